@@ -154,6 +154,40 @@ else:
     }
 
 
+# -----------------------------------------------------------------------------
+# Cache
+# -----------------------------------------------------------------------------
+# Dashboard e relatórios ficam em cache até a próxima mudança na circulação
+# (ver brivo/cache.py). A versão precisa ser a mesma em todos os processos da API:
+# - REDIS_URL definida: Redis;
+# - só DATABASE_URL (produção sem Redis): tabela de cache no próprio banco,
+#   criada pela migração 0035 (ou `python manage.py createcachetable`);
+# - desenvolvimento local (SQLite, um processo): memória do processo.
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',  # Requer o pacote redis
+            'LOCATION': REDIS_URL,
+        }
+    }
+elif DATABASE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'brivo_cache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+CACHE_RESPOSTAS_TIMEOUT = 24 * 3600    # Só limpa entradas de versões antigas; a invalidação é pela versão
+
+
 # -----------------------------------------------------------------------------
 # Validação de Senha, Internacionalização e Arquivos Estáticos
 # -----------------------------------------------------------------------------
@@ -204,6 +238,24 @@ EMAIL_HOST_USER = 'bibliotecabrivo@gmail.com'
 EMAIL_HOST_PASSWORD = 'hpid whck cvdh livf'
 DEFAULT_FROM_EMAIL = 'Biblioteca Escolar <bibliotecabrivo@gmail.com>'
 
+# Fila de e-mails (outbox) consumida por `python manage.py processar_emails`
+EMAIL_OUTBOX_LOTE = 100                # E-mails enviados por lote
+EMAIL_MENSAGENS_POR_CONEXAO = 100      # Mensagens por sessão SMTP antes de reconectar
+EMAIL_BCC_TAMANHO_LOTE = 50            # Destinatários em BCC por mensagem de broadcast
+EMAIL_DESTINATARIOS_POR_BLOCO = 1000   # Usuários lidos do banco por vez nos envios em massa
+EMAIL_ENVIO_THREADS = 4                # Conexões SMTP em paralelo no worker
+EMAIL_LIMITE_POR_SEGUNDO = 5           # Mensagens por segundo (todas as threads)
+EMAIL_LIMITE_POR_DIA = 500             # Destinatários por dia (cota do Gmail)
+EMAIL_MAX_TENTATIVAS = 5               # Após isso o e-mail vai para o dead letter ('falhou')
+EMAIL_BACKOFF_BASE = 60                # Segundos de espera após a primeira falha (dobra a cada falha)
+EMAIL_BACKOFF_MAXIMO = 3600            # Espera máxima entre tentativas
+EMAIL_COTA_RESERVADA_TRANSACIONAL = 150  # Parte da cota diária que só e-mails transacionais usam
+EMAIL_JANELA_CAMPANHA = (19, 7)        # Horário (início, fim) em que campanhas podem sair
+EMAIL_CAMPANHA_POR_LOTE = 20           # Máximo de e-mails de campanha por lote
+EMAIL_RESUMO_JANELA = 24 * 3600        # Segundos que uma notificação espera pelo resumo diário
+EMAIL_OUTBOX_INTERVALO = 5             # Segundos de espera quando a fila está vazia
+EMAIL_OUTBOX_TIMEOUT_BLOQUEIO = 600    # Segundos até um lote reservado voltar para a fila
+
 # -----------------------------------------------------------------------------
 # Configuração de Logging (permanece a mesma, é uma boa configuração)
 # -----------------------------------------------------------------------------
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import Usuario, Livro, Emprestimo, AlertaSistema 
+from .models import Usuario, Livro, Exemplar, Emprestimo, AlertaSistema, EmailOutbox
 
 # Personalização do admin para o modelo Usuario
 class UsuarioAdmin(BaseUserAdmin):
@@ -35,9 +35,16 @@ class LivroAdmin(admin.ModelAdmin):
     disponivel_status.short_description = 'Disponível'
     disponivel_status.boolean = True # Isso diz ao Django para exibir um ícone booleano
 
+# Exemplares físicos (etiquetas com código de barras)
+class ExemplarAdmin(admin.ModelAdmin):
+    list_display = ('id', 'codigo_barras', 'livro', 'status', 'criado_em')
+    list_filter = ('status',)
+    search_fields = ('codigo_barras', 'livro__titulo')
+    ordering = ('livro__titulo', 'codigo_barras')
+
 # Registro do modelo de Empréstimo
 class EmprestimoAdmin(admin.ModelAdmin):
-    list_display = ('id', 'livro', 'usuario', 'data_emprestimo', 'devolvido', 'data_devolucao')
+    list_display = ('id', 'livro', 'exemplar', 'usuario', 'data_emprestimo', 'devolvido', 'data_devolucao')
     list_filter = ('devolvido', 'data_emprestimo', 'data_devolucao')
     search_fields = ('livro__titulo', 'usuario__nome')
     ordering = ('-data_emprestimo',)
@@ -47,14 +54,23 @@ class AlertaSistemaAdmin(admin.ModelAdmin):
     # ATUALIZADO: Inclui os novos campos de visibilidade e agendamento
     list_display = ('id', 'titulo', 'tipo', 'visibilidade', 'data_publicacao', 'expira_em', 'resolvido', 'email_enviado', 'data_criacao')
     # ATUALIZADO: Inclui filtros para os novos campos
-    list_filter = ('tipo', 'visibilidade', 'resolvido', 'email_enviado', 'data_publicacao', 'expira_em')
+    list_filter = ('tipo', 'categoria', 'visibilidade', 'resolvido', 'email_enviado', 'data_publicacao', 'expira_em')
     search_fields = ('titulo', 'mensagem')
     ordering = ('-data_criacao',) 
     list_editable = ('resolvido',) # Permite editar 'resolvido' diretamente na lista
 
+# Fila de e-mails (outbox)
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'destinatario', 'assunto', 'status', 'tentativas', 'criado_em', 'enviado_em')
+    list_filter = ('status', 'criado_em')
+    search_fields = ('destinatario', 'assunto')
+    ordering = ('-criado_em',)
+
 
 # Registro no admin
 admin.site.register(Usuario, UsuarioAdmin)
 admin.site.register(Livro, LivroAdmin)
+admin.site.register(Exemplar, ExemplarAdmin)
 admin.site.register(Emprestimo, EmprestimoAdmin)
-admin.site.register(AlertaSistema, AlertaSistemaAdmin) 
+admin.site.register(AlertaSistema, AlertaSistemaAdmin)
+admin.site.register(EmailOutbox, EmailOutboxAdmin)
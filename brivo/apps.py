@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class BrivoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'brivo'
+
+    def ready(self):
+        from . import signals  # noqa: F401 (conecta os receivers de invalidação do cache)
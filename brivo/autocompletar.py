@@ -0,0 +1,158 @@
+"""
+Índice de prefixos em memória para o autocompletar do catálogo.
+
+Cada processo guarda uma lista ordenada de chaves normalizadas (título completo,
+autor completo e cada palavra de título e autor) apontando para o id do livro, e
+responde a um prefixo com bisect, sem ir ao banco.
+
+- O índice é montado na primeira consulta (uma leitura de livros ativos).
+- Gravações de Livro neste processo atualizam só as chaves daquele livro, após o commit.
+- Gravações em outro processo mudam a versão do catálogo (brivo/cache.py). A versão
+  é lida no cache no máximo a cada INTERVALO_VERIFICACAO segundos (com Redis, cada
+  leitura é uma ida à rede); ao ver uma versão que não conhece, o índice é remontado.
+"""
+import heapq
+import threading
+import time
+from bisect import bisect_left, bisect_right
+
+from django.db import transaction
+
+from .busca import normalizar_texto
+from .cache import incrementar_versao_catalogo, versao_catalogo
+
+TAMANHO_MAXIMO_CHAVE = 40   # Prefixos digitados raramente passam disso
+TAMANHO_MINIMO_PALAVRA = 3  # 'de', 'o', 'a' não viram chave
+MAXIMO_CANDIDATOS = 300     # Chaves percorridas por consulta, no máximo
+INTERVALO_VERIFICACAO = 5   # Segundos entre leituras da versão do catálogo no cache
+
+
+def _chaves(titulo, autor):
+    chaves = set()
+    for texto in (titulo, autor):
+        normalizado = normalizar_texto(texto)
+        if not normalizado:
+            continue
+        chaves.add(normalizado[:TAMANHO_MAXIMO_CHAVE])
+        chaves.update(p[:TAMANHO_MAXIMO_CHAVE] for p in normalizado.split() if len(p) >= TAMANHO_MINIMO_PALAVRA)
+    return chaves
+
+
+class IndicePrefixos:
+
+    def __init__(self):
+        self._trava = threading.Lock()
+        self._chaves = []     # Chaves ordenadas...
+        self._ids = []        # ...e o id do livro de cada uma, na mesma posição
+        self._livros = {}     # id -> (titulo, autor, titulo normalizado, popularidade, chaves)
+        self.versao = None    # Versão do catálogo que o índice reflete (None = não montado)
+        self._verificado_em = None  # time.monotonic() da última leitura da versão
+
+    def montar(self):
+        from .models import Livro
+
+        versao = versao_catalogo()
+        self._verificado_em = time.monotonic()
+        livros = {}
+        entradas = []
+        for livro_id, titulo, autor, popularidade in Livro.objects.filter(ativo=True).values_list(
+            'id', 'titulo', 'autor', 'total_emprestimos'
+        ).iterator(chunk_size=2000):
+            chaves = _chaves(titulo, autor)
+            livros[livro_id] = (titulo, autor, normalizar_texto(titulo), popularidade, chaves)
+            entradas.extend((chave, livro_id) for chave in chaves)
+        entradas.sort()
+
+        with self._trava:
+            self._chaves = [chave for chave, _ in entradas]
+            self._ids = [livro_id for _, livro_id in entradas]
+            self._livros = livros
+            self.versao = versao
+
+    def invalidar(self):
+        """Descarta o índice; a próxima consulta o remonta."""
+        self.versao = None
+
+    def _remover(self, livro_id):
+        dados = self._livros.pop(livro_id, None)
+        if dados is None:
+            return
+        for chave in dados[4]:
+            inicio, fim = bisect_left(self._chaves, chave), bisect_right(self._chaves, chave)
+            for posicao in range(inicio, fim):
+                if self._ids[posicao] == livro_id:
+                    del self._chaves[posicao]
+                    del self._ids[posicao]
+                    break
+
+    def _inserir(self, livro_id, titulo, autor, popularidade):
+        chaves = _chaves(titulo, autor)
+        self._livros[livro_id] = (titulo, autor, normalizar_texto(titulo), popularidade, chaves)
+        for chave in chaves:
+            posicao = bisect_right(self._chaves, chave)
+            self._chaves.insert(posicao, chave)
+            self._ids.insert(posicao, livro_id)
+
+    def aplicar(self, livro_id, dados, versao_anterior, versao_nova):
+        """
+        Atualiza um livro (dados = (titulo, autor, popularidade), ou None para remover).
+        Se a versão anterior não é a que o índice conhece, outro processo também mudou
+        o catálogo: descarta o índice para remontar na próxima consulta.
+        """
+        with self._trava:
+            if self.versao is None:
+                return
+            if self.versao != versao_anterior:
+                self.invalidar()
+                return
+            self._remover(livro_id)
+            if dados is not None:
+                self._inserir(livro_id, *dados)
+            self.versao = versao_nova
+
+    def sugerir(self, termo, limite=8):
+        """
+        Até `limite` livros cujo título, autor ou alguma palavra deles começa com o termo.
+        Títulos que começam com o termo vêm primeiro; depois, os mais emprestados.
+        """
+        prefixo = normalizar_texto(termo)[:TAMANHO_MAXIMO_CHAVE]
+        if not prefixo:
+            return []
+        if self.versao is None:
+            self.montar()
+        elif time.monotonic() - self._verificado_em >= INTERVALO_VERIFICACAO:
+            self._verificado_em = time.monotonic()
+            if self.versao != versao_catalogo():
+                self.montar()
+
+        with self._trava:
+            encontrados = set()
+            posicao = bisect_left(self._chaves, prefixo)
+            fim = min(posicao + MAXIMO_CANDIDATOS, len(self._chaves))
+            while posicao < fim and self._chaves[posicao].startswith(prefixo):
+                encontrados.add(self._ids[posicao])
+                posicao += 1
+            livros = [(livro_id, self._livros[livro_id]) for livro_id in encontrados]
+
+        melhores = heapq.nsmallest(
+            limite, livros, key=lambda item: (not item[1][2].startswith(prefixo), -item[1][3], item[1][2])
+        )
+        return [{'id': livro_id, 'titulo': titulo, 'autor': autor} for livro_id, (titulo, autor, _, _, _) in melhores]
+
+
+indice = IndicePrefixos()
+
+
+def livro_alterado(livro, removido=False):
+    """
+    Agenda a atualização do índice deste processo para depois do commit.
+    Livros inativos saem do autocompletar, como saem da listagem.
+    """
+    livro_id = livro.pk
+    dados = None if removido or not livro.ativo else (livro.titulo, livro.autor, livro.total_emprestimos)
+
+    def atualizar():
+        versao_nova = incrementar_versao_catalogo()
+        indice.aplicar(livro_id, dados, versao_nova - 1, versao_nova)
+
+    transaction.on_commit(atualizar)
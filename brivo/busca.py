@@ -0,0 +1,227 @@
+"""
+Busca textual do catálogo de livros.
+
+- SQLite (db.sqlite3 local): tabela virtual FTS5 `brivo_livro_fts`, com o texto
+  já sem acentos e reduzido ao radical por `radical()`, ordenada por bm25.
+- PostgreSQL (DATABASE_URL): coluna `busca` (tsvector) em brivo_livro com índice
+  GIN, gerada com a configuração 'portuguese' sobre o texto sem acentos e
+  ordenada por ts_rank.
+
+Os dois índices são criados pela migração 0032 e atualizados por `indexar_livro`
+(chamado no Livro.save) e `remover_livro` (post_delete). Em qualquer outro banco
+a busca volta ao SearchFilter do DRF (LIKE).
+A verificação de duplicatas usa os trigramas de título + autor (LivroTrigrama),
+em qualquer banco. Para reconstruir os índices: `python manage.py reindex_catalog`.
+"""
+import re
+import unicodedata
+
+from django.db import connection
+from rest_framework import filters
+
+TABELA_FTS = 'brivo_livro_fts'
+
+# Pesos por campo: título pesa mais que autor, que pesa mais que gênero e descrição
+CAMPOS = ('titulo', 'autor', 'genero', 'descricao')
+PESOS_BM25 = '10.0, 5.0, 2.0, 1.0'
+PESOS_TSVECTOR = {'titulo': 'A', 'autor': 'B', 'genero': 'C', 'descricao': 'D'}
+
+# Redução de plural do português (sem acentos), da mais longa para a mais curta
+_PLURAIS = (('oes', 'ao'), ('aes', 'ao'), ('ais', 'al'), ('eis', 'el'), ('ois', 'ol'),
+            ('ns', 'm'), ('res', 'r'), ('les', 'l'), ('zes', 'z'), ('s', ''))
+
+
+def normalizar_texto(texto):
+    """
+    Minúsculas, sem acentos e só com letras, números e espaços simples.
+    'Memórias Póstumas' -> 'memorias postumas'
+    """
+    if not texto:
+        return ''
+    sem_acentos = ''.join(
+        c for c in unicodedata.normalize('NFKD', str(texto)) if not unicodedata.combining(c)
+    )
+    return ' '.join(re.findall(r'\w+', sem_acentos.lower()))
+
+
+def radical(palavra):
+    """
+    Radical simplificado de uma palavra já normalizada: tira o plural e a vogal
+    final de gênero ('meninas' e 'menino' -> 'menin'). Usado no SQLite, que não
+    tem stemmer de português; o PostgreSQL usa o da configuração 'portuguese'.
+    """
+    if len(palavra) >= 4:
+        for sufixo, troca in _PLURAIS:
+            if palavra.endswith(sufixo):
+                palavra = palavra[:-len(sufixo)] + troca
+                break
+    if len(palavra) >= 5 and palavra[-1] in 'aoe':
+        palavra = palavra[:-1]
+    return palavra
+
+
+def _texto_fts(texto):
+    return ' '.join(radical(p) for p in normalizar_texto(texto).split())
+
+
+def backend():
+    """'sqlite', 'postgresql' ou None se o banco não tem índice de busca."""
+    return connection.vendor if connection.vendor in ('sqlite', 'postgresql') else None
+
+
+def _sql_tsvector():
+    return ' || '.join(
+        f"setweight(to_tsvector('portuguese', %s), '{peso}')" for peso in PESOS_TSVECTOR.values()
+    )
+
+
+def indexar_livro(livro):
+    """Grava (ou regrava) o livro no índice de busca. Chamado dentro da transação do save."""
+    valores = [getattr(livro, campo) for campo in CAMPOS]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f"DELETE FROM {TABELA_FTS} WHERE rowid = %s", [livro.pk])
+            cursor.execute(
+                f"INSERT INTO {TABELA_FTS} (rowid, {', '.join(CAMPOS)}) VALUES (%s, %s, %s, %s, %s)",
+                [livro.pk] + [_texto_fts(valor) for valor in valores],
+            )
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                f"UPDATE brivo_livro SET busca = {_sql_tsvector()} WHERE id = %s",
+                [normalizar_texto(valor) for valor in valores] + [livro.pk],
+            )
+
+
+def remover_livro(livro_id):
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABELA_FTS} WHERE rowid = %s", [livro_id])
+
+
+def reindexar(tamanho_lote=1000):
+    """
+    Reconstrói o índice de texto e os trigramas a partir da tabela de livros.
+    Retorna quantos livros foram indexados.
+    """
+    from .models import Livro
+
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABELA_FTS}")
+    total = 0
+    for livro in Livro.objects.only('id', *CAMPOS).iterator(chunk_size=tamanho_lote):
+        if backend():
+            indexar_livro(livro)
+        indexar_trigramas(livro)
+        total += 1
+    return total
+
+
+def buscar(queryset, termo):
+    """
+    Filtra o queryset de livros pelo termo e ordena por relevância (campo `relevancia`).
+    Retorna None se a busca textual não está disponível neste banco.
+    """
+    if not backend():
+        return None
+
+    if connection.vendor == 'sqlite':
+        radicais = [radical(p) for p in normalizar_texto(termo).split()]
+        if not radicais:
+            return queryset
+        # Cada palavra vira um prefixo entre aspas: o usuário não consegue injetar sintaxe do FTS5
+        consulta = ' '.join(f'"{r}"*' for r in radicais)
+        return queryset.extra(
+            tables=[TABELA_FTS],
+            where=[f'{TABELA_FTS}.rowid = brivo_livro.id', f'{TABELA_FTS} MATCH %s'],
+            params=[consulta],
+            select={'relevancia': f'bm25({TABELA_FTS}, {PESOS_BM25})'},
+        ).order_by('relevancia', 'titulo')
+
+    consulta = normalizar_texto(termo)
+    if not consulta:
+        return queryset
+    return queryset.extra(
+        where=["brivo_livro.busca @@ plainto_tsquery('portuguese', %s)"],
+        params=[consulta],
+        select={'relevancia': "ts_rank(brivo_livro.busca, plainto_tsquery('portuguese', %s))"},
+        select_params=[consulta],
+    ).order_by('-relevancia', 'titulo')
+
+
+class BuscaTextoCompletoFilter(filters.SearchFilter):
+    """
+    SearchFilter do DRF que usa o índice de texto completo (?search=machado assis),
+    ordenando por relevância. Em bancos sem índice, faz o LIKE de sempre.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        termo = request.query_params.get(self.search_param, '')
+        if not termo.strip():
+            return queryset
+        resultado = buscar(queryset, termo)
+        if resultado is None:
+            return super().filter_queryset(request, queryset, view)
+        return resultado
+
+
+# -----------------------------------------------------------------------------
+# Similaridade por trigramas (verificação de duplicatas)
+# -----------------------------------------------------------------------------
+# Cada livro tem seus trigramas de "titulo autor" (normalizados) na tabela
+# LivroTrigrama, com índice em (trigrama, livro). A busca lê só as listas dos
+# trigramas da consulta, como o pg_trgm, e pontua pelo coeficiente de Jaccard.
+
+SIMILARIDADE_MINIMA = 0.3
+
+
+def trigramas(texto):
+    """
+    Trigramas de cada palavra normalizada, com o mesmo preenchimento do pg_trgm
+    ('  c', ' ca', 'cas', ..., 'ro ').
+    """
+    conjunto = set()
+    for palavra in normalizar_texto(texto).split():
+        preenchida = f'  {palavra} '
+        conjunto.update(preenchida[i:i + 3] for i in range(len(preenchida) - 2))
+    return conjunto
+
+
+def indexar_trigramas(livro):
+    """Regrava os trigramas de um livro. Chamado dentro da transação do save."""
+    from .models import LivroTrigrama
+
+    LivroTrigrama.objects.filter(livro_id=livro.pk).delete()
+    conjunto = trigramas(f'{livro.titulo} {livro.autor}')
+    LivroTrigrama.objects.bulk_create([
+        LivroTrigrama(livro_id=livro.pk, trigrama=trigrama, total_do_livro=len(conjunto)) for trigrama in conjunto
+    ])
+
+
+def livros_similares(titulo, autor, limite=5, minimo=SIMILARIDADE_MINIMA):
+    """
+    Os `limite` livros ativos mais parecidos com título + autor, como lista de
+    (livro, similaridade de 0 a 1), da maior para a menor. Duas consultas,
+    independentemente do tamanho do acervo.
+    """
+    from django.db.models import Count, F, FloatField, Max, Value
+    from django.db.models.functions import Cast
+    from .models import Livro, LivroTrigrama
+
+    alvo = trigramas(f'{titulo} {autor}')
+    if not alvo:
+        return []
+
+    # Jaccard calculado no banco para todos os livros com algum trigrama em comum:
+    # comuns / (trigramas da consulta + trigramas do livro - comuns)
+    pontuados = list(
+        LivroTrigrama.objects.filter(trigrama__in=alvo, livro__ativo=True)
+        .values('livro')
+        .annotate(comuns=Count('id'), total=Max('total_do_livro'))
+        .annotate(similaridade=Cast(F('comuns'), FloatField()) / (Value(len(alvo)) + F('total') - F('comuns')))
+        .filter(similaridade__gte=minimo)
+        .order_by('-similaridade', 'livro')
+        .values_list('similaridade', 'livro')[:limite]
+    )
+    livros = Livro.objects.in_bulk([livro_id for _, livro_id in pontuados])
+    return [(livros[livro_id], similaridade) for similaridade, livro_id in pontuados]
@@ -0,0 +1,117 @@
+"""
+Cache das respostas de dashboard e relatórios.
+
+Toda chave inclui a "versão da circulação": um contador global incrementado
+(após o commit) sempre que um Emprestimo, Reserva, Livro ou Usuario é gravado
+ou apagado — ver brivo/signals.py. Uma resposta em cache vale até a próxima
+mudança; não há TTL adivinhado, o timeout só descarta versões antigas. A chave
+também leva o dia local: contadores como "reservas de hoje" e "últimos 7 dias"
+mudam à meia-noite mesmo sem nenhuma gravação.
+"""
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.db import DatabaseCache
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+CHAVE_VERSAO = 'brivo:circulacao:versao'
+CHAVE_VERSAO_CATALOGO = 'brivo:catalogo:versao'
+
+
+def _versao(chave):
+    versao = cache.get(chave)
+    if versao is None:
+        # Começa do relógio: se a chave for descartada, nunca volta a uma versão já usada
+        cache.add(chave, int(time.time() * 1000), timeout=None)
+        versao = cache.get(chave)
+    return versao
+
+
+TENTATIVAS_TRAVA = 50      # x ESPERA_TRAVA: pouco mais que o timeout da trava
+ESPERA_TRAVA = 0.1
+TIMEOUT_TRAVA = 5          # Uma trava de processo que morreu expira sozinha
+
+
+def _incrementar(chave):
+    """
+    Incrementa a versão e retorna o novo valor. No Redis e na memória local o incr
+    é atômico; no DatabaseCache ele é um get + set, então o incremento roda sob uma
+    trava feita com `add` (um INSERT, que só um processo consegue fazer).
+    """
+    if not isinstance(caches['default'], DatabaseCache):
+        try:
+            return cache.incr(chave)
+        except ValueError:
+            return _versao(chave)
+
+    trava = f'{chave}:trava'
+    for _ in range(TENTATIVAS_TRAVA):
+        if cache.add(trava, 1, timeout=TIMEOUT_TRAVA):
+            try:
+                versao = _versao(chave) + 1
+                cache.set(chave, versao, timeout=None)
+                return versao
+            finally:
+                cache.delete(trava)
+        time.sleep(ESPERA_TRAVA)
+    # A trava já teria expirado; segue sem ela em vez de perder a invalidação
+    versao = _versao(chave) + 1
+    cache.set(chave, versao, timeout=None)
+    return versao
+
+
+def versao_circulacao():
+    return _versao(CHAVE_VERSAO)
+
+
+def _incrementar_versao():
+    _incrementar(CHAVE_VERSAO)
+
+
+def versao_catalogo():
+    """Versão dos dados cadastrais dos livros (título, autor, ativo...), sem o estoque."""
+    return _versao(CHAVE_VERSAO_CATALOGO)
+
+
+def incrementar_versao_catalogo():
+    """Chamado após o commit de uma gravação de Livro. Retorna a nova versão."""
+    return _incrementar(CHAVE_VERSAO_CATALOGO)
+
+
+def invalidar_circulacao():
+    """
+    Invalida todas as respostas em cache quando a transação atual fizer commit.
+    Antes do commit, outra requisição ainda vê (e guarda) os dados antigos na versão antiga.
+    """
+    transaction.on_commit(_incrementar_versao)
+
+
+def resposta_em_cache(nome, por_usuario=False):
+    """
+    Decorator para o `get` de uma APIView. A chave é o endpoint, o `periodo`
+    da query string, a versão da circulação, o dia local e, se `por_usuario`, o usuário.
+    Só respostas 200 são guardadas.
+    """
+    def decorador(metodo):
+        @wraps(metodo)
+        def envolvido(self, request, *args, **kwargs):
+            usuario = request.user.pk if por_usuario else '-'
+            periodo = request.query_params.get('periodo') or '-'
+            dia = timezone.localdate().isoformat()
+            chave = f'brivo:resposta:{nome}:{versao_circulacao()}:{dia}:{periodo}:{usuario}'
+
+            dados = cache.get(chave)
+            if dados is not None:
+                return Response(dados)
+
+            resposta = metodo(self, request, *args, **kwargs)
+            if resposta.status_code == status.HTTP_200_OK:
+                cache.set(chave, resposta.data, settings.CACHE_RESPOSTAS_TIMEOUT)
+            return resposta
+        return envolvido
+    return decorador
@@ -0,0 +1,475 @@
+"""
+Fila persistente de e-mails (outbox).
+
+As views e os helpers `enviar_email_*` apenas gravam o e-mail na tabela
+`EmailOutbox`. O envio SMTP acontece fora da requisição HTTP, no comando
+`python manage.py processar_emails`, que consome a fila em lotes.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import logging
+import random
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F, Min, Q
+from django.utils import timezone
+
+from .email_templates import EMAIL_RESUMO_DIARIO
+from .models import EmailOutbox, HistoricoAcao, Usuario
+
+logger = logging.getLogger(__name__)
+
+
+def enfileirar_email(destinatario, assunto, mensagem, html=False, prioridade=EmailOutbox.PRIORIDADE_TRANSACIONAL,
+                     resumo=False):
+    """
+    Grava um e-mail na fila para envio posterior pelo worker.
+    Com `resumo=True` o e-mail fica guardado para o resumo diário do destinatário.
+    """
+    return EmailOutbox.objects.create(
+        destinatario=destinatario,
+        assunto=assunto,
+        mensagem=mensagem,
+        html=html,
+        prioridade=prioridade,
+        status='resumo' if resumo else 'pendente',
+    )
+
+
+def enfileirar_emails(mensagens, html=False, prioridade=EmailOutbox.PRIORIDADE_TRANSACIONAL):
+    """
+    Grava vários e-mails na fila com um único INSERT (em lotes).
+    `mensagens` é uma lista de tuplas (destinatario, assunto, mensagem).
+    """
+    return EmailOutbox.objects.bulk_create(
+        [
+            EmailOutbox(destinatario=destinatario, assunto=assunto, mensagem=mensagem, html=html, prioridade=prioridade)
+            for destinatario, assunto, mensagem in mensagens
+        ],
+        batch_size=500,
+    )
+
+
+def enfileirar_broadcast(destinatarios, assunto, mensagem, tamanho_bloco=None,
+                         prioridade=EmailOutbox.PRIORIDADE_INFORMATIVO):
+    """
+    Enfileira um conteúdo idêntico para muitos destinatários como poucas
+    mensagens, cada uma com até `tamanho_bloco` endereços em BCC.
+    O campo "Para" de cada mensagem é o próprio e-mail da biblioteca.
+    """
+    tamanho_bloco = tamanho_bloco or settings.EMAIL_BCC_TAMANHO_LOTE
+    return EmailOutbox.objects.bulk_create([
+        EmailOutbox(
+            destinatario=settings.EMAIL_HOST_USER,
+            bcc=destinatarios[inicio:inicio + tamanho_bloco],
+            assunto=assunto,
+            mensagem=mensagem,
+            prioridade=prioridade,
+        )
+        for inicio in range(0, len(destinatarios), tamanho_bloco)
+    ])
+
+
+def construir_mensagem(item):
+    """
+    Monta o EmailMessage do Django a partir de um item da fila.
+    """
+    email = EmailMessage(
+        subject=item.assunto,
+        body=item.mensagem,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[item.destinatario],
+        bcc=item.bcc,
+    )
+    if item.html:
+        email.content_subtype = 'html'
+    return email
+
+
+class TokenBucket:
+    """
+    Balde de fichas thread-safe: recebe `taxa` fichas por segundo e acumula
+    no máximo `capacidade`. Cada envio consome fichas.
+    """
+    def __init__(self, taxa, capacidade, fichas=None):
+        self.taxa = taxa
+        self.capacidade = capacidade
+        self.fichas = capacidade if fichas is None else fichas
+        self.atualizado_em = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reabastecer(self):
+        agora = time.monotonic()
+        self.fichas = min(self.capacidade, self.fichas + (agora - self.atualizado_em) * self.taxa)
+        self.atualizado_em = agora
+
+    def disponiveis(self):
+        with self._lock:
+            self._reabastecer()
+            return int(self.fichas)
+
+    def consumir(self, quantidade=1, bloquear=True):
+        """
+        Consome `quantidade` fichas. Com `bloquear=True` espera até haver
+        fichas suficientes; caso contrário retorna False imediatamente.
+        """
+        quantidade = min(quantidade, self.capacidade)
+        while True:
+            with self._lock:
+                self._reabastecer()
+                if self.fichas >= quantidade:
+                    self.fichas -= quantidade
+                    return True
+                espera = (quantidade - self.fichas) / self.taxa
+            if not bloquear:
+                return False
+            time.sleep(espera)
+
+
+class LimitadorEnvio:
+    """
+    Limites do provedor (Gmail) compartilhados por todas as threads do worker:
+    mensagens por segundo e destinatários por dia (janela móvel de 24h).
+    """
+    def __init__(self, por_segundo, por_dia, enviados_ultimas_24h=0):
+        self.por_segundo = TokenBucket(por_segundo, capacidade=max(1, por_segundo))
+        self.por_dia = TokenBucket(
+            por_dia / 86400, capacidade=por_dia,
+            fichas=max(0, por_dia - enviados_ultimas_24h),
+        )
+
+    def disponiveis_hoje(self):
+        return self.por_dia.disponiveis()
+
+    def reservar_cota_diaria(self, destinatarios):
+        return self.por_dia.consumir(destinatarios, bloquear=False)
+
+    def aguardar_vez(self):
+        self.por_segundo.consumir()
+
+
+_limitador = None
+_limitador_lock = threading.Lock()
+
+
+def destinatarios_enviados_ultimas_24h():
+    """
+    Conta os destinatários (Para + BCC) entregues nas últimas 24 horas.
+    """
+    desde = timezone.now() - timedelta(days=1)
+    return sum(
+        1 + len(bcc)
+        for bcc in EmailOutbox.objects.filter(status='enviado', enviado_em__gte=desde).values_list('bcc', flat=True)
+    )
+
+
+def obter_limitador():
+    """
+    Limitador compartilhado do processo, iniciado com o que já foi enviado
+    nas últimas 24 horas para respeitar a cota diária entre reinícios.
+    """
+    global _limitador
+    with _limitador_lock:
+        if _limitador is None:
+            _limitador = LimitadorEnvio(
+                settings.EMAIL_LIMITE_POR_SEGUNDO,
+                settings.EMAIL_LIMITE_POR_DIA,
+                destinatarios_enviados_ultimas_24h(),
+            )
+        return _limitador
+
+
+def _conexao_continua_valida(erro):
+    """
+    Erros em que o servidor respondeu normalmente (destinatário recusado,
+    remetente recusado, mensagem rejeitada) não derrubam a sessão SMTP.
+    """
+    return isinstance(erro, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused))
+
+
+def enviar_mensagens(mensagens, por_conexao=None, limitador=None):
+    """
+    Envia uma lista de EmailMessage reaproveitando a mesma conexão SMTP.
+
+    As mensagens passam por `send_messages` em blocos de `por_conexao`
+    (EMAIL_MENSAGENS_POR_CONEXAO), com uma conexão por bloco. Retorna uma
+    lista, na mesma ordem de `mensagens`, com None para cada envio bem-sucedido
+    ou o texto do erro daquele destinatário. Com `limitador`, cada envio
+    espera a sua vez no limite de mensagens por segundo.
+    """
+    por_conexao = por_conexao or settings.EMAIL_MENSAGENS_POR_CONEXAO
+    resultados = []
+
+    for inicio in range(0, len(mensagens), por_conexao):
+        bloco = mensagens[inicio:inicio + por_conexao]
+        conexao = get_connection(fail_silently=False)
+        try:
+            conexao.open()
+        except Exception as e:
+            logger.error(f"Falha ao abrir conexão SMTP: {str(e)}")
+            resultados.extend([str(e)] * len(bloco))
+            continue
+
+        try:
+            for posicao, mensagem in enumerate(bloco):
+                if limitador:
+                    limitador.aguardar_vez()
+                try:
+                    if not conexao.send_messages([mensagem]):
+                        resultados.append("Mensagem sem destinatários válidos")
+                        continue
+                    resultados.append(None)
+                except Exception as e:
+                    resultados.append(str(e))
+                    if _conexao_continua_valida(e):
+                        continue
+                    # A sessão caiu: reabre para o restante do bloco
+                    conexao.close()
+                    try:
+                        conexao.open()
+                    except Exception as erro_conexao:
+                        restantes = len(bloco) - posicao - 1
+                        resultados.extend([str(erro_conexao)] * restantes)
+                        break
+        finally:
+            conexao.close()
+
+    return resultados
+
+
+def enviar_mensagens_em_paralelo(mensagens, threads=None, limitador=None):
+    """
+    Divide as mensagens entre até `threads` threads (EMAIL_ENVIO_THREADS),
+    cada uma com a sua própria conexão SMTP, e junta os resultados na ordem
+    original. Todas as threads respeitam o mesmo `limitador`.
+    """
+    threads = max(1, min(threads or settings.EMAIL_ENVIO_THREADS, len(mensagens)))
+    if threads == 1:
+        return enviar_mensagens(mensagens, limitador=limitador)
+
+    tamanho = -(-len(mensagens) // threads)  # divisão arredondando para cima
+    partes = [mensagens[inicio:inicio + tamanho] for inicio in range(0, len(mensagens), tamanho)]
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='email') as executor:
+        resultados_por_parte = executor.map(lambda parte: enviar_mensagens(parte, limitador=limitador), partes)
+        return [resultado for resultados in resultados_por_parte for resultado in resultados]
+
+
+def liberar_bloqueios_expirados():
+    """
+    Devolve para a fila e-mails presos em 'enviando' por um worker que morreu.
+    """
+    limite = timezone.now() - timedelta(seconds=settings.EMAIL_OUTBOX_TIMEOUT_BLOQUEIO)
+    return EmailOutbox.objects.filter(
+        status='enviando',
+        bloqueado_em__lt=limite,
+    ).update(status='pendente', bloqueado_em=None)
+
+
+def consolidar_resumos(janela=None):
+    """
+    Junta as notificações guardadas para o resumo diário em um único e-mail por
+    destinatário, assim que a mais antiga delas completa `janela` segundos
+    (EMAIL_RESUMO_JANELA). Notificações idênticas entram uma vez só, e cada
+    resumo gera um único registro NOTIFICACAO no histórico.
+    Retorna quantos resumos foram enfileirados.
+    """
+    janela = settings.EMAIL_RESUMO_JANELA if janela is None else janela
+    limite = timezone.now() - timedelta(seconds=janela)
+    prontos = (
+        EmailOutbox.objects.filter(status='resumo')
+        .values('destinatario')
+        .annotate(primeiro=Min('criado_em'))
+        .filter(primeiro__lte=limite)
+        .values_list('destinatario', flat=True)
+    )
+
+    total = 0
+    for destinatario in list(prontos):
+        with transaction.atomic():
+            itens = list(
+                EmailOutbox.objects.select_for_update(skip_locked=True)
+                .filter(status='resumo', destinatario=destinatario)
+                .order_by('criado_em')
+            )
+            if not itens:
+                continue
+
+            unicos = list(dict.fromkeys((item.assunto, item.mensagem.strip()) for item in itens))
+            usuario = Usuario.objects.filter(email=destinatario).first()
+            EmailOutbox.objects.create(
+                destinatario=destinatario,
+                assunto=EMAIL_RESUMO_DIARIO['assunto'].format(total=len(unicos)),
+                mensagem=EMAIL_RESUMO_DIARIO['template'].format(
+                    nome=usuario.nome if usuario else destinatario,
+                    itens=EMAIL_RESUMO_DIARIO['separador'].join(f"{assunto}\n\n{mensagem}" for assunto, mensagem in unicos),
+                ),
+                prioridade=EmailOutbox.PRIORIDADE_INFORMATIVO,
+            )
+            EmailOutbox.objects.filter(id__in=[item.id for item in itens]).delete()
+            if usuario:
+                HistoricoAcao.objects.create(
+                    usuario=None,
+                    objeto_tipo='Usuario',
+                    objeto_id=usuario.id,
+                    acao='NOTIFICACAO',
+                    descricao=f'Resumo diário com {len(unicos)} notificações enviado para {usuario.nome}',
+                )
+            total += 1
+
+    if total:
+        logger.info(f"{total} resumos diários adicionados à fila")
+    return total
+
+
+def em_janela_de_campanha(agora=None):
+    """
+    Indica se estamos na janela fora de pico (EMAIL_JANELA_CAMPANHA, em horas
+    locais) em que e-mails de campanha podem ser enviados.
+    """
+    hora = timezone.localtime(agora).hour
+    inicio, fim = settings.EMAIL_JANELA_CAMPANHA
+    if inicio <= fim:
+        return inicio <= hora < fim
+    return hora >= inicio or hora < fim  # Janela que atravessa a meia-noite
+
+
+def reservar_lote(tamanho, max_campanha=0):
+    """
+    Reserva até `tamanho` e-mails pendentes para este worker, dos mais
+    prioritários para os menos. No máximo `max_campanha` deles podem ser de
+    campanha. Usa SKIP LOCKED (quando o banco suporta) para que vários workers
+    não peguem o mesmo e-mail.
+    """
+    with transaction.atomic():
+        prontos = (
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status='pendente')
+            .filter(Q(proxima_tentativa_em__isnull=True) | Q(proxima_tentativa_em__lte=timezone.now()))
+            .order_by('prioridade', 'criado_em')
+        )
+        ids = list(
+            prontos.exclude(prioridade=EmailOutbox.PRIORIDADE_CAMPANHA)
+            .values_list('id', flat=True)[:tamanho]
+        )
+        vagas_campanha = min(tamanho - len(ids), max_campanha)
+        if vagas_campanha > 0:
+            ids += list(
+                prontos.filter(prioridade=EmailOutbox.PRIORIDADE_CAMPANHA)
+                .values_list('id', flat=True)[:vagas_campanha]
+            )
+        if ids:
+            EmailOutbox.objects.filter(id__in=ids).update(status='enviando', bloqueado_em=timezone.now())
+    return list(EmailOutbox.objects.filter(id__in=ids).order_by('prioridade', 'criado_em'))
+
+
+def calcular_backoff(tentativas):
+    """
+    Espera (em segundos) antes da próxima tentativa: exponencial a partir de
+    EMAIL_BACKOFF_BASE, limitada a EMAIL_BACKOFF_MAXIMO, com jitter para que
+    e-mails que falharam juntos não sejam reenviados todos ao mesmo tempo.
+    """
+    atraso = min(settings.EMAIL_BACKOFF_MAXIMO, settings.EMAIL_BACKOFF_BASE * 2 ** (tentativas - 1))
+    return atraso / 2 + random.uniform(0, atraso / 2)
+
+
+def registrar_falha(item, erro):
+    """
+    Registra a falha de envio: agenda nova tentativa com backoff ou, após
+    EMAIL_MAX_TENTATIVAS, move o e-mail para o dead letter ('falhou').
+    """
+    item.tentativas += 1
+    item.erro = erro
+    item.bloqueado_em = None
+    if item.tentativas >= settings.EMAIL_MAX_TENTATIVAS:
+        item.status = 'falhou'
+        item.proxima_tentativa_em = None
+        logger.error(f"Email para {item.destinatario} movido para o dead letter após {item.tentativas} tentativas: {erro}")
+    else:
+        item.status = 'pendente'
+        item.proxima_tentativa_em = timezone.now() + timedelta(seconds=calcular_backoff(item.tentativas))
+        logger.warning(f"Falha ao enviar email para {item.destinatario} (tentativa {item.tentativas}); nova tentativa agendada: {erro}")
+    item.save(update_fields=['status', 'erro', 'tentativas', 'bloqueado_em', 'proxima_tentativa_em'])
+
+
+def reenviar_falhas(ids=None):
+    """
+    Devolve e-mails do dead letter para a fila, zerando as tentativas.
+    Sem `ids`, reenvia todos. Retorna quantos voltaram para a fila.
+    """
+    falhas = EmailOutbox.objects.filter(status='falhou')
+    if ids:
+        falhas = falhas.filter(id__in=ids)
+    return falhas.update(status='pendente', tentativas=0, erro='', proxima_tentativa_em=None)
+
+
+def processar_lote(tamanho=None, limitador=None):
+    """
+    Envia um lote de e-mails pendentes em paralelo, respeitando a cota diária
+    e o limite por segundo do provedor.
+
+    E-mails transacionais saem primeiro. Campanhas só são enviadas na janela
+    fora de pico, em poucas unidades por lote (EMAIL_CAMPANHA_POR_LOTE).
+    Nada além dos transacionais (campanhas, alertas públicos, envios em grupo)
+    consome a parte da cota reservada a eles (EMAIL_COTA_RESERVADA_TRANSACIONAL).
+    Retorna a tupla (enviados, falhas).
+    """
+    tamanho = tamanho or settings.EMAIL_OUTBOX_LOTE
+    limitador = limitador or obter_limitador()
+    reserva = settings.EMAIL_COTA_RESERVADA_TRANSACIONAL
+
+    disponiveis = limitador.disponiveis_hoje()
+    if disponiveis <= 0:
+        logger.warning("Cota diária de e-mails atingida; a fila aguarda a renovação")
+        return 0, 0
+
+    max_campanha = 0
+    if em_janela_de_campanha():
+        max_campanha = max(0, min(settings.EMAIL_CAMPANHA_POR_LOTE, disponiveis - reserva))
+
+    itens = reservar_lote(min(tamanho, disponiveis), max_campanha=max_campanha)
+
+    # Cada mensagem consome da cota diária um destinatário por endereço (Para + BCC)
+    dentro_da_cota = []
+    devolver = []
+    for item in itens:
+        custo = 1 + len(item.bcc)
+        if item.prioridade != EmailOutbox.PRIORIDADE_TRANSACIONAL and limitador.disponiveis_hoje() - custo < reserva:
+            devolver.append(item.id)
+        elif limitador.reservar_cota_diaria(custo):
+            dentro_da_cota.append(item)
+        else:
+            devolver.append(item.id)
+    if devolver:
+        EmailOutbox.objects.filter(id__in=devolver).update(status='pendente', bloqueado_em=None)
+    itens = dentro_da_cota
+
+    resultados = enviar_mensagens_em_paralelo(
+        [construir_mensagem(item) for item in itens],
+        limitador=limitador,
+    )
+
+    enviados = []
+    falhas = 0
+    for item, erro in zip(itens, resultados):
+        if erro is None:
+            enviados.append(item.id)
+            continue
+        falhas += 1
+        registrar_falha(item, erro)
+
+    if enviados:
+        EmailOutbox.objects.filter(id__in=enviados).update(
+            status='enviado',
+            enviado_em=timezone.now(),
+            bloqueado_em=None,
+            proxima_tentativa_em=None,
+            tentativas=F('tentativas') + 1,
+        )
+        logger.info(f"{len(enviados)} emails enviados pela fila")
+
+    return len(enviados), falhas
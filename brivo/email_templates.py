@@ -355,6 +355,24 @@ Sistema de Biblioteca
 '''
 }
 
+# Sem campos do usuário: enviado em modo broadcast (BCC em lotes)
+EMAIL_ALERTA_PUBLICO = {
+    'assunto': '[Biblioteca Brivo] {titulo}',
+    'template': '''
+Olá!
+
+A Biblioteca tem um novo alerta:
+
+Título: {titulo}
+Tipo: {tipo_alerta}
+
+{mensagem}
+{expira_texto}
+
+Biblioteca Brivo
+'''
+}
+
 # -----------------------------------------------------------------------------
 # 🎓 8. EMAILS EDUCACIONAIS
 # -----------------------------------------------------------------------------
@@ -407,6 +425,27 @@ Equipe da Biblioteca
 '''
 }
 
+# -----------------------------------------------------------------------------
+# 🗞️ 10. RESUMO DIÁRIO
+# -----------------------------------------------------------------------------
+
+# Junta as notificações não urgentes de quem ativou `resumo_emails`
+EMAIL_RESUMO_DIARIO = {
+    'assunto': '🗞️ Seu resumo da biblioteca ({total} notificações)',
+    'template': '''
+Olá {nome},
+
+Estas são as suas notificações desde o último resumo:
+
+{itens}
+
+📱 Mais detalhes no sistema!
+
+Equipe da Biblioteca
+''',
+    'separador': '\n' + '─' * 40 + '\n',
+}
+
 # =============================================================================
 # 📧 CONFIGURAÇÕES GERAIS DE EMAIL
 # =============================================================================
@@ -425,6 +464,10 @@ RODAPE_PADRAO = """
 📱 Acesse o sistema para mais informações.
 """
 
+# Campos que mudam de um destinatário para outro. Templates que usam algum
+# deles são renderizados por usuário; os demais podem ir em broadcast (BCC).
+CAMPOS_POR_USUARIO = {'nome', 'email', 'ra', 'turma'}
+
 # Configurações de horário de funcionamento
 HORARIO_FUNCIONAMENTO = "Segunda a Sexta: 8h às 17h"
 
@@ -0,0 +1,130 @@
+"""
+Eventos do ciclo de vida de usuários, reservas e empréstimos.
+
+Models, serializers e views não enviam e-mails diretamente: eles registram um
+evento com `registrar_evento`, e o efeito colateral (e-mail + histórico de
+NOTIFICACAO) só roda depois do commit da transação, via
+`transaction.on_commit`. Assim:
+
+- o mesmo evento registrado duas vezes na mesma transação dispara uma vez só;
+- se a transação for desfeita, nenhum e-mail é enviado.
+
+A revisão dos alertas de estoque de um livro (ESTOQUE_ALTERADO) usa o mesmo
+mecanismo: roda uma vez por transação, com o estoque final.
+"""
+import logging
+import weakref
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+USUARIO_CADASTRADO = 'usuario_cadastrado'
+RESERVA_CRIADA = 'reserva_criada'
+RESERVA_SUA_VEZ = 'reserva_sua_vez'
+EMPRESTIMO_CRIADO = 'emprestimo_criado'
+EMPRESTIMO_DEVOLVIDO = 'emprestimo_devolvido'
+ESTOQUE_ALTERADO = 'estoque_alterado'
+
+
+def _usuario_cadastrado(usuario):
+    from .utils import enviar_email_boas_vindas
+    enviar_email_boas_vindas(usuario)
+
+
+def _reserva_criada(reserva):
+    from .utils import enviar_email_confirmacao_reserva, enviar_email_entrada_fila
+    if reserva.status == 'aguardando_retirada':
+        enviar_email_confirmacao_reserva(reserva)
+    elif reserva.status == 'na_fila':
+        enviar_email_entrada_fila(reserva)
+
+
+def _reserva_sua_vez(reserva):
+    from .utils import enviar_email_sua_vez_fila
+    enviar_email_sua_vez_fila(reserva)
+
+
+def _emprestimo_criado(emprestimo):
+    from .utils import enviar_email_emprestimo_confirmado
+    enviar_email_emprestimo_confirmado(emprestimo)
+
+
+def _emprestimo_devolvido(emprestimo):
+    from .utils import enviar_email_devolucao_confirmada
+    enviar_email_devolucao_confirmada(emprestimo)
+
+
+def _estoque_alterado(livro):
+    livro._check_and_create_low_stock_alert()
+
+
+TRATADORES = {
+    USUARIO_CADASTRADO: _usuario_cadastrado,
+    RESERVA_CRIADA: _reserva_criada,
+    RESERVA_SUA_VEZ: _reserva_sua_vez,
+    EMPRESTIMO_CRIADO: _emprestimo_criado,
+    EMPRESTIMO_DEVOLVIDO: _emprestimo_devolvido,
+    ESTOQUE_ALTERADO: _estoque_alterado,
+}
+
+
+# Disparos ainda pendentes em cada conexão: chave (evento, model, pk) -> weakref do _Disparo.
+# A entrada sai quando o disparo roda (commit) ou quando o Django descarta o callback
+# em um rollback (da transação ou do savepoint) e a última referência ao disparo some.
+_pendentes = weakref.WeakKeyDictionary()
+
+
+class _Disparo:
+    """
+    Callback de on_commit para um evento. Guarda a chave (evento, model, pk)
+    para que o mesmo evento não seja agendado duas vezes na transação.
+    """
+
+    def __init__(self, evento, objeto):
+        self.evento = evento
+        self.model = type(objeto)
+        self.pk = objeto.pk
+        self.chave = (evento, self.model._meta.label, objeto.pk)
+        self.executado = False
+        self.pendentes = None
+
+    def __call__(self):
+        self.executado = True
+        _esquecer(self.pendentes, self.chave, self)
+        # Recarrega o objeto para o tratador ver o estado que foi gravado
+        objeto = self.model._default_manager.filter(pk=self.pk).first()
+        if objeto is None:
+            logger.info(f"Evento {self.evento} ignorado: {self.model.__name__} {self.pk} não existe mais")
+            return
+        try:
+            TRATADORES[self.evento](objeto)
+        except Exception as e:
+            logger.warning(f"Falha ao tratar o evento {self.evento} de {self.model.__name__} {self.pk}: {str(e)}")
+
+
+def registrar_evento(evento, objeto):
+    """
+    Agenda o tratador de `evento` para depois do commit da transação atual
+    (ou roda na hora, fora de uma transação).
+    """
+    pendentes = _pendentes.setdefault(transaction.get_connection(), {})
+    disparo = _Disparo(evento, objeto)
+    agendado = pendentes.get(disparo.chave)
+    if agendado is not None and agendado() is not None:
+        return
+
+    chave = disparo.chave
+    referencia = weakref.ref(disparo, lambda ref: _esquecer(pendentes, chave, ref))
+    pendentes[chave] = referencia
+    disparo.pendentes = pendentes
+    transaction.on_commit(disparo)
+
+
+def _esquecer(pendentes, chave, disparo_ou_ref):
+    # Remove a chave só se ela ainda aponta para este disparo (não para um agendado depois)
+    if pendentes is None:
+        return
+    atual = pendentes.get(chave)
+    if atual is not None and (atual is disparo_ou_ref or atual() is disparo_ou_ref):
+        del pendentes[chave]
@@ -0,0 +1,176 @@
+import statistics
+import time
+from datetime import date, time as hora, timedelta
+
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from brivo import utils
+from brivo.email_outbox import LimitadorEnvio, processar_lote
+from brivo.email_templates import EMAIL_ALERTA_PUBLICO, CAMPOS_POR_USUARIO
+from brivo.models import EmailOutbox, Emprestimo, Livro, Reserva, Usuario
+from brivo.smtp_sink import SMTPSink
+
+# Latência de cada mensagem enviada pelo backend abaixo (em segundos)
+_latencias_envio = []
+
+
+class BackendCronometrado(EmailBackend):
+    """
+    Backend SMTP do Django que mede quanto tempo cada mensagem leva para ser aceita.
+    """
+
+    def _send(self, email_message):
+        inicio = time.perf_counter()
+        try:
+            return super()._send(email_message)
+        finally:
+            _latencias_envio.append(time.perf_counter() - inicio)
+
+
+def _p95(valores):
+    if len(valores) < 2:
+        return valores[0] if valores else 0.0
+    return statistics.quantiles(valores, n=20)[-1]
+
+
+class Command(BaseCommand):
+    help = ('📊 Mede a vazão do envio de e-mails contra um servidor SMTP local, em um banco de teste '
+            'criado e apagado pelo comando (nada é gravado no banco configurado nem enviado de verdade)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--usuarios', type=int, default=200, help='Usuários fictícios criados para o teste')
+        parser.add_argument('--repeticoes', type=int, default=20, help='Chamadas de cada enviar_email_* individual')
+        parser.add_argument('--latencia', type=float, default=0.0, help='Segundos que o SMTP local leva por mensagem')
+        parser.add_argument('--taxa-falha', type=float, default=0.0, help='Fração das mensagens recusadas (0 a 1)')
+        parser.add_argument('--threads', type=int, default=None, help='Sobrescreve EMAIL_ENVIO_THREADS')
+        parser.add_argument('--lote', type=int, default=100, help='E-mails por lote do worker')
+
+    def handle(self, *args, **options):
+        sink = SMTPSink(latencia=options['latencia'], taxa_falha=options['taxa_falha'])
+        configuracoes = {
+            'EMAIL_BACKEND': f'{__name__}.BackendCronometrado',
+            'EMAIL_HOST': sink.host,
+            'EMAIL_PORT': sink.porta,
+            'EMAIL_USE_SSL': False,
+            'EMAIL_USE_TLS': False,
+            'EMAIL_HOST_PASSWORD': '',  # Sem senha o backend não tenta autenticar
+            'EMAIL_JANELA_CAMPANHA': (0, 24),  # Campanhas também entram na medição
+            'EMAIL_COTA_RESERVADA_TRANSACIONAL': 0,
+            'EMAIL_CAMPANHA_POR_LOTE': options['lote'],
+            # Versões do cache de relatórios ficam na memória, longe do Redis/tabela de produção
+            'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        }
+        if options['threads']:
+            configuracoes['EMAIL_ENVIO_THREADS'] = options['threads']
+
+        self.stdout.write(f"📭 SMTP local em {sink.host}:{sink.porta} "
+                          f"(latência={options['latencia']}s, falhas={options['taxa_falha']:.0%})")
+
+        # Banco de teste separado (como o do `manage.py test`): a fila e as linhas reais
+        # não são lidas, alteradas nem travadas, e tudo some junto com o banco no final
+        nome_original = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with sink, override_settings(**configuracoes):
+                dados = self.criar_dados(options['usuarios'])
+
+                self.stdout.write("\n📝 Enfileiramento")
+                for nome, chamada, vezes in self.cenarios(dados, options['repeticoes']):
+                    self.medir_enfileiramento(nome, chamada, vezes)
+
+                self.stdout.write("\n📤 Entrega")
+                self.medir_entrega(sink, options['lote'])
+        finally:
+            connection.creation.destroy_test_db(nome_original, verbosity=0)
+
+    def criar_dados(self, total_usuarios):
+        usuarios = Usuario.objects.bulk_create([
+            Usuario(ra=f'BENCH-{i}', nome=f'Aluno Benchmark {i}', email=f'bench.{i}@example.com',
+                    turma='BENCH', tipo='aluno')
+            for i in range(total_usuarios)
+        ])
+        livro = Livro.objects.create(titulo='Livro Benchmark', autor='Autor Benchmark', data_publicacao=date.today(),
+                                     tipo='fisico', quantidade_total=total_usuarios)
+        # bulk_create não passa pelo save(), que também dispararia e-mails
+        reservas = Reserva.objects.bulk_create([
+            Reserva(livro=livro, aluno=usuario, status='na_fila',
+                    data_retirada_prevista=date.today() + timedelta(days=1), hora_retirada_prevista=hora(10))
+            for usuario in usuarios
+        ])
+        emprestimos = Emprestimo.objects.bulk_create([Emprestimo(livro=livro, usuario=usuario) for usuario in usuarios])
+        for emprestimo in emprestimos:
+            emprestimo.data_emprestimo = emprestimo.data_emprestimo - timedelta(days=20)
+        return {'usuarios': usuarios, 'livro': livro, 'reservas': reservas, 'emprestimos': emprestimos}
+
+    def cenarios(self, dados, repeticoes):
+        """
+        Lista (nome, chamada(i), vezes) com cada caminho de envio do sistema.
+        """
+        usuarios, livro = dados['usuarios'], dados['livro']
+        reservas, emprestimos = dados['reservas'], dados['emprestimos']
+        ids = [usuario.id for usuario in usuarios]
+
+        def um_por_vez(funcao, objetos, *extra):
+            return lambda i: funcao(objetos[i % len(objetos)], *extra)
+
+        return [
+            ('boas_vindas', um_por_vez(utils.enviar_email_boas_vindas, usuarios), repeticoes),
+            ('confirmacao_reserva', um_por_vez(utils.enviar_email_confirmacao_reserva, reservas), repeticoes),
+            ('lembrete_retirada', um_por_vez(utils.enviar_email_lembrete_retirada, reservas), repeticoes),
+            ('reserva_cancelada', um_por_vez(utils.enviar_email_reserva_cancelada, reservas), repeticoes),
+            ('emprestimo_confirmado', um_por_vez(utils.enviar_email_emprestimo_confirmado, emprestimos), repeticoes),
+            ('lembrete_devolucao_3_dias', um_por_vez(utils.enviar_email_lembrete_devolucao_3_dias, emprestimos), repeticoes),
+            ('livro_atraso', um_por_vez(utils.enviar_email_livro_atraso, emprestimos), repeticoes),
+            ('devolucao_confirmada', um_por_vez(utils.enviar_email_devolucao_confirmada, emprestimos), repeticoes),
+            ('entrada_fila', um_por_vez(utils.enviar_email_entrada_fila, reservas), repeticoes),
+            ('sua_vez_fila', um_por_vez(utils.enviar_email_sua_vez_fila, reservas), repeticoes),
+            ('recomendacoes', um_por_vez(utils.enviar_email_recomendacoes, usuarios, [livro]), repeticoes),
+            ('relatorio_mensal', um_por_vez(utils.enviar_email_relatorio_mensal, usuarios, {}), repeticoes),
+            ('alerta_admin', lambda i: utils.enviar_email_alerta_admin(usuarios[0].email, 'Benchmark', {}), repeticoes),
+            ('novos_livros (massa)', lambda i: utils.enviar_email_novos_livros(usuarios, [livro]), 1),
+            ('dicas_leitura (massa)', lambda i: utils.enviar_email_dicas_leitura(usuarios, 'Dica', 'Conteúdo', livro), 1),
+            ('convite_evento (massa)', lambda i: utils.enviar_email_convite_evento(
+                usuarios, 'Evento', 'Amanhã', '10h', 'Biblioteca', ['Abertura']), 1),
+            ('email_grupo (massa)', lambda i: utils.enviar_email_grupo(
+                utils.resolver_destinatarios(ids=ids), 'Aviso', 'Texto'), 1),
+            ('alerta_publico (broadcast)', lambda i: utils.enviar_template_para_usuarios(
+                utils.resolver_destinatarios(ids=ids, campos=sorted(CAMPOS_POR_USUARIO)), EMAIL_ALERTA_PUBLICO,
+                titulo='Benchmark', tipo_alerta='Info', mensagem='Texto', expira_texto=''), 1),
+        ]
+
+    def medir_enfileiramento(self, nome, chamada, vezes):
+        antes = EmailOutbox.objects.count()
+        tempos = []
+        for i in range(vezes):
+            inicio = time.perf_counter()
+            chamada(i)
+            tempos.append(time.perf_counter() - inicio)
+        mensagens = EmailOutbox.objects.count() - antes
+        total = sum(tempos)
+        self.stdout.write(
+            f"  {nome:<28} {mensagens:>6} msgs  {mensagens / total if total else 0:>9.1f} msgs/s"
+            f"  p95 {_p95(tempos) * 1000:>8.2f} ms/chamada"
+        )
+
+    def medir_entrega(self, sink, lote):
+        _latencias_envio.clear()
+        limitador = LimitadorEnvio(por_segundo=10 ** 6, por_dia=10 ** 9)
+        enviados = falhas = 0
+        inicio = time.perf_counter()
+        while True:
+            ok, erro = processar_lote(lote, limitador=limitador)
+            if not ok and not erro:
+                break
+            enviados += ok
+            falhas += erro
+        duracao = time.perf_counter() - inicio
+
+        self.stdout.write(f"  {enviados} mensagens enviadas, {falhas} falharam (reagendadas) em {duracao:.2f}s")
+        self.stdout.write(f"  SMTP local aceitou {sink.mensagens} mensagens para {sink.destinatarios} destinatários")
+        self.stdout.write(self.style.SUCCESS(
+            f"  🚀 {enviados / duracao if duracao else 0:.1f} msgs/s, "
+            f"p95 {_p95(_latencias_envio) * 1000:.2f} ms por mensagem"
+        ))
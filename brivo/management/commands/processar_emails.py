@@ -0,0 +1,49 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from brivo.email_outbox import processar_lote, liberar_bloqueios_expirados, consolidar_resumos
+
+
+class Command(BaseCommand):
+    help = '📧 Consome a fila de e-mails (EmailOutbox) e envia as mensagens em lotes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=settings.EMAIL_OUTBOX_LOTE, help='E-mails por lote')
+        parser.add_argument('--intervalo', type=float, default=settings.EMAIL_OUTBOX_INTERVALO,
+                            help='Segundos de espera quando a fila está vazia')
+        parser.add_argument('--uma-vez', action='store_true', help='Esvazia a fila uma vez e encerra')
+
+    def handle(self, *args, **options):
+        lote = options['lote']
+        intervalo = options['intervalo']
+        uma_vez = options['uma_vez']
+
+        liberados = liberar_bloqueios_expirados()
+        if liberados:
+            self.stdout.write(f"🔓 {liberados} e-mails presos devolvidos para a fila")
+
+        consolidar_resumos()
+        self.stdout.write(f"📧 Processando fila de e-mails (lote={lote})")
+        total_enviados = 0
+        total_falhas = 0
+        try:
+            while True:
+                enviados, falhas = processar_lote(lote)
+                total_enviados += enviados
+                total_falhas += falhas
+
+                if enviados or falhas:
+                    self.stdout.write(f"✅ {enviados} enviados, ❌ {falhas} falharam")
+                    continue
+
+                # Fila vazia
+                if uma_vez:
+                    break
+                time.sleep(intervalo)
+                liberar_bloqueios_expirados()
+                consolidar_resumos()
+        except KeyboardInterrupt:
+            self.stdout.write("⏹️ Worker interrompido")
+
+        self.stdout.write(f"🎯 Total: {total_enviados} enviados, {total_falhas} falharam")
@@ -0,0 +1,14 @@
+import time
+from django.core.management.base import BaseCommand
+
+from brivo.models import EstatisticaDiaria
+
+
+class Command(BaseCommand):
+    help = '📊 Recria a tabela de estatísticas diárias a partir do histórico de empréstimos e reservas'
+
+    def handle(self, *args, **options):
+        inicio = time.perf_counter()
+        linhas = EstatisticaDiaria.reconstruir()
+        duracao = time.perf_counter() - inicio
+        self.stdout.write(self.style.SUCCESS(f"✅ {linhas} linhas de estatísticas diárias gravadas em {duracao:.2f}s"))
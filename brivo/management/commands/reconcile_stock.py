@@ -0,0 +1,30 @@
+import time
+from django.core.management.base import BaseCommand
+
+from brivo.models import Livro
+
+
+class Command(BaseCommand):
+    help = '📦 Recalcula a quantidade emprestada de cada livro a partir dos empréstimos ativos e corrige divergências'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--simular', action='store_true', help='Apenas lista as divergências, sem corrigir')
+
+    def handle(self, *args, **options):
+        simular = options['simular']
+        inicio = time.perf_counter()
+        divergencias = Livro.reconciliar_estoque(aplicar=not simular)
+        duracao = time.perf_counter() - inicio
+
+        for item in divergencias:
+            diferenca = item['correto'] - item['registrado']
+            self.stdout.write(
+                f"  📕 #{item['id']} {item['titulo']}: {item['registrado']} → {item['correto']} ({diferenca:+d})"
+            )
+
+        if not divergencias:
+            self.stdout.write(self.style.SUCCESS(f"✅ Estoque consistente ({duracao:.2f}s)"))
+        elif simular:
+            self.stdout.write(self.style.WARNING(f"⚠️ {len(divergencias)} livros divergentes (simulação, nada foi gravado)"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"🔧 {len(divergencias)} livros corrigidos em {duracao:.2f}s"))
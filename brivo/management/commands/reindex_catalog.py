@@ -0,0 +1,21 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from brivo import busca
+
+
+class Command(BaseCommand):
+    help = '🔎 Reconstrói os índices de busca do catálogo: texto completo (FTS5/tsvector) e trigramas de duplicatas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=1000, help='Livros lidos do banco por vez')
+
+    def handle(self, *args, **options):
+        if not busca.backend():
+            self.stdout.write(self.style.WARNING("⚠️ Este banco não tem índice de texto completo; só os trigramas serão gravados"))
+        inicio = time.perf_counter()
+        with transaction.atomic():
+            total = busca.reindexar(options['lote'])
+        duracao = time.perf_counter() - inicio
+        self.stdout.write(self.style.SUCCESS(f"✅ {total} livros indexados em {duracao:.2f}s"))
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0021_usuario_username_alter_usuario_email_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('destinatario', models.EmailField(max_length=254)),
+                ('assunto', models.CharField(max_length=500)),
+                ('mensagem', models.TextField()),
+                ('html', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('pendente', 'Pendente'), ('enviando', 'Enviando'), ('enviado', 'Enviado'), ('falhou', 'Falhou')], default='pendente', max_length=10)),
+                ('tentativas', models.PositiveIntegerField(default=0)),
+                ('erro', models.TextField(blank=True)),
+                ('criado_em', models.DateTimeField(auto_now_add=True)),
+                ('bloqueado_em', models.DateTimeField(blank=True, help_text='Quando um worker reservou este e-mail para envio.', null=True)),
+                ('enviado_em', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'E-mail na Fila',
+                'verbose_name_plural': 'E-mails na Fila',
+                'ordering': ['criado_em'],
+                'indexes': [models.Index(fields=['status', 'criado_em'], name='brivo_email_status_f9bde3_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0022_emailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailoutbox',
+            name='bcc',
+            field=models.JSONField(blank=True, default=list, help_text='Destinatários ocultos (envio em broadcast).'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0023_emailoutbox_bcc'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailoutbox',
+            name='proxima_tentativa_em',
+            field=models.DateTimeField(blank=True, help_text='Após uma falha, só é reenviado a partir deste momento.', null=True),
+        ),
+        migrations.AlterField(
+            model_name='emailoutbox',
+            name='status',
+            field=models.CharField(choices=[('pendente', 'Pendente'), ('enviando', 'Enviando'), ('enviado', 'Enviado'), ('falhou', 'Falhou (dead letter)')], default='pendente', max_length=10),
+        ),
+    ]
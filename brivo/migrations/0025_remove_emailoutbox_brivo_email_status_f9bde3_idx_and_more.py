@@ -0,0 +1,26 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0024_emailoutbox_proxima_tentativa_em_and_more'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='emailoutbox',
+            name='brivo_email_status_f9bde3_idx',
+        ),
+        migrations.AddField(
+            model_name='emailoutbox',
+            name='prioridade',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Transacional'), (1, 'Informativo'), (2, 'Campanha')], default=0),
+        ),
+        migrations.AddIndex(
+            model_name='emailoutbox',
+            index=models.Index(fields=['status', 'prioridade', 'criado_em'], name='brivo_email_status_78aa6a_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0025_remove_emailoutbox_brivo_email_status_f9bde3_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usuario',
+            name='resumo_emails',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='emailoutbox',
+            name='status',
+            field=models.CharField(choices=[('pendente', 'Pendente'), ('enviando', 'Enviando'), ('enviado', 'Enviado'), ('falhou', 'Falhou (dead letter)'), ('resumo', 'Aguardando resumo')], default='pendente', max_length=10),
+        ),
+    ]
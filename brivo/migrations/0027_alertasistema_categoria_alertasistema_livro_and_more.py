@@ -0,0 +1,61 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+SUFIXOS = {' - Estoque Baixo': 'estoque_baixo', ' - Esgotado': 'esgotado'}
+
+
+def preencher_chave_dos_alertas(apps, schema_editor):
+    """
+    Liga os alertas de estoque existentes ao livro e à categoria, a partir do
+    título "Livro: <titulo> - Estoque Baixo/Esgotado". Se houver mais de um
+    pendente para o mesmo livro e categoria, só o mais recente continua pendente.
+    """
+    AlertaSistema = apps.get_model('brivo', 'AlertaSistema')
+    Livro = apps.get_model('brivo', 'Livro')
+    livros = dict(Livro.objects.values_list('titulo', 'id'))
+
+    vistos = set()
+    for alerta in AlertaSistema.objects.filter(titulo__startswith='Livro: ').order_by('-data_criacao'):
+        for sufixo, categoria in SUFIXOS.items():
+            if not alerta.titulo.endswith(sufixo):
+                continue
+            livro_id = livros.get(alerta.titulo[len('Livro: '):-len(sufixo)])
+            if livro_id is None:
+                break
+            alerta.livro_id = livro_id
+            alerta.categoria = categoria
+            if not alerta.resolvido:
+                if (livro_id, categoria) in vistos:
+                    alerta.resolvido = True
+                    alerta.resolvido_em = timezone.now()
+                vistos.add((livro_id, categoria))
+            alerta.save(update_fields=['livro', 'categoria', 'resolvido', 'resolvido_em'])
+            break
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0026_usuario_resumo_emails_alter_emailoutbox_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alertasistema',
+            name='categoria',
+            field=models.CharField(blank=True, choices=[('estoque_baixo', 'Estoque baixo'), ('esgotado', 'Livro esgotado')], default='', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='alertasistema',
+            name='livro',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='alertas', to='brivo.livro'),
+        ),
+        migrations.RunPython(preencher_chave_dos_alertas, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='alertasistema',
+            constraint=models.UniqueConstraint(condition=models.Q(('livro__isnull', False), ('resolvido', False)), fields=('livro', 'categoria'), name='alerta_pendente_unico_por_livro'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0027_alertasistema_categoria_alertasistema_livro_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Exemplar',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('codigo_barras', models.CharField(max_length=50, unique=True)),
+                ('status', models.CharField(choices=[('disponivel', 'Disponível'), ('emprestado', 'Emprestado'), ('indisponivel', 'Indisponível')], default='disponivel', max_length=15)),
+                ('criado_em', models.DateTimeField(auto_now_add=True)),
+                ('livro', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exemplares', to='brivo.livro')),
+            ],
+            options={
+                'verbose_name': 'Exemplar',
+                'verbose_name_plural': 'Exemplares',
+                'ordering': ['livro', 'codigo_barras'],
+            },
+        ),
+        migrations.AddField(
+            model_name='emprestimo',
+            name='exemplar',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='emprestimos', to='brivo.exemplar'),
+        ),
+    ]
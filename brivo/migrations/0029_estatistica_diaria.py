@@ -0,0 +1,66 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:51
+
+from django.db import migrations, models
+from django.db.models import Count, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+
+def preencher_estatisticas(apps, schema_editor):
+    # Mesmo cálculo de EstatisticaDiaria.reconstruir, com os models históricos
+    Emprestimo = apps.get_model('brivo', 'Emprestimo')
+    Reserva = apps.get_model('brivo', 'Reserva')
+    EstatisticaDiaria = apps.get_model('brivo', 'EstatisticaDiaria')
+
+    fuso = timezone.get_current_timezone()
+    fontes = [
+        ('emprestimos', Emprestimo.objects.all(), 'data_emprestimo', 'usuario__turma'),
+        ('devolucoes', Emprestimo.objects.filter(devolvido=True, data_devolucao__isnull=False),
+         'data_devolucao', 'usuario__turma'),
+        ('reservas', Reserva.objects.all(), 'data_reserva', 'aluno__turma'),
+    ]
+
+    totais = {}
+    for campo, queryset, data, turma in fontes:
+        grupos = queryset.values_list(
+            TruncDate(data, tzinfo=fuso),
+            Coalesce('livro__genero', Value('')),
+            Coalesce(turma, Value('')),
+        ).annotate(total=Count('id')).order_by()
+        for dia, genero, turma_usuario, total in grupos:
+            totais.setdefault((dia, genero, turma_usuario), {})[campo] = total
+
+    EstatisticaDiaria.objects.bulk_create(
+        [EstatisticaDiaria(dia=dia, genero=genero, turma=turma, **contadores)
+         for (dia, genero, turma), contadores in totais.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0028_exemplar'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EstatisticaDiaria',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dia', models.DateField()),
+                ('genero', models.CharField(blank=True, default='', max_length=100)),
+                ('turma', models.CharField(blank=True, default='', max_length=20)),
+                ('emprestimos', models.PositiveIntegerField(default=0)),
+                ('devolucoes', models.PositiveIntegerField(default=0)),
+                ('reservas', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Estatística Diária',
+                'verbose_name_plural': 'Estatísticas Diárias',
+                'ordering': ['dia'],
+                'constraints': [models.UniqueConstraint(fields=('dia', 'genero', 'turma'), name='estatistica_diaria_unica')],
+            },
+        ),
+        migrations.RunPython(preencher_estatisticas, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:54
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def preencher_contadores(apps, schema_editor):
+    """
+    Preenche os contadores de cada livro com o histórico de empréstimos e reservas,
+    em um único UPDATE com subconsultas (sem juntar as duas tabelas).
+    """
+    Livro = apps.get_model('brivo', 'Livro')
+
+    def contagem(nome_model):
+        model = apps.get_model('brivo', nome_model)
+        return Coalesce(Subquery(
+            model.objects.filter(livro=OuterRef('pk')).order_by().values('livro').annotate(total=Count('id')).values('total')
+        ), 0)
+
+    Livro.objects.update(total_emprestimos=contagem('Emprestimo'), total_reservas=contagem('Reserva'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0029_estatistica_diaria'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='livro',
+            name='total_emprestimos',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='livro',
+            name='total_reservas',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(preencher_contadores, migrations.RunPython.noop),
+    ]
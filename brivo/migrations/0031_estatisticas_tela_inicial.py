@@ -0,0 +1,39 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:56
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0030_livro_contadores_popularidade'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EstatisticaCatalogo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('livros_ativos', models.IntegerField(default=0)),
+                ('livros_disponiveis', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Estatística do Catálogo',
+                'verbose_name_plural': 'Estatísticas do Catálogo',
+            },
+        ),
+        migrations.CreateModel(
+            name='EstatisticaUsuario',
+            fields=[
+                ('usuario', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='estatisticas', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('reservas_ativas', models.IntegerField(default=0)),
+                ('livros_lidos', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Estatística do Usuário',
+                'verbose_name_plural': 'Estatísticas dos Usuários',
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+from django.db import migrations
+
+from brivo import busca
+
+
+def criar_indice(apps, schema_editor):
+    """
+    SQLite: tabela virtual FTS5 separada (o rowid é o id do livro).
+    PostgreSQL: coluna tsvector em brivo_livro com índice GIN.
+    Depois indexa os livros que já existem.
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {busca.TABELA_FTS} USING fts5("
+            f"{', '.join(busca.CAMPOS)}, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute("ALTER TABLE brivo_livro ADD COLUMN IF NOT EXISTS busca tsvector")
+        schema_editor.execute("CREATE INDEX IF NOT EXISTS brivo_livro_busca_gin ON brivo_livro USING GIN (busca)")
+    else:
+        return
+
+    Livro = apps.get_model('brivo', 'Livro')
+    for livro in Livro.objects.only('id', *busca.CAMPOS).iterator(chunk_size=1000):
+        busca.indexar_livro(livro)
+
+
+def remover_indice(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(f"DROP TABLE IF EXISTS {busca.TABELA_FTS}")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS brivo_livro_busca_gin")
+        schema_editor.execute("ALTER TABLE brivo_livro DROP COLUMN IF EXISTS busca")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0031_estatisticas_tela_inicial'),
+    ]
+
+    operations = [
+        migrations.RunPython(criar_indice, remover_indice),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from brivo.busca import trigramas
+
+
+def preencher_trigramas(apps, schema_editor):
+    Livro = apps.get_model('brivo', 'Livro')
+    LivroTrigrama = apps.get_model('brivo', 'LivroTrigrama')
+    lote = []
+    for livro in Livro.objects.only('id', 'titulo', 'autor').iterator(chunk_size=1000):
+        lote.extend(LivroTrigrama(livro_id=livro.pk, trigrama=t) for t in trigramas(f'{livro.titulo} {livro.autor}'))
+        if len(lote) >= 5000:
+            LivroTrigrama.objects.bulk_create(lote)
+            lote = []
+    LivroTrigrama.objects.bulk_create(lote)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0032_indice_busca_livros'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LivroTrigrama',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigrama', models.CharField(max_length=3)),
+                ('livro', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trigramas', to='brivo.livro')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['trigrama', 'livro'], name='brivo_livro_trigram_e23531_idx')],
+                'constraints': [models.UniqueConstraint(fields=('livro', 'trigrama'), name='trigrama_unico_por_livro')],
+            },
+        ),
+        migrations.RunPython(preencher_trigramas, migrations.RunPython.noop),
+    ]
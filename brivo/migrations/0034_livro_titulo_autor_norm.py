@@ -0,0 +1,47 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+from brivo.busca import normalizar_texto
+
+
+def preencher_normalizados(apps, schema_editor):
+    Livro = apps.get_model('brivo', 'Livro')
+    lote = []
+    for livro in Livro.objects.only('id', 'titulo', 'autor').iterator(chunk_size=1000):
+        livro.titulo_norm = normalizar_texto(livro.titulo)[:255]
+        livro.autor_norm = normalizar_texto(livro.autor)[:255]
+        lote.append(livro)
+        if len(lote) >= 1000:
+            Livro.objects.bulk_update(lote, ['titulo_norm', 'autor_norm'])
+            lote = []
+    Livro.objects.bulk_update(lote, ['titulo_norm', 'autor_norm'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0033_livro_trigramas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='livro',
+            name='autor_norm',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='livro',
+            name='titulo_norm',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(preencher_normalizados, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='livro',
+            index=models.Index(fields=['titulo_norm', 'autor_norm'], name='livro_titulo_autor_norm', opclasses=['varchar_pattern_ops', 'varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='livro',
+            index=models.Index(fields=['autor_norm', 'titulo_norm'], name='livro_autor_titulo_norm', opclasses=['varchar_pattern_ops', 'varchar_pattern_ops']),
+        ),
+    ]
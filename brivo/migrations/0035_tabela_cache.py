@@ -0,0 +1,18 @@
+from django.core.management import call_command
+from django.db import migrations
+
+
+def criar_tabela_cache(apps, schema_editor):
+    # Só cria algo quando CACHES usa DatabaseCache (produção com DATABASE_URL e sem REDIS_URL)
+    call_command('createcachetable', database=schema_editor.connection.alias, verbosity=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0034_livro_titulo_autor_norm'),
+    ]
+
+    operations = [
+        migrations.RunPython(criar_tabela_cache, migrations.RunPython.noop),
+    ]
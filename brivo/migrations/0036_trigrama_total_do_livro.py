@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:15
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+
+
+def preencher_totais(apps, schema_editor):
+    LivroTrigrama = apps.get_model('brivo', 'LivroTrigrama')
+    totais = (
+        LivroTrigrama.objects.filter(livro=OuterRef('livro'))
+        .values('livro').annotate(total=Count('id')).values('total')
+    )
+    LivroTrigrama.objects.update(total_do_livro=Subquery(totais))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brivo', '0035_tabela_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='livrotrigrama',
+            name='total_do_livro',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(preencher_totais, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,11 @@
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Count, F
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 
+from . import busca
+
 
 # Define a constante para o limite de estoque baixo
 ESTOQUE_BAIXO_LIMITE = 3 # Exemplo: 3 exemplares restantes ou menos
@@ -106,6 +109,7 @@ class Usuario(AbstractBaseUser, PermissionsMixin):
     REQUIRED_FIELDS = ['nome', 'tipo'] # Campos obrigatórios na criação de usuário
 
     ativo = models.BooleanField(default=True) # Campo para soft delete
+    resumo_emails = models.BooleanField(default=False) # Agrupa notificações não urgentes em um resumo diário
 
     objects = UsuarioManager() # Gerenciador customizado para o modelo Usuario
 
@@ -124,6 +128,27 @@ class LivroQuerySet(models.QuerySet):
     def ativos(self):
         return self.filter(ativo=True)
 
+    # Consultas por título/autor passam pelas colunas normalizadas (indexadas):
+    # 'Dom Casmurro', 'dom casmurro' e 'DOM CASMURRO' caem na mesma chave
+    def com_titulo(self, titulo):
+        return self.filter(titulo_norm=busca.normalizar_texto(titulo))
+
+    def com_autor(self, autor):
+        return self.filter(autor_norm=busca.normalizar_texto(autor))
+
+    def titulo_comeca_com(self, prefixo):
+        return self._prefixo('titulo_norm', prefixo)
+
+    def autor_comeca_com(self, prefixo):
+        return self._prefixo('autor_norm', prefixo)
+
+    def _prefixo(self, campo, prefixo):
+        prefixo = busca.normalizar_texto(prefixo)
+        if connection.vendor == 'sqlite':
+            # O LIKE do SQLite ignora maiúsculas e por isso não usa o índice; um intervalo usa
+            return self.filter(**{f'{campo}__gte': prefixo, f'{campo}__lt': prefixo + '\U0010ffff'})
+        return self.filter(**{f'{campo}__startswith': prefixo})
+
 class Livro(models.Model):
     TIPO_LIVRO_CHOICES = [
         ('fisico', 'Físico'),
@@ -143,14 +168,33 @@ class Livro(models.Model):
     quantidade_total = models.IntegerField(default=1, help_text="Número total de exemplares deste livro.")
     quantidade_emprestada = models.IntegerField(default=0, help_text="Número de exemplares atualmente emprestados.")
     # O campo 'disponivel' como BooleanField foi removido, agora é uma propriedade calculada.
+
+    # Quantos empréstimos e reservas do livro existem, para os rankings de popularidade.
+    # Só mudam por UPDATE com F(): somam na criação e subtraem nos post_delete (brivo/signals.py).
+    total_emprestimos = models.PositiveIntegerField(default=0, editable=False)
+    total_reservas = models.PositiveIntegerField(default=0, editable=False)
+    CONTADORES = ('total_emprestimos', 'total_reservas')
     
     capa = models.URLField(blank=True, null=True)
     descricao = models.TextField(null=True, blank=True)
 
     ativo = models.BooleanField(default=True, help_text="Indica se o livro está ativo no sistema.") # campo para soft delete
+
+    # Título e autor sem acentos e em minúsculas (busca.normalizar_texto), mantidos no save
+    titulo_norm = models.CharField(max_length=255, default='', editable=False)
+    autor_norm = models.CharField(max_length=255, default='', editable=False)
     
     objects = LivroQuerySet.as_manager() # Ativa a queryset customizada
 
+    class Meta:
+        indexes = [
+            # varchar_pattern_ops: no PostgreSQL, o mesmo índice serve igualdade e LIKE 'prefixo%'
+            models.Index(fields=['titulo_norm', 'autor_norm'], name='livro_titulo_autor_norm',
+                         opclasses=['varchar_pattern_ops', 'varchar_pattern_ops']),
+            models.Index(fields=['autor_norm', 'titulo_norm'], name='livro_autor_titulo_norm',
+                         opclasses=['varchar_pattern_ops', 'varchar_pattern_ops']),
+        ]
+
     def __str__(self):
         return self.titulo
 
@@ -173,85 +217,227 @@ class Livro(models.Model):
         if self.quantidade_emprestada < 0:
             self.quantidade_emprestada = 0
 
-        super().save(*args, **kwargs)
-        # Chama a função de verificação de estoque APÓS o save do livro
-        self._check_and_create_low_stock_alert() 
+        self.titulo_norm = busca.normalizar_texto(self.titulo)[:255]
+        self.autor_norm = busca.normalizar_texto(self.autor)[:255]
+        if kwargs.get('update_fields') is not None and {'titulo', 'autor'} & set(kwargs['update_fields']):
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'titulo_norm', 'autor_norm'}
+
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Uma instância carregada antes de um empréstimo não pode sobrescrever os contadores
+            # nem o estoque emprestado, que só mudam por UPDATE com F() e pela reconciliação
+            ignorados = set(self.CONTADORES) | {'quantidade_emprestada'} | self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                campo.attname for campo in self._meta.concrete_fields
+                if not campo.primary_key and campo.attname not in ignorados
+            ]
+        with transaction.atomic():
+            # Estado gravado antes desta mudança, para os contadores do catálogo
+            antes = None if self._state.adding else Livro.objects.select_for_update().filter(pk=self.pk).values_list(
+                'ativo', 'quantidade_total', 'quantidade_emprestada'
+            ).first()
+            if antes is not None and 'quantidade_emprestada' not in kwargs['update_fields']:
+                # Usa o valor do banco (linha travada), não o que a instância carregou
+                self.quantidade_emprestada = antes[2]
+                if self.quantidade_total < self.quantidade_emprestada:
+                    raise ValidationError(
+                        f'A quantidade total não pode ser menor que os {self.quantidade_emprestada} exemplares emprestados.'
+                    )
+            estoque_mudou = antes is None or antes[1:] != (self.quantidade_total, self.quantidade_emprestada)
+            super().save(*args, **kwargs)
+            EstatisticaCatalogo.registrar_mudanca(antes, (self.ativo, self.quantidade_total, self.quantidade_emprestada))
+            if antes is None or set(kwargs['update_fields']) & set(busca.CAMPOS):
+                busca.indexar_livro(self)
+            if antes is None or {'titulo', 'autor'} & set(kwargs['update_fields']):
+                busca.indexar_trigramas(self)
+
+        # Só revê os alertas de estoque se o estoque mudou (editar capa ou descrição não conta)
+        if estoque_mudou:
+            self._agendar_verificacao_estoque()
+
+    def retirar_exemplar(self):
+        """
+        Empresta um exemplar com um único UPDATE condicional no banco
+        (quantidade_emprestada + 1 somente se ainda houver exemplar livre).
+        Dois empréstimos simultâneos não conseguem levar o mesmo último exemplar.
+        Retorna False se o livro estava esgotado.
+        """
+        atualizados = Livro.objects.filter(
+            pk=self.pk, quantidade_total__gt=F('quantidade_emprestada')
+        ).update(quantidade_emprestada=F('quantidade_emprestada') + 1)
+        if atualizados:
+            self._apos_movimentar_estoque(1)
+        return bool(atualizados)
+
+    def devolver_exemplares(self, quantidade=1):
+        """
+        Devolve `quantidade` exemplares ao estoque com um único UPDATE, sem deixar
+        quantidade_emprestada ficar negativa.
+        Retorna False se não havia tantos exemplares emprestados.
+        """
+        atualizados = Livro.objects.filter(
+            pk=self.pk, quantidade_emprestada__gte=quantidade
+        ).update(quantidade_emprestada=F('quantidade_emprestada') - quantidade)
+        if atualizados:
+            self._apos_movimentar_estoque(-quantidade)
+        return bool(atualizados)
+
+    def _apos_movimentar_estoque(self, movimento):
+        # Atualiza a instância com os valores gravados e agenda a revisão dos alertas.
+        # O UPDATE travou a linha, então o estado anterior é o atual menos o movimento.
+        self.refresh_from_db(fields=['ativo', 'quantidade_total', 'quantidade_emprestada'])
+        EstatisticaCatalogo.registrar_mudanca(
+            (self.ativo, self.quantidade_total, self.quantidade_emprestada - movimento),
+            (self.ativo, self.quantidade_total, self.quantidade_emprestada),
+        )
+        self._agendar_verificacao_estoque()
+
+    def _agendar_verificacao_estoque(self):
+        """
+        Agenda _check_and_create_low_stock_alert para o commit da transação.
+        Várias mudanças no mesmo livro durante a transação geram uma única
+        verificação, já com o estoque final.
+        """
+        from .eventos import registrar_evento, ESTOQUE_ALTERADO
+        registrar_evento(ESTOQUE_ALTERADO, self)
+
+    @classmethod
+    def reconciliar_estoque(cls, aplicar=True):
+        """
+        Recalcula quantidade_emprestada de todos os livros a partir dos
+        empréstimos ativos (um único GROUP BY) e grava só os livros divergentes
+        com bulk_update. Com aplicar=False apenas informa as divergências.
+        Retorna uma lista de dicts {id, titulo, registrado, correto}.
+        """
+        ativos = dict(
+            Emprestimo.objects.filter(devolvido=False)
+            .values_list('livro').annotate(total=Count('id')).order_by()
+        )
+
+        divergentes = []
+        relatorio = []
+        livros = cls.objects.only('id', 'titulo', 'quantidade_emprestada').order_by('id')
+        for livro in livros.iterator(chunk_size=2000):
+            correto = ativos.get(livro.id, 0)
+            if livro.quantidade_emprestada != correto:
+                relatorio.append({
+                    'id': livro.id,
+                    'titulo': livro.titulo,
+                    'registrado': livro.quantidade_emprestada,
+                    'correto': correto,
+                })
+                livro.quantidade_emprestada = correto
+                divergentes.append(livro)
+
+        if aplicar and divergentes:
+            with transaction.atomic():
+                cls.objects.bulk_update(divergentes, ['quantidade_emprestada'], batch_size=500)
+                for livro in divergentes:
+                    livro._agendar_verificacao_estoque()
+                # bulk_update não dispara post_save nem passa pelos deltas do catálogo
+                EstatisticaCatalogo.recalcular()
+                from .cache import invalidar_circulacao
+                invalidar_circulacao()
+
+        return relatorio
 
     def _check_and_create_low_stock_alert(self):
         """
         Verifica se o estoque do livro está baixo/esgotado e cria/resolve alertas se necessário.
+        Os alertas são achados pela chave (livro, categoria), não pelo título, então
+        renomear o livro não deixa alertas órfãos.
         """
         # Importa AlertaSistema aqui para evitar circular import
-        from .models import AlertaSistema 
-        
-        # Alerta de Estoque Baixo
-        if self.quantidade_disponivel > 0 and self.quantidade_disponivel <= ESTOQUE_BAIXO_LIMITE:
-            # Verifica se já existe um alerta *pendente* de estoque baixo para este livro
-            existing_low_stock_alert = AlertaSistema.objects.filter(
-                titulo__icontains=f"Livro: {self.titulo} - Estoque Baixo",
-                resolvido=False,
-                tipo='warning',
-                visibilidade='admin_only' # Alertas de estoque são apenas para o admin
-            ).first()
+        from .models import AlertaSistema
 
-            if not existing_low_stock_alert:
-                AlertaSistema.objects.create(
-                    titulo=f"Livro: {self.titulo} - Estoque Baixo",
-                    mensagem=f"O livro '{self.titulo}' tem apenas {self.quantidade_disponivel} exemplares disponíveis.",
-                    tipo='warning',
-                    visibilidade='admin_only' # Alertas de estoque são apenas para o admin
-                )
-                print(f"Alerta de estoque baixo criado para o livro: {self.titulo}")
-            else:
-                # Atualiza a mensagem se o alerta já existe mas a quantidade mudou
-                if existing_low_stock_alert.mensagem != f"O livro '{self.titulo}' tem apenas {self.quantidade_disponivel} exemplares disponíveis.":
-                    existing_low_stock_alert.mensagem = f"O livro '{self.titulo}' tem apenas {self.quantidade_disponivel} exemplares disponíveis."
-                    existing_low_stock_alert.save(update_fields=['mensagem'])
-
-            # Garante que o alerta de "Esgotado" esteja resolvido se o estoque não é zero
-            AlertaSistema.objects.filter(
-                titulo__icontains=f"Livro: {self.titulo} - Esgotado",
-                resolvido=False
-            ).update(resolvido=True, resolvido_em=timezone.now())
-
-        # Alerta de Livro Esgotado
-        elif self.quantidade_disponivel == 0:
-            # Verifica se já existe um alerta *pendente* de livro esgotado para este livro
-            existing_out_of_stock_alert = AlertaSistema.objects.filter(
-                titulo__icontains=f"Livro: {self.titulo} - Esgotado",
-                resolvido=False,
-                tipo='critical',
-                visibilidade='admin_only' # Alertas de estoque são apenas para o admin
-            ).first()
+        disponivel = self.quantidade_disponivel
+        if disponivel <= 0:
+            categoria = AlertaSistema.CATEGORIA_ESGOTADO
+        elif disponivel <= ESTOQUE_BAIXO_LIMITE:
+            categoria = AlertaSistema.CATEGORIA_ESTOQUE_BAIXO
+        else:
+            categoria = None # Estoque acima do limite: nenhum alerta deve ficar pendente
 
-            if not existing_out_of_stock_alert:
-                AlertaSistema.objects.create(
-                    titulo=f"Livro: {self.titulo} - Esgotado",
-                    mensagem=f"O livro '{self.titulo}' não possui exemplares disponíveis para empréstimo.",
-                    tipo='critical',
-                    visibilidade='admin_only' # Alertas de estoque são apenas para o admin
-                )
-                print(f"Alerta de livro esgotado criado para o livro: {self.titulo}")
-            
-            # Garante que o alerta de "Estoque Baixo" esteja resolvido se o livro está esgotado
-            AlertaSistema.objects.filter(
-                titulo__icontains=f"Livro: {self.titulo} - Estoque Baixo",
-                resolvido=False
-            ).update(resolvido=True, resolvido_em=timezone.now())
-
-        # Resolve alertas de estoque baixo/esgotado se o estoque está acima do limite
-        elif self.quantidade_disponivel > ESTOQUE_BAIXO_LIMITE:
-            AlertaSistema.objects.filter(
-                titulo__icontains=f"Livro: {self.titulo} - Estoque Baixo",
-                resolvido=False
-            ).update(resolvido=True, resolvido_em=timezone.now())
-            
-            AlertaSistema.objects.filter(
-                titulo__icontains=f"Livro: {self.titulo} - Esgotado",
-                resolvido=False
-            ).update(resolvido=True, resolvido_em=timezone.now())
+        # Resolve os alertas de estoque que não valem mais (ex.: "Esgotado" quando voltou um exemplar)
+        resolvidos = AlertaSistema.objects.filter(
+            livro=self, resolvido=False, categoria__in=AlertaSistema.CATEGORIAS_ESTOQUE
+        ).exclude(categoria=categoria).update(resolvido=True, resolvido_em=timezone.now())
+        if resolvidos and categoria is None:
             print(f"Alertas de estoque baixo/esgotado resolvidos para o livro: {self.titulo}")
 
+        if categoria is None:
+            return
+
+        if categoria == AlertaSistema.CATEGORIA_ESGOTADO:
+            titulo = f"Livro: {self.titulo} - Esgotado"
+            mensagem = f"O livro '{self.titulo}' não possui exemplares disponíveis para empréstimo."
+            tipo = 'critical'
+        else:
+            titulo = f"Livro: {self.titulo} - Estoque Baixo"
+            mensagem = f"O livro '{self.titulo}' tem apenas {disponivel} exemplares disponíveis."
+            tipo = 'warning'
+
+        alerta, criado = AlertaSistema.objects.get_or_create(
+            livro=self,
+            categoria=categoria,
+            resolvido=False,
+            defaults={
+                'titulo': titulo,
+                'mensagem': mensagem,
+                'tipo': tipo,
+                'visibilidade': 'admin_only', # Alertas de estoque são apenas para o admin
+            },
+        )
+        if criado:
+            print(f"Alerta de {alerta.get_categoria_display().lower()} criado para o livro: {self.titulo}")
+        elif (alerta.titulo, alerta.mensagem) != (titulo, mensagem):
+            # Atualiza o texto se a quantidade (ou o título do livro) mudou
+            AlertaSistema.objects.filter(pk=alerta.pk).update(titulo=titulo, mensagem=mensagem)
+
+
+class LivroTrigrama(models.Model):
+    """
+    Trigramas do título + autor normalizados de um livro, para achar duplicatas
+    por similaridade (ver brivo/busca.py). Mantidos pelo Livro.save().
+    """
+    livro = models.ForeignKey(Livro, on_delete=models.CASCADE, related_name='trigramas')
+    trigrama = models.CharField(max_length=3)
+    # Quantos trigramas o livro tem ao todo, repetido em cada linha: o banco calcula
+    # a similaridade (Jaccard) de cada candidato sem precisar de uma segunda contagem
+    total_do_livro = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['livro', 'trigrama'], name='trigrama_unico_por_livro'),
+        ]
+        indexes = [
+            models.Index(fields=['trigrama', 'livro']),
+        ]
+
+
+class Exemplar(models.Model):
+    """
+    Um exemplar físico de um livro, identificado pelo código de barras da etiqueta.
+    Os contadores de Livro continuam valendo; os exemplares dizem qual cópia está fora.
+    """
+    STATUS_CHOICES = [
+        ('disponivel', 'Disponível'),
+        ('emprestado', 'Emprestado'),
+        ('indisponivel', 'Indisponível'), # Perdido, danificado ou em reparo
+    ]
+
+    livro = models.ForeignKey(Livro, on_delete=models.CASCADE, related_name='exemplares')
+    codigo_barras = models.CharField(max_length=50, unique=True) # unique já cria o índice usado na leitura
+    status = models.CharField(max_length=15, choices=STATUS_CHOICES, default='disponivel')
+    criado_em = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Exemplar"
+        verbose_name_plural = "Exemplares"
+        ordering = ['livro', 'codigo_barras']
+
+    def __str__(self):
+        return f"{self.codigo_barras} - {self.livro.titulo}"
+
 
 class Categoria(models.Model):
     nome = models.CharField(max_length=100)
@@ -290,6 +476,8 @@ class Reserva(models.Model):
     status = models.CharField(max_length=30, choices=STATUS_CHOICES, default='na_fila')
     notificado_em = models.DateTimeField(null=True, blank=True)
 
+    STATUS_ATIVOS = ('na_fila', 'aguardando_retirada', 'emprestado')
+
     def __str__(self):
         return f'Reserva de {self.livro.titulo} por {self.aluno.nome} ({self.status})'
 
@@ -304,7 +492,21 @@ class Reserva(models.Model):
             # Considerar automaticamente expirar ou exigir ação manual
             pass # A lógica de expiração pode ser um cron job, por exemplo.
 
-    # O método save() pode ser sobrescrito para adicionar lógica, mas faremos isso no ViewSet/Serializer para validação.
+    # A validação fica no ViewSet/Serializer; o save() só mantém as estatísticas diárias.
+    def save(self, *args, **kwargs):
+        nova = self.pk is None
+        with transaction.atomic():
+            status_antes = None if nova else Reserva.objects.select_for_update().filter(pk=self.pk).values_list(
+                'status', flat=True
+            ).first()
+            super().save(*args, **kwargs)
+            if nova:
+                Livro.objects.filter(pk=self.livro_id).update(total_reservas=F('total_reservas') + 1)
+                EstatisticaDiaria.registrar(self.data_reserva, self.livro.genero, self.aluno.turma, reservas=1)
+            EstatisticaUsuario.somar(
+                self.aluno_id,
+                reservas_ativas=int(self.status in self.STATUS_ATIVOS) - int(status_antes in self.STATUS_ATIVOS),
+            )
     
     @classmethod
     def limpar_antigas(cls):
@@ -329,6 +531,7 @@ class Reserva(models.Model):
 class Emprestimo(models.Model):
     livro = models.ForeignKey(Livro, on_delete=models.CASCADE, related_name='emprestimos')
     usuario = models.ForeignKey(Usuario, on_delete=models.CASCADE, related_name='emprestimos')
+    exemplar = models.ForeignKey(Exemplar, on_delete=models.SET_NULL, null=True, blank=True, related_name='emprestimos')
     data_emprestimo = models.DateTimeField(auto_now_add=True)
     data_devolucao_prevista = models.DateTimeField(null=True, blank=True)
     data_devolucao = models.DateTimeField(null=True, blank=True)
@@ -369,69 +572,63 @@ class Emprestimo(models.Model):
         return (hoje - data_limite).days
 
     def save(self, *args, **kwargs):
-        is_new_loan = self.pk is None # Verifica se é um novo empréstimo
+        # Estoque, empréstimo e reserva são gravados juntos; os e-mails saem só após o commit
+        with transaction.atomic():
+            self._salvar(*args, **kwargs)
 
-        # Se é um novo empréstimo, decrementa a quantidade disponível e incrementa a emprestada
+    def _salvar(self, *args, **kwargs):
+        from .eventos import registrar_evento, EMPRESTIMO_CRIADO, EMPRESTIMO_DEVOLVIDO
+
+        is_new_loan = self.pk is None # Verifica se é um novo empréstimo
+        # Devolução só é processada uma vez, na transição para devolvido: o UPDATE condicional
+        # trava a linha, e de duas devoluções simultâneas só a primeira muda alguma linha
+        acabou_de_devolver = False
+        if not is_new_loan and self.devolvido:
+            data_devolucao = self.data_devolucao or timezone.now()
+            acabou_de_devolver = bool(
+                Emprestimo.objects.filter(pk=self.pk, devolvido=False).update(devolvido=True, data_devolucao=data_devolucao)
+            )
+            if acabou_de_devolver:
+                self.data_devolucao = data_devolucao
+
+        # Se é um novo empréstimo, retira um exemplar do estoque (UPDATE condicional no banco)
         if is_new_loan:
-            # Antes de salvar o empréstimo, verifica se há exemplares disponíveis
-            if self.livro.quantidade_disponivel > 0:
-                self.livro.quantidade_emprestada += 1
-                self.livro.save() # Isso vai disparar o _check_and_create_low_stock_alert do Livro
-                # Definir data de devolução prevista (15 dias a partir da data do empréstimo)
-                from datetime import timedelta
-                self.data_devolucao_prevista = timezone.now() + timedelta(days=self.PRAZO_DIAS)
-            else:
+            if not self.livro.retirar_exemplar():
                 # Se não há exemplares disponíveis, impede o empréstimo
                 raise ValidationError("Não há exemplares disponíveis para este livro.")
+            Livro.objects.filter(pk=self.livro_id).update(total_emprestimos=F('total_emprestimos') + 1)
+            # Definir data de devolução prevista (15 dias a partir da data do empréstimo)
+            from datetime import timedelta
+            self.data_devolucao_prevista = timezone.now() + timedelta(days=self.PRAZO_DIAS)
 
         super().save(*args, **kwargs) # Salva o empréstimo
         
-        # ENVIAR EMAIL DE CONFIRMAÇÃO DE EMPRÉSTIMO PARA NOVOS EMPRÉSTIMOS
+        # EMAIL DE CONFIRMAÇÃO DE EMPRÉSTIMO (enviado após o commit)
         if is_new_loan:
-            try:
-                from .utils import enviar_email_emprestimo_confirmado
-                enviar_email_emprestimo_confirmado(self)
-            except Exception as e:
-                print(f"Email de empréstimo não enviado: {str(e)}")
+            EstatisticaDiaria.registrar(self.data_emprestimo, self.livro.genero, self.usuario.turma, emprestimos=1)
+            registrar_evento(EMPRESTIMO_CRIADO, self)
 
         # Lógica para gerenciar a quantidade de livros e alertas APÓS o save
-        if not is_new_loan: # Se é uma atualização de um empréstimo existente
-            # Verificar se o empréstimo foi marcado como devolvido
-            if self.devolvido:
-                # Livro foi devolvido: decrementa a quantidade emprestada
-                if self.livro.quantidade_emprestada > 0:
-                    self.livro.quantidade_emprestada -= 1
-                    self.livro.save() # Isso vai disparar o _check_and_create_low_stock_alert do Livro
-                
-                if not self.data_devolucao:
-                    self.data_devolucao = timezone.now()
-                    # Salvar novamente para garantir que a data seja persistida
-                    super().save(update_fields=['data_devolucao'])
-                
-                # ENVIAR EMAIL DE DEVOLUÇÃO CONFIRMADA
-                try:
-                    from .utils import enviar_email_devolucao_confirmada
-                    enviar_email_devolucao_confirmada(self)
-                except Exception as e:
-                    print(f"Email de devolução não enviado: {str(e)}")
-                
-                self._notificar_reserva() # Chama a notificação para o próximo da fila
-                
-                # Se o empréstimo foi concluído e era resultado de uma reserva, marque a reserva como concluída
-                try:
-                    reserva_associada = Reserva.objects.get(livro=self.livro, aluno=self.usuario, status='emprestado')
-                    reserva_associada.status = 'concluida'
-                    reserva_associada.save()
-                    print(f"Reserva {reserva_associada.id} marcada como concluída automaticamente")
-                except Reserva.DoesNotExist:
-                    print(f"Nenhuma reserva 'emprestado' encontrada para o empréstimo {self.pk}")
-                except Reserva.MultipleObjectsReturned:
-                    # Se houver múltiplas reservas, pega a mais recente
-                    reserva_associada = Reserva.objects.filter(livro=self.livro, aluno=self.usuario, status='emprestado').order_by('-data_reserva').first()
-                    if reserva_associada:
-                        reserva_associada.status = 'concluida'
-                        reserva_associada.save()
-                        print(f"Reserva {reserva_associada.id} marcada como concluída automaticamente (múltiplas encontradas)")
+        if acabou_de_devolver:
+            # Livro foi devolvido: o exemplar volta ao estoque
+            self.livro.devolver_exemplares()
+            if self.exemplar_id:
+                Exemplar.objects.filter(pk=self.exemplar_id).update(status='disponivel')
+            EstatisticaDiaria.registrar(self.data_devolucao, self.livro.genero, self.usuario.turma, devolucoes=1)
+            EstatisticaUsuario.somar(self.usuario_id, livros_lidos=1)
+
+            # EMAIL DE DEVOLUÇÃO CONFIRMADA (enviado após o commit)
+            registrar_evento(EMPRESTIMO_DEVOLVIDO, self)
+
+            self._notificar_reserva() # Chama a notificação para o próximo da fila
+
+            # Se o empréstimo foi concluído e era resultado de uma reserva, marque a reserva como concluída
+            reserva_associada = Reserva.objects.filter(
+                livro=self.livro, aluno=self.usuario, status='emprestado'
+            ).order_by('-data_reserva').first()
+            if reserva_associada:
+                reserva_associada.status = 'concluida'
+                reserva_associada.save()
 
     def marcar_devolucao(self):
         """Método para uso explícito"""
@@ -449,16 +646,11 @@ class Emprestimo(models.Model):
         ).order_by('data_reserva').first()
 
         if proxima_reserva:
-            # Marca a reserva como notificada e envia email
+            # Marca a reserva como notificada; o email de "SUA VEZ NA FILA" sai após o commit
+            from .eventos import registrar_evento, RESERVA_SUA_VEZ
             proxima_reserva.notificado_em = timezone.now()
             proxima_reserva.save()
-            
-            # ENVIAR EMAIL DE "SUA VEZ NA FILA"
-            try:
-                from .utils import enviar_email_sua_vez_fila
-                enviar_email_sua_vez_fila(proxima_reserva)
-            except Exception as e:
-                print(f"Email de sua vez na fila não enviado: {str(e)}")
+            registrar_evento(RESERVA_SUA_VEZ, proxima_reserva)
 
 
 # NOVO: Modelo para Alertas do Sistema
@@ -475,6 +667,15 @@ class AlertaSistema(models.Model):
         ('publico', 'Público (para Alunos e Professores)'),
     ]
 
+    # Alertas gerados pelo sistema; os criados manualmente ficam sem categoria
+    CATEGORIA_ESTOQUE_BAIXO = 'estoque_baixo'
+    CATEGORIA_ESGOTADO = 'esgotado'
+    CATEGORIA_CHOICES = [
+        (CATEGORIA_ESTOQUE_BAIXO, 'Estoque baixo'),
+        (CATEGORIA_ESGOTADO, 'Livro esgotado'),
+    ]
+    CATEGORIAS_ESTOQUE = [CATEGORIA_ESTOQUE_BAIXO, CATEGORIA_ESGOTADO]
+
     titulo = models.CharField(max_length=255)
     mensagem = models.TextField()
     tipo = models.CharField(max_length=10, choices=TIPO_ALERTA_CHOICES, default='info')
@@ -492,11 +693,22 @@ class AlertaSistema(models.Model):
     email_enviado = models.BooleanField(default=False, 
                                         help_text="Indica se o e-mail desta notificação pública já foi enviado.")
 
+    # Chave estruturada dos alertas automáticos: (livro, categoria)
+    livro = models.ForeignKey(Livro, on_delete=models.CASCADE, null=True, blank=True, related_name='alertas')
+    categoria = models.CharField(max_length=20, choices=CATEGORIA_CHOICES, blank=True, default='')
 
     class Meta:
         verbose_name = "Alerta do Sistema"
         verbose_name_plural = "Alertas do Sistema"
         ordering = ['-data_criacao'] # Ordena os alertas do mais novo para o mais antigo
+        constraints = [
+            # No máximo um alerta pendente de cada categoria por livro
+            models.UniqueConstraint(
+                fields=['livro', 'categoria'],
+                condition=models.Q(resolvido=False, livro__isnull=False),
+                name='alerta_pendente_unico_por_livro',
+            ),
+        ]
 
     def __str__(self):
         status_text = "Resolvido" if self.resolvido else "Pendente"
@@ -527,3 +739,227 @@ class AlertaSistema(models.Model):
         super().save(*args, **kwargs)
 
 
+# Fila persistente de e-mails (outbox). As requisições apenas enfileiram;
+# o envio SMTP é feito pelo comando `manage.py processar_emails`.
+class EmailOutbox(models.Model):
+    STATUS_CHOICES = [
+        ('pendente', 'Pendente'),
+        ('enviando', 'Enviando'),
+        ('enviado', 'Enviado'),
+        ('falhou', 'Falhou (dead letter)'), # Esgotou as tentativas; só volta à fila manualmente
+        ('resumo', 'Aguardando resumo'), # Notificação guardada para o resumo diário do usuário
+    ]
+
+    # Prioridades: quanto menor, antes sai da fila
+    PRIORIDADE_TRANSACIONAL = 0 # Empréstimos, devoluções, fila, atrasos
+    PRIORIDADE_INFORMATIVO = 1 # Alertas públicos e emails manuais
+    PRIORIDADE_CAMPANHA = 2 # Novos livros, dicas de leitura, eventos
+    PRIORIDADE_CHOICES = [
+        (PRIORIDADE_TRANSACIONAL, 'Transacional'),
+        (PRIORIDADE_INFORMATIVO, 'Informativo'),
+        (PRIORIDADE_CAMPANHA, 'Campanha'),
+    ]
+
+    destinatario = models.EmailField()
+    bcc = models.JSONField(default=list, blank=True,
+                           help_text="Destinatários ocultos (envio em broadcast).")
+    assunto = models.CharField(max_length=500)
+    mensagem = models.TextField()
+    html = models.BooleanField(default=False)
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pendente')
+    prioridade = models.PositiveSmallIntegerField(choices=PRIORIDADE_CHOICES, default=PRIORIDADE_TRANSACIONAL)
+    tentativas = models.PositiveIntegerField(default=0)
+    erro = models.TextField(blank=True)
+    proxima_tentativa_em = models.DateTimeField(null=True, blank=True,
+                                                help_text="Após uma falha, só é reenviado a partir deste momento.")
+
+    criado_em = models.DateTimeField(auto_now_add=True)
+    bloqueado_em = models.DateTimeField(null=True, blank=True,
+                                        help_text="Quando um worker reservou este e-mail para envio.")
+    enviado_em = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "E-mail na Fila"
+        verbose_name_plural = "E-mails na Fila"
+        ordering = ['criado_em']
+        indexes = [
+            models.Index(fields=['status', 'prioridade', 'criado_em']),
+        ]
+
+    def __str__(self):
+        return f"{self.assunto} -> {self.destinatario} ({self.get_status_display()})"
+
+
+
+
+class EstatisticaDiaria(models.Model):
+    """
+    Contadores de circulação por dia, gênero do livro e turma do usuário.
+    Atualizados na mesma transação de cada empréstimo, devolução e reserva, para que
+    os gráficos do dashboard somem poucas linhas em vez de varrer todo o histórico.
+    Gênero e turma vazios ('') agrupam livros e usuários sem esses dados.
+    """
+    dia = models.DateField()
+    genero = models.CharField(max_length=100, blank=True, default='')
+    turma = models.CharField(max_length=20, blank=True, default='')
+    emprestimos = models.PositiveIntegerField(default=0)
+    devolucoes = models.PositiveIntegerField(default=0)
+    reservas = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Estatística Diária"
+        verbose_name_plural = "Estatísticas Diárias"
+        ordering = ['dia']
+        constraints = [
+            models.UniqueConstraint(fields=['dia', 'genero', 'turma'], name='estatistica_diaria_unica'),
+        ]
+
+    def __str__(self):
+        return f"{self.dia} {self.genero or '-'} {self.turma or '-'}"
+
+    @classmethod
+    def registrar(cls, momento, genero=None, turma=None, **incrementos):
+        """
+        Soma os incrementos (ex.: emprestimos=1) na linha do dia de `momento`.
+        Deve ser chamado dentro da transação que gravou o evento.
+        """
+        linha, _ = cls.objects.get_or_create(dia=timezone.localdate(momento), genero=genero or '', turma=turma or '')
+        cls.objects.filter(pk=linha.pk).update(**{campo: F(campo) + n for campo, n in incrementos.items()})
+
+    @classmethod
+    def reconstruir(cls):
+        """
+        Apaga e recalcula a tabela a partir do histórico de empréstimos e reservas.
+        Retorna o número de linhas gravadas.
+        """
+        from django.db.models import Value
+        from django.db.models.functions import Coalesce, TruncDate
+
+        fuso = timezone.get_current_timezone()
+        fontes = [
+            ('emprestimos', Emprestimo.objects.all(), 'data_emprestimo', 'usuario__turma'),
+            ('devolucoes', Emprestimo.objects.filter(devolvido=True, data_devolucao__isnull=False),
+             'data_devolucao', 'usuario__turma'),
+            ('reservas', Reserva.objects.all(), 'data_reserva', 'aluno__turma'),
+        ]
+
+        totais = {}
+        for campo, queryset, data, turma in fontes:
+            grupos = queryset.values_list(
+                TruncDate(data, tzinfo=fuso),
+                Coalesce('livro__genero', Value('')),
+                Coalesce(turma, Value('')),
+            ).annotate(total=Count('id')).order_by()
+            for dia, genero, turma_usuario, total in grupos:
+                totais.setdefault((dia, genero, turma_usuario), {})[campo] = total
+
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(
+                [cls(dia=dia, genero=genero, turma=turma, **contadores)
+                 for (dia, genero, turma), contadores in totais.items()],
+                batch_size=1000,
+            )
+        return len(totais)
+
+
+class EstatisticaCatalogo(models.Model):
+    """
+    Linha única (pk=1) com os contadores do acervo mostrados na tela inicial.
+    Mantida por deltas na mesma transação de cada mudança de estoque, gravação
+    ou exclusão de livro; só a reconciliação em massa recalcula a linha.
+    """
+    livros_ativos = models.IntegerField(default=0)
+    livros_disponiveis = models.IntegerField(default=0)
+
+    PK = 1
+
+    class Meta:
+        verbose_name = "Estatística do Catálogo"
+        verbose_name_plural = "Estatísticas do Catálogo"
+
+    def __str__(self):
+        return f"{self.livros_ativos} livros ativos, {self.livros_disponiveis} disponíveis"
+
+    @classmethod
+    def obter(cls):
+        return cls.objects.filter(pk=cls.PK).first() or cls.recalcular()
+
+    @classmethod
+    def recalcular(cls):
+        contagens = Livro.objects.filter(ativo=True).aggregate(
+            livros_ativos=Count('id'),
+            livros_disponiveis=Count('id', filter=models.Q(quantidade_total__gt=F('quantidade_emprestada'))),
+        )
+        estatistica, _ = cls.objects.update_or_create(pk=cls.PK, defaults=contagens)
+        return estatistica
+
+    @staticmethod
+    def _contribuicao(estado):
+        # (ativo, quantidade_total, quantidade_emprestada) -> quanto o livro soma em cada contador
+        if estado is None:
+            return 0, 0
+        ativo, total, emprestada = estado
+        return int(ativo), int(ativo and total > emprestada)
+
+    @classmethod
+    def registrar_mudanca(cls, antes, depois):
+        """
+        Aplica a diferença entre o estado de um livro antes e depois de uma gravação
+        (None = o livro não existia).
+        """
+        ativos_antes, disponiveis_antes = cls._contribuicao(antes)
+        ativos_depois, disponiveis_depois = cls._contribuicao(depois)
+        deltas = {
+            'livros_ativos': ativos_depois - ativos_antes,
+            'livros_disponiveis': disponiveis_depois - disponiveis_antes,
+        }
+        deltas = {campo: delta for campo, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        if not cls.objects.filter(pk=cls.PK).update(**{campo: F(campo) + delta for campo, delta in deltas.items()}):
+            # Primeira mudança desde a criação da tabela: a contagem já inclui esta gravação
+            cls.recalcular()
+
+
+class EstatisticaUsuario(models.Model):
+    """
+    Contadores pessoais da tela inicial de cada usuário, atualizados pelo ciclo de
+    vida de reservas e empréstimos. A linha é criada (por contagem) no primeiro uso.
+    """
+    usuario = models.OneToOneField(Usuario, on_delete=models.CASCADE, primary_key=True, related_name='estatisticas')
+    reservas_ativas = models.IntegerField(default=0)
+    livros_lidos = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Estatística do Usuário"
+        verbose_name_plural = "Estatísticas dos Usuários"
+
+    def __str__(self):
+        return f"Estatísticas de {self.usuario_id}"
+
+    @classmethod
+    def obter(cls, usuario_id):
+        return cls.objects.filter(pk=usuario_id).first() or cls.recalcular(usuario_id)
+
+    @classmethod
+    def recalcular(cls, usuario_id):
+        estatistica, _ = cls.objects.update_or_create(usuario_id=usuario_id, defaults={
+            'reservas_ativas': Reserva.objects.filter(aluno_id=usuario_id, status__in=Reserva.STATUS_ATIVOS).count(),
+            'livros_lidos': Emprestimo.objects.filter(usuario_id=usuario_id, devolvido=True).count(),
+        })
+        return estatistica
+
+    @classmethod
+    def somar(cls, usuario_id, criar=True, **deltas):
+        """
+        Aplica os deltas na linha do usuário. Sem linha, conta tudo de novo (a contagem
+        já inclui esta mudança), a não ser com criar=False, usado durante exclusões.
+        """
+        deltas = {campo: delta for campo, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        if not cls.objects.filter(pk=usuario_id).update(**{campo: F(campo) + delta for campo, delta in deltas.items()}):
+            if criar:
+                cls.recalcular(usuario_id)
@@ -1,10 +1,11 @@
 from rest_framework import serializers
-from .models import Livro, Usuario, Emprestimo, Reserva, AlertaSistema
+from .models import Livro, Exemplar, Usuario, Emprestimo, Reserva, AlertaSistema, EmailOutbox
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework.exceptions import AuthenticationFailed
 from django.utils import timezone
 from datetime import datetime, date, time
 from .constants import GENEROS_VALIDOS, SUBGENEROS_VALIDOS
+from .eventos import registrar_evento, RESERVA_CRIADA, USUARIO_CADASTRADO
 
 # Serializers para os Alertas do Sistema
 class AlertaSistemaSerializer(serializers.ModelSerializer):
@@ -13,7 +14,7 @@ class AlertaSistemaSerializer(serializers.ModelSerializer):
         # Inclui todos os campos do modelo AlertaSistema, incluindo os novos
         fields = '__all__'
         # Campos que não devem ser modificados via API (exceto 'resolvido')
-        read_only_fields = ['id', 'data_criacao', 'resolvido_em']
+        read_only_fields = ['id', 'data_criacao', 'resolvido_em', 'livro', 'categoria']
 
     def validate(self, data):
         """
@@ -48,6 +49,17 @@ class AlertaSistemaSerializer(serializers.ModelSerializer):
         return super().update(instance, validated_data)
 
 
+# Serializer da fila de e-mails (somente leitura, usado no painel de falhas)
+class EmailOutboxSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = EmailOutbox
+        fields = [
+            'id', 'destinatario', 'bcc', 'assunto', 'status', 'tentativas', 'erro',
+            'criado_em', 'proxima_tentativa_em', 'enviado_em'
+        ]
+        read_only_fields = fields
+
+
 # Serializers para as Reservas
 class ReservaSerializer(serializers.ModelSerializer):
     aluno_nome = serializers.CharField(source='aluno.nome', read_only=True)
@@ -185,18 +197,8 @@ class ReservaSerializer(serializers.ModelSerializer):
 
         reserva = super().create(validated_data)
         
-        # ENVIAR EMAILS AUTOMATICAMENTE CONFORME O STATUS DA RESERVA
-        try:
-            from .utils import enviar_email_confirmacao_reserva, enviar_email_entrada_fila
-            
-            if reserva.status == 'aguardando_retirada':
-                enviar_email_confirmacao_reserva(reserva)
-            elif reserva.status == 'na_fila':
-                enviar_email_entrada_fila(reserva)
-        except Exception as e:
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.warning(f"Email de reserva nao enviado para {reserva.aluno.email}: {str(e)}")
+        # EMAIL CONFORME O STATUS DA RESERVA (enviado após o commit)
+        registrar_evento(RESERVA_CRIADA, reserva)
         
         return reserva
 
@@ -206,7 +208,7 @@ class UsuarioSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Usuario
-        fields = ['id', 'ra', 'nome', 'email', 'username', 'senha', 'turma', 'tipo', 'ativo']
+        fields = ['id', 'ra', 'nome', 'email', 'username', 'senha', 'turma', 'tipo', 'ativo', 'resumo_emails']
 
     def validate_email(self, value):
         if not value:  # Email pode ser nulo para admins
@@ -268,14 +270,8 @@ class UsuarioSerializer(serializers.ModelSerializer):
         senha = validated_data.pop('senha')
         usuario = Usuario.objects.create_user(password=senha, **validated_data)
         
-        # ENVIAR EMAIL DE BOAS-VINDAS AUTOMATICAMENTE
-        try:
-            from .utils import enviar_email_boas_vindas
-            enviar_email_boas_vindas(usuario)
-        except Exception as e:
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.warning(f"Email de boas-vindas nao enviado para {usuario.email}: {str(e)}")
+        # EMAIL DE BOAS-VINDAS (enviado após o commit)
+        registrar_evento(USUARIO_CADASTRADO, usuario)
         
         return usuario
 
@@ -313,13 +309,20 @@ class LivroSerializer(serializers.ModelSerializer):
         if subgenero and subgenero not in SUBGENEROS_VALIDOS:
             erros['subgenero'] = f'Subgênero inválido. Subgêneros válidos: {", ".join(SUBGENEROS_VALIDOS)}'
         
+        # O total não pode ficar abaixo dos exemplares que estão emprestados agora
+        quantidade_total = data.get('quantidade_total')
+        if self.instance is not None and quantidade_total is not None:
+            emprestados = Livro.objects.filter(pk=self.instance.pk).values_list('quantidade_emprestada', flat=True).first()
+            if emprestados and quantidade_total < emprestados:
+                erros['quantidade_total'] = f'Há {emprestados} exemplares emprestados; a quantidade total não pode ser menor.'
+
         if erros:
             raise serializers.ValidationError(erros)
         return data
     capa = serializers.URLField(required=False, allow_null=True, allow_blank=True)
     disponivel = serializers.BooleanField(read_only=True)
     quantidade_total = serializers.IntegerField(required=False)
-    quantidade_emprestada = serializers.IntegerField(required=False)
+    quantidade_emprestada = serializers.IntegerField(read_only=True)  # Só muda por empréstimo/devolução
     quantidade_disponivel = serializers.ReadOnlyField()
 
     titulo = serializers.CharField(
@@ -346,6 +349,28 @@ class LivroSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'disponivel', 'ativo']
 
 
+# Serializers para os Exemplares físicos
+class ExemplarSerializer(serializers.ModelSerializer):
+    livro_titulo = serializers.CharField(source='livro.titulo', read_only=True)
+
+    class Meta:
+        model = Exemplar
+        fields = ['id', 'livro', 'livro_titulo', 'codigo_barras', 'status', 'criado_em']
+        read_only_fields = ['id', 'status', 'criado_em']  # O status só muda no checkout e na devolução
+
+    def validate_codigo_barras(self, value):
+        return value.strip()
+
+    def validate(self, data):
+        livro = data.get('livro')
+        # Um livro não pode ter mais etiquetas do que exemplares cadastrados
+        if livro and self.instance is None and livro.exemplares.count() >= livro.quantidade_total:
+            raise serializers.ValidationError(
+                {"livro": f"O livro já tem {livro.quantidade_total} exemplares etiquetados (quantidade total)."}
+            )
+        return data
+
+
 # Serializers para Empréstimos
 class EmprestimoSerializer(serializers.ModelSerializer):
     usuario = serializers.PrimaryKeyRelatedField(read_only=True)
@@ -364,11 +389,12 @@ class EmprestimoSerializer(serializers.ModelSerializer):
     class Meta:
         model = Emprestimo
         fields = [
-            'id', 'livro', 'usuario', 'usuario_nome',
+            'id', 'livro', 'exemplar', 'usuario', 'usuario_nome',
             'livro_titulo', 'livro_capa', 'livro_autor', # Incluído capa e autor
             'data_emprestimo', 'data_devolucao_prevista', 'data_devolucao', 'devolvido',
             'dias_restantes', 'esta_atrasado', 'dias_atraso'  # Novos campos de prazo
         ]
+        read_only_fields = ['exemplar']  # Definido pela leitura do código de barras
 
     def validate(self, data):
         # Só valida disponibilidade se o campo 'livro' estiver sendo enviado (POST ou PUT/PATCH com 'livro')
@@ -0,0 +1,70 @@
+"""
+Signals que invalidam o cache de dashboard e relatórios (brivo/cache.py),
+mantêm o autocompletar do catálogo (brivo/autocompletar.py) e corrigem os
+contadores da tela inicial e dos rankings quando registros são apagados (inclusive em
+cascata e por QuerySet.delete(), que não passam pelo model).
+Conectados em BrivoConfig.ready().
+"""
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import autocompletar
+from .busca import remover_livro
+from .cache import invalidar_circulacao
+from .models import Emprestimo, EstatisticaCatalogo, EstatisticaUsuario, Livro, Reserva, Usuario
+
+
+@receiver(post_save, sender=Emprestimo)
+@receiver(post_save, sender=Reserva)
+@receiver(post_save, sender=Livro)
+@receiver(post_delete, sender=Emprestimo)
+@receiver(post_delete, sender=Reserva)
+@receiver(post_delete, sender=Livro)
+@receiver(post_delete, sender=Usuario)
+def circulacao_alterada(sender, **kwargs):
+    invalidar_circulacao()
+
+
+@receiver(post_save, sender=Usuario)
+def usuario_alterado(sender, update_fields=None, **kwargs):
+    # O login só atualiza last_login, que não aparece em nenhum relatório
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    invalidar_circulacao()
+
+
+@receiver(post_save, sender=Livro)
+def livro_salvo(sender, instance, **kwargs):
+    autocompletar.livro_alterado(instance)
+
+
+@receiver(pre_delete, sender=Livro)
+def livro_sera_apagado(sender, instance, **kwargs):
+    # Estado gravado (linha travada até o fim da exclusão), não o que a instância carregou
+    instance._estado_catalogo = Livro.objects.select_for_update().filter(pk=instance.pk).values_list(
+        'ativo', 'quantidade_total', 'quantidade_emprestada'
+    ).first()
+
+
+@receiver(post_delete, sender=Livro)
+def livro_apagado(sender, instance, **kwargs):
+    EstatisticaCatalogo.registrar_mudanca(getattr(instance, '_estado_catalogo', None), None)
+    remover_livro(instance.pk)
+    autocompletar.livro_alterado(instance, removido=True)
+
+
+@receiver(post_delete, sender=Reserva)
+def reserva_apagada(sender, instance, **kwargs):
+    Livro.objects.filter(pk=instance.livro_id, total_reservas__gt=0).update(total_reservas=F('total_reservas') - 1)
+    if instance.status in Reserva.STATUS_ATIVOS:
+        EstatisticaUsuario.somar(instance.aluno_id, criar=False, reservas_ativas=-1)
+
+
+@receiver(post_delete, sender=Emprestimo)
+def emprestimo_apagado(sender, instance, **kwargs):
+    Livro.objects.filter(pk=instance.livro_id, total_emprestimos__gt=0).update(
+        total_emprestimos=F('total_emprestimos') - 1
+    )
+    if instance.devolvido:
+        EstatisticaUsuario.somar(instance.usuario_id, criar=False, livros_lidos=-1)
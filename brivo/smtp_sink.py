@@ -0,0 +1,134 @@
+"""
+Servidor SMTP local para testes de carga do envio de e-mails.
+
+Aceita as mensagens e apenas as conta, sem entregar nada a ninguém. Permite
+simular um provedor lento (`latencia`, em segundos por mensagem) e instável
+(`taxa_falha`, fração das mensagens recusadas com 451). Usado pelo comando
+`python manage.py benchmark_emails`, mas pode rodar sozinho:
+
+    python -m brivo.smtp_sink --porta 2525 --latencia 0.05 --taxa-falha 0.1
+"""
+import argparse
+import random
+import socketserver
+import threading
+import time
+
+
+class _SessaoSMTP(socketserver.StreamRequestHandler):
+    """
+    Uma conexão SMTP. Implementa só o necessário para o backend do Django:
+    EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP e QUIT.
+    """
+
+    def responder(self, linha):
+        self.wfile.write(f"{linha}\r\n".encode())
+
+    def handle(self):
+        sink = self.server.sink
+        destinatarios = 0
+        self.responder("220 brivo-smtp-sink pronto")
+
+        for bruta in self.rfile:
+            comando = bruta.decode('utf-8', 'replace').strip()
+            verbo = comando[:4].upper()
+
+            if verbo in ('EHLO', 'HELO'):
+                self.responder("250-brivo-smtp-sink")
+                self.responder("250 8BITMIME")
+            elif verbo == 'MAIL':
+                destinatarios = 0
+                self.responder("250 OK")
+            elif verbo == 'RCPT':
+                destinatarios += 1
+                self.responder("250 OK")
+            elif verbo == 'DATA':
+                self.responder("354 Termine com <CRLF>.<CRLF>")
+                for linha in self.rfile:
+                    if linha in (b'.\r\n', b'.\n'):
+                        break
+                if sink.latencia:
+                    time.sleep(sink.latencia)
+                if random.random() < sink.taxa_falha:
+                    sink.registrar(falha=True)
+                    self.responder("451 Falha simulada, tente mais tarde")
+                else:
+                    sink.registrar(destinatarios=destinatarios)
+                    self.responder("250 OK: mensagem aceita")
+                destinatarios = 0
+            elif verbo in ('RSET', 'NOOP'):
+                destinatarios = 0
+                self.responder("250 OK")
+            elif verbo == 'QUIT':
+                self.responder("221 Até logo")
+                break
+            else:
+                self.responder("502 Comando não implementado")
+
+
+class _Servidor(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink:
+    """
+    Servidor SMTP de mentira, rodando em uma thread em segundo plano.
+
+        with SMTPSink(latencia=0.01) as sink:
+            ...  # EMAIL_HOST='127.0.0.1', EMAIL_PORT=sink.porta
+        print(sink.mensagens)
+    """
+
+    def __init__(self, host='127.0.0.1', porta=0, latencia=0.0, taxa_falha=0.0):
+        self.latencia = latencia
+        self.taxa_falha = taxa_falha
+        self.mensagens = 0
+        self.destinatarios = 0
+        self.falhas = 0
+        self._trava = threading.Lock()
+        self._servidor = _Servidor((host, porta), _SessaoSMTP)
+        self._servidor.sink = self
+        self.host, self.porta = self._servidor.server_address[:2]
+        self._thread = None
+
+    def registrar(self, destinatarios=0, falha=False):
+        with self._trava:
+            if falha:
+                self.falhas += 1
+            else:
+                self.mensagens += 1
+                self.destinatarios += destinatarios
+
+    def iniciar(self):
+        self._thread = threading.Thread(target=self._servidor.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def parar(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    def __enter__(self):
+        return self.iniciar()
+
+    def __exit__(self, *exc):
+        self.parar()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Servidor SMTP local que só conta as mensagens recebidas')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--porta', type=int, default=2525)
+    parser.add_argument('--latencia', type=float, default=0.0, help='Segundos de espera por mensagem')
+    parser.add_argument('--taxa-falha', type=float, default=0.0, help='Fração das mensagens recusadas (0 a 1)')
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.host, args.porta, args.latencia, args.taxa_falha)
+    print(f"📭 SMTP sink ouvindo em {sink.host}:{sink.porta} (Ctrl+C para sair)")
+    try:
+        sink._servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"📊 {sink.mensagens} mensagens aceitas, {sink.destinatarios} destinatários, {sink.falhas} falhas")
@@ -1,8 +1,22 @@
+import smtplib
+from datetime import date, datetime, timedelta
+from unittest import mock
+from django.core import mail
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APIClient
 from rest_framework_simplejwt.tokens import AccessToken
-from .models import Usuario
+from .models import (Usuario, Livro, Exemplar, Emprestimo, Reserva, EmailOutbox, AlertaSistema, HistoricoAcao,
+                     EstatisticaDiaria, EstatisticaCatalogo, EstatisticaUsuario)
+from .email_outbox import processar_lote, LimitadorEnvio, consolidar_resumos
+from . import autocompletar
+from .eventos import ESTOQUE_ALTERADO, registrar_evento
+from .smtp_sink import SMTPSink
+from .utils import enviar_email, enviar_emails, enviar_notificacao, enviar_notificacao_alerta_publico
 
 class UsuarioAPITests(APITestCase):
     """
@@ -104,3 +118,801 @@ class UsuarioAPITests(APITestCase):
         # Verifica se os campos NÃO foram alterados
         self.assertNotEqual(self.target_user.nome, update_data['nome'])
         self.assertNotEqual(self.target_user.turma, update_data['turma'])
+
+
+class DashboardCacheTests(APITestCase):
+    """
+    Testes das consultas e do cache do dashboard administrativo.
+    """
+    def setUp(self):
+        self.admin_user = Usuario.objects.create_user(ra='12345', nome='Admin User', email='admin@example.com',
+                                                      turma='A', tipo='admin', password='adminpassword')
+        Usuario.objects.create_user(ra='67890', nome='Target User', email='target@example.com', turma='B',
+                                    tipo='aluno', password='targetpassword')
+        cache.clear()
+
+    def test_dashboard_faz_uma_consulta_por_tabela(self):
+        """
+        Os contadores do dashboard saem de um aggregate por tabela; o número de consultas
+        não cresce com a quantidade de contadores nem com o filtro de período.
+        """
+        self.client.force_authenticate(self.admin_user)
+        url = reverse('dashboard-admin')
+        for periodo in ('', 'ultimos_7_dias', 'mes_atual'):
+            # livros, usuários, reservas e empréstimos + 4 consultas agrupadas dos gráficos
+            with self.assertNumQueries(8):
+                resposta = self.client.get(url, {'periodo': periodo} if periodo else {})
+            self.assertEqual(resposta.status_code, status.HTTP_200_OK)
+            self.assertEqual(resposta.data['usuarios']['total_geral_ativos'], 2)
+            self.assertEqual(resposta.data['usuarios']['alunos'], 1)
+            self.assertEqual(resposta.data['emprestimos']['ativos'], 0)
+
+    def test_dashboard_fica_em_cache_ate_a_circulacao_mudar(self):
+        """
+        A segunda leitura vem do cache sem consultas; gravar um livro invalida após o commit.
+        """
+        self.client.force_authenticate(self.admin_user)
+        url = reverse('dashboard-admin')
+        self.assertEqual(self.client.get(url).data['livros']['total'], 0)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Livro.objects.create(titulo='Livro Novo', autor='Autor', data_publicacao=date(2020, 1, 1),
+                                 tipo='fisico', quantidade_total=5)
+        self.assertEqual(self.client.get(url).data['livros']['total'], 1)
+
+    def test_dashboard_em_cache_vira_com_o_dia(self):
+        """
+        Os contadores de "hoje" não atravessam a meia-noite: o dia local faz parte da chave.
+        """
+        self.client.force_authenticate(self.admin_user)
+        url = reverse('dashboard-admin')
+        self.client.get(url)
+        amanha = timezone.localdate() + timedelta(days=1)
+        with mock.patch('brivo.cache.timezone.localdate', return_value=amanha), self.assertNumQueries(8):
+            self.client.get(url)
+
+    def test_versao_incrementa_sem_perder_valores_no_cache_em_banco(self):
+        """
+        No DatabaseCache o incr não é atômico; o incremento roda sob a trava feita com add.
+        """
+        from django.core.management import call_command
+        from .cache import CHAVE_VERSAO, _incrementar, versao_circulacao
+        banco = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache_testes'}}
+        with self.settings(CACHES=banco):
+            call_command('createcachetable', verbosity=0)
+            inicial = versao_circulacao()
+            self.assertEqual([_incrementar(CHAVE_VERSAO) for _ in range(3)], [inicial + 1, inicial + 2, inicial + 3])
+            self.assertEqual(versao_circulacao(), inicial + 3)
+            self.assertIsNone(cache.get(f'{CHAVE_VERSAO}:trava'))
+
+
+class EmailOutboxTests(TestCase):
+    """
+    Testes da fila persistente de e-mails.
+    """
+    def test_enviar_email_apenas_enfileira(self):
+        """
+        enviar_email não deve abrir conexão SMTP, apenas gravar na fila.
+        """
+        self.assertTrue(enviar_email('aluno@example.com', 'Assunto', 'Mensagem'))
+
+        self.assertEqual(len(mail.outbox), 0)
+        item = EmailOutbox.objects.get()
+        self.assertEqual(item.status, 'pendente')
+        self.assertEqual(item.destinatario, 'aluno@example.com')
+
+    def test_processar_lote_envia_e_marca_como_enviado(self):
+        """
+        O worker envia os e-mails pendentes e marca cada um como enviado.
+        """
+        enviar_email('a@example.com', 'Assunto A', 'Mensagem A')
+        enviar_email('b@example.com', 'Assunto B', 'Mensagem B')
+
+        enviados, falhas = processar_lote()
+
+        self.assertEqual((enviados, falhas), (2, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertFalse(EmailOutbox.objects.exclude(status='enviado').exists())
+
+    def test_envio_em_massa_usa_uma_conexao(self):
+        """
+        Um lote é entregue por uma única conexão SMTP, com resultado por destinatário.
+        """
+        resultados = enviar_emails([(f'aluno{i}@example.com', 'Aviso', 'Texto') for i in range(5)] + [('', 'Aviso', 'Texto')])
+        self.assertEqual(len(resultados), 5)
+        self.assertTrue(all(resultados.values()))
+
+        with self.settings(EMAIL_ENVIO_THREADS=1), \
+                mock.patch('brivo.email_outbox.get_connection', wraps=mail.get_connection) as get_connection:
+            enviados, falhas = processar_lote()
+
+        self.assertEqual((enviados, falhas), (5, 0))
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_alerta_publico_vai_em_broadcast_com_bcc(self):
+        """
+        Conteúdo sem campos do usuário é enviado como poucas mensagens com BCC.
+        """
+        for i in range(5):
+            Usuario.objects.create_user(ra=f'RA{i}', nome=f'Aluno {i}', email=f'aluno{i}@example.com', turma='A', tipo='aluno')
+        alerta = AlertaSistema.objects.create(titulo='Biblioteca fechada', mensagem='Feriado', visibilidade='publico')
+
+        with self.settings(EMAIL_BCC_TAMANHO_LOTE=2):
+            enviar_notificacao_alerta_publico(alerta.id)
+            processar_lote()
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(sorted(sum((m.bcc for m in mail.outbox), [])), [f'aluno{i}@example.com' for i in range(5)])
+
+    def test_cota_diaria_deixa_excedente_na_fila(self):
+        """
+        E-mails além da cota diária continuam pendentes para o próximo dia.
+        """
+        enviar_emails([(f'aluno{i}@example.com', 'Aviso', 'Texto') for i in range(5)])
+        limitador = LimitadorEnvio(por_segundo=100, por_dia=3)
+
+        enviados, falhas = processar_lote(limitador=limitador)
+
+        self.assertEqual((enviados, falhas), (3, 0))
+        self.assertEqual(EmailOutbox.objects.filter(status='pendente').count(), 2)
+        self.assertEqual(processar_lote(limitador=limitador), (0, 0))
+
+    def test_campanhas_saem_depois_dos_transacionais_e_fora_do_pico(self):
+        """
+        Campanhas ficam na fila fora da janela e, dentro dela, não usam a cota
+        reservada aos e-mails transacionais.
+        """
+        enviar_emails([(f'campanha{i}@example.com', 'Novidades', 'Texto') for i in range(3)],
+                      prioridade=EmailOutbox.PRIORIDADE_CAMPANHA)
+        enviar_email('aluno@example.com', 'Empréstimo', 'Texto')
+        limitador = LimitadorEnvio(por_segundo=100, por_dia=4)
+
+        with self.settings(EMAIL_COTA_RESERVADA_TRANSACIONAL=2), \
+                mock.patch('brivo.email_outbox.em_janela_de_campanha', return_value=False):
+            self.assertEqual(processar_lote(limitador=limitador), (1, 0))
+        self.assertEqual(mail.outbox[0].to, ['aluno@example.com'])
+
+        with self.settings(EMAIL_COTA_RESERVADA_TRANSACIONAL=2), \
+                mock.patch('brivo.email_outbox.em_janela_de_campanha', return_value=True):
+            self.assertEqual(processar_lote(limitador=limitador), (1, 0))
+        self.assertEqual(EmailOutbox.objects.filter(status='pendente').count(), 2)
+
+    def test_envios_em_grupo_nao_usam_a_cota_reservada(self):
+        """
+        Alertas públicos e envios em grupo (informativos) também param na cota
+        reservada, que fica para os avisos transacionais.
+        """
+        enviar_emails([(f'aluno{i}@example.com', 'Aviso geral', 'Texto') for i in range(4)],
+                      prioridade=EmailOutbox.PRIORIDADE_INFORMATIVO)
+        limitador = LimitadorEnvio(por_segundo=100, por_dia=4)
+
+        with self.settings(EMAIL_COTA_RESERVADA_TRANSACIONAL=2):
+            self.assertEqual(processar_lote(limitador=limitador), (2, 0))
+            enviar_email('aluno@example.com', 'Empréstimo', 'Texto')
+            self.assertEqual(processar_lote(limitador=limitador), (1, 0))
+        self.assertEqual(mail.outbox[-1].to, ['aluno@example.com'])
+
+    def test_resumo_diario_junta_notificacoes_do_usuario(self):
+        """
+        Quem ativou o resumo recebe um único e-mail, sem notificações repetidas,
+        e o histórico ganha um só registro.
+        """
+        aluno = Usuario.objects.create_user(ra='RA1', nome='Aluno', email='aluno@example.com', turma='A',
+                                            tipo='aluno')
+        aluno.resumo_emails = True
+        aluno.save()
+
+        enviar_notificacao(aluno, aluno, 'Reserva confirmada', 'Texto da reserva', 'Reserva')
+        enviar_notificacao(aluno, aluno, 'Empréstimo confirmado', 'Texto do empréstimo', 'Empréstimo')
+        enviar_notificacao(aluno, aluno, 'Empréstimo confirmado', 'Texto do empréstimo', 'Empréstimo')
+        self.assertEqual(processar_lote(), (0, 0))
+
+        self.assertEqual(consolidar_resumos(janela=0), 1)
+        self.assertEqual(processar_lote(), (1, 0))
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('2 notificações', mail.outbox[0].subject)
+        self.assertEqual(mail.outbox[0].body.count('Texto do empréstimo'), 1)
+        self.assertEqual(HistoricoAcao.objects.filter(acao='NOTIFICACAO').count(), 1)
+
+    def test_email_em_grupo_nao_duplica_destinatario(self):
+        """
+        Um usuário que cai no filtro por tipo e no filtro por id recebe o e-mail uma vez só,
+        e cada envio fica no histórico em nome do admin que o disparou.
+        """
+        alunos = [
+            Usuario.objects.create_user(ra=f'RA{i}', nome=f'Aluno {i}', email=f'aluno{i}@example.com', turma='A',
+                                        tipo='aluno')
+            for i in range(3)
+        ]
+        admin = Usuario.objects.create_user(nome='Admin', email='admin@example.com', tipo='admin', password='senha')
+        cliente = APIClient()
+        cliente.force_authenticate(admin)
+
+        resposta = cliente.post(reverse('enviar-email-grupo'), {
+            'tipo_usuarios': ['aluno'],
+            'usuarios_ids': [alunos[0].id, admin.id],
+            'assunto': 'Aviso',
+            'mensagem': 'Texto',
+        }, format='json')
+
+        self.assertEqual(resposta.data['emails_enviados'], 4)
+        self.assertEqual(EmailOutbox.objects.count(), 4)
+        historico = HistoricoAcao.objects.filter(acao='NOTIFICACAO', usuario=admin, objeto_tipo='Usuario')
+        self.assertEqual(sorted(historico.values_list('objeto_id', flat=True)),
+                         sorted([aluno.id for aluno in alunos] + [admin.id]))
+
+    def test_smtp_sink_conta_mensagens_e_injeta_falhas(self):
+        """
+        O SMTP local aceita e conta as mensagens do worker e recusa todas com taxa_falha=1.
+        """
+        enviar_emails([(f'aluno{i}@example.com', 'Aviso', 'Texto') for i in range(3)])
+        smtp = {'EMAIL_BACKEND': 'django.core.mail.backends.smtp.EmailBackend', 'EMAIL_USE_SSL': False,
+                'EMAIL_USE_TLS': False, 'EMAIL_HOST_PASSWORD': ''}
+
+        with SMTPSink() as sink, self.settings(EMAIL_HOST=sink.host, EMAIL_PORT=sink.porta, **smtp):
+            self.assertEqual(processar_lote(), (3, 0))
+            self.assertEqual(sink.mensagens, 3)
+
+            enviar_email('aluno@example.com', 'Aviso', 'Texto')
+            sink.taxa_falha = 1.0
+            self.assertEqual(processar_lote(), (0, 1))
+            self.assertEqual(sink.falhas, 1)
+
+    def test_falha_agenda_nova_tentativa_e_depois_vai_para_dead_letter(self):
+        """
+        Falhas são reagendadas com backoff; após o limite o e-mail vai para o
+        dead letter e pode ser devolvido à fila pelo endpoint de admin.
+        """
+        enviar_email('aluno@example.com', 'Assunto', 'Mensagem')
+        conexao = mock.Mock()
+        conexao.send_messages.side_effect = smtplib.SMTPDataError(451, 'Tente mais tarde')
+
+        with self.settings(EMAIL_MAX_TENTATIVAS=2), \
+                mock.patch('brivo.email_outbox.get_connection', return_value=conexao):
+            self.assertEqual(processar_lote(), (0, 1))
+            item = EmailOutbox.objects.get()
+            self.assertEqual(item.status, 'pendente')
+            self.assertGreater(item.proxima_tentativa_em, timezone.now())
+
+            # Ainda dentro do backoff: nada é enviado
+            self.assertEqual(processar_lote(), (0, 0))
+
+            EmailOutbox.objects.update(proxima_tentativa_em=timezone.now())
+            self.assertEqual(processar_lote(), (0, 1))
+
+        item.refresh_from_db()
+        self.assertEqual(item.status, 'falhou')
+        self.assertEqual(item.tentativas, 2)
+
+        admin = Usuario.objects.create_user(nome='Admin', email='admin@example.com', tipo='admin', password='senha')
+        cliente = APIClient()
+        cliente.force_authenticate(admin)
+        self.assertEqual(len(cliente.get('/api/alertas-sistema/emails-falhos/').data['results']), 1)
+
+        resposta = cliente.post('/api/alertas-sistema/reenviar-emails-falhos/', {}, format='json')
+
+        self.assertEqual(resposta.data['total'], 1)
+        item.refresh_from_db()
+        self.assertEqual((item.status, item.tentativas), ('pendente', 0))
+
+
+class EventosCicloDeVidaTests(TestCase):
+    """
+    Testes dos e-mails disparados após o commit pelo ciclo de empréstimo.
+    """
+    def setUp(self):
+        self.aluno = Usuario.objects.create_user(ra='RA1', nome='Aluno', email='aluno@example.com', turma='A',
+                                                 tipo='aluno', password='senha')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.livro = Livro.objects.create(titulo='Dom Casmurro', autor='Machado de Assis',
+                                              data_publicacao=date(1899, 1, 1), tipo='fisico', quantidade_total=2)
+        self.cliente = APIClient()
+        self.cliente.force_authenticate(self.aluno)
+
+    def test_emprestimo_e_devolucao_enviam_um_email_cada(self):
+        """
+        Criar e devolver um empréstimo pela API gera exatamente um e-mail cada,
+        e salvar de novo um empréstimo já devolvido não repete nada.
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            resposta = self.cliente.post(reverse('emprestimo-list'), {'livro': self.livro.id}, format='json')
+        self.assertEqual(EmailOutbox.objects.count(), 1)
+
+        url = reverse('emprestimo-detail', kwargs={'pk': resposta.data['id']})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cliente.patch(url, {'devolvido': True}, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            Emprestimo.objects.get().save()
+
+        self.assertEqual(EmailOutbox.objects.count(), 2)
+        self.livro.refresh_from_db()
+        self.assertEqual(self.livro.quantidade_emprestada, 0)
+
+    def test_ultimo_exemplar_nao_e_emprestado_duas_vezes(self):
+        """
+        A retirada é um UPDATE condicional: com o estoque já zerado no banco, uma
+        instância desatualizada do livro não consegue emprestar mais um exemplar.
+        """
+        desatualizado = Livro.objects.get(pk=self.livro.pk)
+        self.assertTrue(self.livro.retirar_exemplar())
+        self.assertTrue(self.livro.retirar_exemplar())
+
+        self.assertTrue(desatualizado.disponivel)
+        self.assertFalse(desatualizado.retirar_exemplar())
+        self.livro.refresh_from_db()
+        self.assertEqual(self.livro.quantidade_emprestada, 2)
+
+        self.assertTrue(self.livro.devolver_exemplares(2))
+        self.assertFalse(self.livro.devolver_exemplares())
+        self.assertEqual(self.livro.quantidade_emprestada, 0)
+
+    def test_salvar_instancia_antiga_nao_desfaz_emprestimos(self):
+        """
+        Um save completo de uma instância carregada antes de dois empréstimos
+        (edição do admin, serializer) não volta quantidade_emprestada para 0.
+        """
+        desatualizado = Livro.objects.get(pk=self.livro.pk)
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+
+        desatualizado.descricao = 'Romance de Machado'
+        desatualizado.save()
+        self.assertEqual(desatualizado.quantidade_emprestada, 2)
+        self.livro.refresh_from_db()
+        self.assertEqual(self.livro.quantidade_emprestada, 2)
+        self.assertEqual(self.livro.descricao, 'Romance de Machado')
+
+    def test_alertas_de_estoque_usam_livro_e_categoria(self):
+        """
+        Os alertas de estoque são ligados ao livro: renomear o livro não cria um
+        alerta novo, e só fica um pendente por categoria.
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            self.livro.retirar_exemplar()
+        self.livro.titulo = 'Dom Casmurro (edição nova)'
+        self.livro.quantidade_total = 3
+        with self.captureOnCommitCallbacks(execute=True):
+            self.livro.save()
+            self.livro.retirar_exemplar()
+            self.livro.retirar_exemplar()
+
+        pendentes = AlertaSistema.objects.filter(livro=self.livro, resolvido=False)
+        self.assertEqual(list(pendentes.values_list('categoria', flat=True)), [AlertaSistema.CATEGORIA_ESGOTADO])
+        self.assertIn('edição nova', pendentes.get().titulo)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.livro.devolver_exemplares(2)
+        self.assertEqual(list(pendentes.values_list('categoria', flat=True)), [AlertaSistema.CATEGORIA_ESTOQUE_BAIXO])
+        self.assertEqual(AlertaSistema.objects.filter(livro=self.livro).count(), 3)
+
+    def test_alertas_de_estoque_so_sao_revistos_quando_o_estoque_muda(self):
+        """
+        Salvar um livro sem mexer no estoque não agenda a revisão de alertas, e
+        várias mudanças na mesma transação geram uma revisão só.
+        """
+        def revisoes(callbacks):
+            return [c for c in callbacks if getattr(c, 'evento', None) == ESTOQUE_ALTERADO]
+
+        livro = Livro.objects.get(pk=self.livro.pk)
+        livro.descricao = 'Nova descrição'
+        with self.captureOnCommitCallbacks() as callbacks:
+            livro.save()
+        self.assertEqual(revisoes(callbacks), [])
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            livro.retirar_exemplar()
+            livro.devolver_exemplares()
+            livro.quantidade_total = 5
+            livro.save()
+        self.assertEqual(len(revisoes(callbacks)), 1)
+
+    def test_reconciliar_estoque_corrige_contador_divergente(self):
+        """
+        Empréstimos apagados sem devolver o exemplar deixam o contador errado;
+        a reconciliação recalcula a partir dos empréstimos ativos.
+        """
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+        Emprestimo.objects.filter(pk=Emprestimo.objects.first().pk).delete()
+        admin = Usuario.objects.create_user(nome='Admin', email='admin@example.com', tipo='admin', password='senha')
+        self.cliente.force_authenticate(admin)
+        url = reverse('livro-reconciliar-estoque')
+
+        resposta = self.cliente.post(url, {'simular': True}, format='json')
+        self.assertEqual(resposta.data['divergencias'], [
+            {'id': self.livro.id, 'titulo': self.livro.titulo, 'registrado': 2, 'correto': 1},
+        ])
+        self.livro.refresh_from_db()
+        self.assertEqual(self.livro.quantidade_emprestada, 2)
+
+        self.assertEqual(self.cliente.post(url, {'simular': 'false'}).data['total'], 1)
+        self.livro.refresh_from_db()
+        self.assertEqual(self.livro.quantidade_emprestada, 1)
+        self.assertEqual(Livro.reconciliar_estoque(), [])
+
+    def test_leitura_do_codigo_de_barras_empresta_e_devolve_o_exemplar(self):
+        """
+        O balcão empresta e devolve pela etiqueta: exemplar, empréstimo e estoque mudam juntos.
+        """
+        exemplar = Exemplar.objects.create(livro=self.livro, codigo_barras='789000000001')
+        professor = Usuario.objects.create_user(ra='P1', nome='Prof', email='prof@example.com', turma='A',
+                                                tipo='professor', password='senha')
+        self.cliente.force_authenticate(professor)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            resposta = self.cliente.post(reverse('exemplar-checkout'), {'codigo_barras': '789000000001', 'ra': 'RA1'}, format='json')
+        self.assertEqual(resposta.status_code, 201)
+        exemplar.refresh_from_db()
+        self.livro.refresh_from_db()
+        self.assertEqual(exemplar.status, 'emprestado')
+        self.assertEqual(self.livro.quantidade_emprestada, 1)
+        self.assertEqual(Emprestimo.objects.get().exemplar, exemplar)
+
+        # A mesma etiqueta lida de novo não gera um segundo empréstimo
+        resposta = self.cliente.post(reverse('exemplar-checkout'), {'codigo_barras': '789000000001', 'ra': 'RA1'}, format='json')
+        self.assertEqual(resposta.status_code, 400)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            resposta = self.cliente.post(reverse('exemplar-devolucao'), {'codigo_barras': '789000000001'}, format='json')
+        self.assertEqual(resposta.status_code, 200)
+        exemplar.refresh_from_db()
+        self.livro.refresh_from_db()
+        self.assertEqual(exemplar.status, 'disponivel')
+        self.assertEqual(self.livro.quantidade_emprestada, 0)
+        self.assertTrue(Emprestimo.objects.get().devolvido)
+
+    def test_devolucao_repetida_pelo_codigo_de_barras_conta_uma_vez(self):
+        """
+        Duas leituras da mesma etiqueta (ou um cliente que repete a requisição)
+        devolvem o empréstimo uma vez só: o estoque volta um exemplar e sai um e-mail.
+        A instância carregada antes da primeira devolução também não devolve de novo.
+        """
+        Exemplar.objects.create(livro=self.livro, codigo_barras='789000000001')
+        admin = Usuario.objects.create_user(nome='Admin', email='admin@example.com', tipo='admin', password='senha')
+        self.cliente.force_authenticate(admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cliente.post(reverse('exemplar-checkout'), {'codigo_barras': '789000000001', 'ra': 'RA1'}, format='json')
+        carregado_antes = Emprestimo.objects.get()
+        emails_antes = EmailOutbox.objects.count()
+
+        url = reverse('exemplar-devolucao')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.cliente.post(url, {'codigo_barras': '789000000001'}, format='json').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.cliente.post(url, {'codigo_barras': '789000000001'}, format='json').status_code, 404)
+            carregado_antes.marcar_devolucao()
+
+        self.livro.refresh_from_db()
+        self.assertEqual(self.livro.quantidade_emprestada, 0)
+        self.assertEqual(EmailOutbox.objects.count() - emails_antes, 1)
+        self.assertEqual(EstatisticaUsuario.obter(self.aluno.pk).livros_lidos, 1)
+
+    def test_balcao_respeita_usuario_inativo_e_reservas_de_outros(self):
+        """
+        O checkout pelo código de barras segue as regras do empréstimo: usuário
+        inativo não empresta, e exemplares prometidos a reservas de outros ficam
+        no acervo. O status do exemplar não é editável pela API.
+        """
+        Exemplar.objects.create(livro=self.livro, codigo_barras='789000000001')
+        admin = Usuario.objects.create_user(nome='Admin', email='admin@example.com', tipo='admin', password='senha')
+        outro = Usuario.objects.create_user(ra='RA2', nome='Outro', email='outro@example.com', turma='A',
+                                            tipo='aluno', password='senha')
+        self.cliente.force_authenticate(admin)
+        url = reverse('exemplar-checkout')
+
+        outro.ativo = False
+        outro.save()
+        self.assertEqual(self.cliente.post(url, {'codigo_barras': '789000000001', 'ra': 'RA2'}, format='json').status_code, 400)
+
+        Reserva.objects.create(livro=self.livro, aluno=outro, status='aguardando_retirada')
+        Reserva.objects.create(livro=self.livro, aluno=admin, status='na_fila')
+        resposta = self.cliente.post(url, {'codigo_barras': '789000000001', 'ra': 'RA1'}, format='json')
+        self.assertEqual(resposta.status_code, 400)
+        self.assertFalse(Emprestimo.objects.exists())
+
+        exemplar = Exemplar.objects.get()
+        self.cliente.patch(reverse('exemplar-detail', args=[exemplar.pk]), {'status': 'emprestado'}, format='json')
+        exemplar.refresh_from_db()
+        self.assertEqual(exemplar.status, 'disponivel')
+
+    def test_estatisticas_diarias_acompanham_emprestimos_e_batem_com_o_historico(self):
+        """
+        Empréstimo e devolução somam na linha do dia; a reconstrução a partir do
+        histórico chega aos mesmos números.
+        """
+        emprestimo = Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+        emprestimo.marcar_devolucao()
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+
+        def linhas():
+            return list(EstatisticaDiaria.objects.values_list('dia', 'genero', 'turma', 'emprestimos', 'devolucoes', 'reservas'))
+
+        hoje = timezone.localdate()
+        self.assertEqual(linhas(), [(hoje, '', 'A', 2, 1, 0)])
+        self.assertEqual(EstatisticaDiaria.reconstruir(), 1)
+        self.assertEqual(linhas(), [(hoje, '', 'A', 2, 1, 0)])
+
+    def test_graficos_do_dashboard_mantem_o_formato_da_api(self):
+        """
+        As séries mensais saem das estatísticas diárias com `mes` em datetime, e
+        as reservas por gênero só contam livros ativos.
+        """
+        self.livro.genero = 'Romance'
+        self.livro.save()
+        inativo = Livro.objects.create(titulo='Esquecido', autor='Anônimo', genero='Poesia',
+                                       data_publicacao=date(1900, 1, 1), tipo='fisico')
+        Reserva.objects.create(livro=self.livro, aluno=self.aluno)
+        Reserva.objects.create(livro=inativo, aluno=self.aluno)
+        inativo.ativo = False
+        inativo.save()
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+
+        cache.clear()
+        admin = Usuario.objects.create_user(nome='Admin', email='admin@example.com', tipo='admin', password='senha')
+        self.cliente.force_authenticate(admin)
+        graficos = self.cliente.get(reverse('dashboard-admin')).data['graficos']
+
+        self.assertEqual(graficos['reservas_por_genero'], [{'livro__genero': 'Romance', 'total_reservas': 1}])
+        mes = graficos['emprestimos_por_mes'][0]['mes']
+        self.assertIsInstance(mes, datetime)
+        self.assertEqual(mes, timezone.localtime().replace(day=1, hour=0, minute=0, second=0, microsecond=0))
+        self.assertEqual(graficos['reservas_por_mes'][0]['total'], 2)
+
+    def test_popularidade_nao_multiplica_emprestimos_por_reservas(self):
+        """
+        O relatório usa os contadores do livro: 2 empréstimos e 3 reservas dão
+        popularidade 5 (o JOIN duplo dava 6 + 6). Salvar uma instância antiga do
+        livro não apaga os contadores.
+        """
+        desatualizado = Livro.objects.get(pk=self.livro.pk)
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+        for _ in range(3):
+            Reserva.objects.create(livro=self.livro, aluno=self.aluno)
+        desatualizado.descricao = 'Romance'
+        desatualizado.save()
+
+        cache.clear()
+        professor = Usuario.objects.create_user(ra='P1', nome='Prof', email='prof@example.com', turma='A',
+                                                tipo='professor', password='senha')
+        self.cliente.force_authenticate(professor)
+        dados = self.cliente.get(reverse('relatorios-pedagogicos')).data
+        self.assertEqual(dados['livros_mais_populares'][0]['total_emprestimos'], 2)
+        self.assertEqual(dados['livros_mais_populares'][0]['total_reservas'], 3)
+        self.assertEqual(dados['livros_mais_populares'][0]['popularidade'], 5)
+        self.assertEqual(dados['alunos_mais_ativos'][0]['total_emprestimos'], 2)
+
+    def test_contadores_de_popularidade_descontam_registros_apagados(self):
+        """
+        Apagar reservas (limpar_antigas) ou o aluno (e seus empréstimos, em cascata)
+        tira os registros dos contadores do livro.
+        """
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+        antiga = Reserva.objects.create(livro=self.livro, aluno=self.aluno, status='concluida')
+        Reserva.objects.filter(pk=antiga.pk).update(data_reserva=timezone.now() - timedelta(days=8))
+        Reserva.objects.create(livro=self.livro, aluno=self.aluno)
+
+        self.assertEqual(Reserva.limpar_antigas(), 1)
+        self.livro.refresh_from_db()
+        self.assertEqual((self.livro.total_emprestimos, self.livro.total_reservas), (1, 1))
+
+        self.aluno.delete()
+        self.livro.refresh_from_db()
+        self.assertEqual((self.livro.total_emprestimos, self.livro.total_reservas), (0, 0))
+
+    def test_tela_inicial_le_contadores_mantidos_pelo_ciclo_de_vida(self):
+        """
+        Reservas, empréstimos e devoluções mantêm os contadores do usuário e do
+        acervo; a tela inicial só lê as duas linhas, que batem com uma contagem nova.
+        """
+        reserva = Reserva.objects.create(livro=self.livro, aluno=self.aluno)
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno).marcar_devolucao()
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)  # Último exemplar: livro esgotado
+        reserva.status = 'cancelada'
+        reserva.save()
+        Reserva.objects.create(livro=self.livro, aluno=self.aluno)
+
+        cache.clear()
+        with self.assertNumQueries(2):
+            dados = self.cliente.get(reverse('user-stats')).data
+        self.assertEqual(dados, {'total_livros': 1, 'livros_disponiveis': 0, 'minhas_reservas': 1, 'livros_lidos': 1})
+
+        Emprestimo.objects.filter(devolvido=True).delete()
+        EstatisticaUsuario.objects.filter(pk=self.aluno.pk).update(reservas_ativas=0)
+        self.assertEqual(EstatisticaUsuario.obter(self.aluno.pk).livros_lidos, 0)
+        self.assertEqual(EstatisticaUsuario.recalcular(self.aluno.pk).reservas_ativas, 1)
+        self.assertEqual(EstatisticaCatalogo.recalcular().livros_disponiveis, 0)
+
+    def test_excluir_livro_desconta_so_a_linha_apagada_do_catalogo(self):
+        """
+        Excluir livros tira só a contribuição de cada um dos contadores do acervo,
+        pelo estado gravado (mesmo com a instância desatualizada), sem recontar o catálogo.
+        """
+        desatualizado = Livro.objects.get(pk=self.livro.pk)
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+        Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)  # Último exemplar: livro esgotado
+        outros = [
+            Livro.objects.create(titulo=f'Livro {i}', autor='Autor', data_publicacao=date(2000, 1, 1), tipo='fisico')
+            for i in range(2)
+        ]
+        EstatisticaCatalogo.obter()
+
+        with mock.patch.object(EstatisticaCatalogo, 'recalcular') as recalcular:
+            desatualizado.delete()
+            Livro.objects.filter(pk=outros[0].pk).delete()
+        recalcular.assert_not_called()
+
+        estatistica = EstatisticaCatalogo.obter()
+        self.assertEqual((estatistica.livros_ativos, estatistica.livros_disponiveis), (1, 1))
+
+    def test_busca_textual_ignora_acentos_e_plural_e_ordena_por_relevancia(self):
+        """
+        ?search= usa o índice de texto completo: sem acentos, com plural/singular
+        e com o título pesando mais que a descrição. O índice acompanha edições e exclusões.
+        """
+        def livro(titulo, autor, descricao=''):
+            return Livro.objects.create(titulo=titulo, autor=autor, descricao=descricao,
+                                        data_publicacao=date(2000, 1, 1), tipo='fisico')
+
+        def buscar(termo):
+            resposta = self.cliente.get(reverse('livro-list'), {'search': termo})
+            return [item['titulo'] for item in resposta.data['results']]
+
+        livro('Memórias Póstumas de Brás Cubas', 'Machado de Assis')
+        coracoes = livro('Corações de Pedra', 'Ana Souza')
+        livro('Estudos Literários', 'Vários', descricao='Ensaios sobre a obra de Machado de Assis')
+
+        self.assertEqual(buscar('bras cubas'), ['Memórias Póstumas de Brás Cubas'])
+        self.assertEqual(buscar('coracao'), ['Corações de Pedra'])
+        self.assertEqual(buscar('MACHADO')[-1], 'Estudos Literários')
+        self.assertEqual(len(buscar('machado')), 3)
+
+        coracoes.titulo = 'Cidades de Pedra'
+        coracoes.save()
+        self.assertEqual(buscar('coracao'), [])
+        self.assertEqual(buscar('cidade'), ['Cidades de Pedra'])
+        coracoes.delete()
+        self.assertEqual(buscar('pedra'), [])
+
+    def test_verificar_duplicatas_acha_titulos_com_erro_de_digitacao(self):
+        """
+        A similaridade por trigramas acha o livro mesmo com acento trocado e letra
+        faltando, e o título exato (sem diferença de caixa) é a duplicata exata.
+        """
+        Livro.objects.create(titulo='O Cortiço', autor='Aluísio Azevedo', data_publicacao=date(1890, 1, 1), tipo='fisico')
+        admin = Usuario.objects.create_user(nome='Admin', email='admin@example.com', tipo='admin', password='senha')
+        self.cliente.force_authenticate(admin)
+        url = reverse('livro-verificar-duplicatas')
+
+        dados = self.cliente.post(url, {'titulo': 'Dom Casmuro', 'autor': 'Machado de Asis'}, format='json').data
+        self.assertEqual([item['titulo'] for item in dados['livros_similares']], ['Dom Casmurro'])
+        self.assertFalse(dados['livros_similares'][0]['eh_duplicata_exata'])
+        self.assertGreater(dados['livros_similares'][0]['similaridade'], 50)
+
+        dados = self.cliente.post(url, {'livros': [
+            {'titulo': 'o cortico', 'autor': 'aluisio azevedo'},
+            {'titulo': 'Livro Inédito', 'autor': 'Autor Novo'},
+        ]}, format='json').data
+        self.assertTrue(dados['resultados'][0]['livros_similares'][0]['eh_duplicata_exata'])
+        self.assertFalse(dados['resultados'][1]['tem_duplicatas'])
+
+        for livros in ([{'titulo': 'Dom Casmurro', 'autor': 'Machado'}, 'foo'], 'foo', [{'titulo': 1}]):
+            resposta = self.cliente.post(url, {'livros': livros}, format='json')
+            self.assertEqual(resposta.status_code, 400)
+        for limite in (-1, 0):
+            resposta = self.cliente.post(url, {'titulo': 'Dom Casmurro', 'autor': 'Machado', 'limite': limite}, format='json')
+            self.assertEqual(resposta.status_code, 400)
+
+    def test_filtros_de_titulo_e_autor_ignoram_maiusculas_e_acentos(self):
+        """
+        ?titulo= e ?autor= comparam as colunas normalizadas, mantidas no save,
+        e ?titulo_inicia= filtra por prefixo.
+        """
+        url = reverse('livro-list')
+
+        def titulos(**filtros):
+            resposta = self.cliente.get(url, filtros).data
+            return [livro['titulo'] for livro in resposta.get('results', resposta)]
+
+        self.assertEqual(titulos(titulo='DOM CASMURRO', autor='machado de assis'), ['Dom Casmurro'])
+        self.assertEqual(titulos(titulo_inicia='dom'), ['Dom Casmurro'])
+        self.assertEqual(titulos(titulo='Dom'), [])
+
+        self.livro.titulo = 'Memórias Póstumas de Brás Cubas'
+        self.livro.save(update_fields=['titulo'])
+        self.assertEqual(titulos(titulo='memorias postumas de bras cubas'), ['Memórias Póstumas de Brás Cubas'])
+
+    def test_autocompletar_responde_da_memoria_e_acompanha_gravacoes(self):
+        """
+        O índice de prefixos é montado uma vez; depois, criar ou desativar livros
+        só ajusta as chaves daquele livro e as sugestões saem sem consultar o banco.
+        """
+        cache.clear()
+        autocompletar.indice.invalidar()
+        url = reverse('livro-autocomplete')
+
+        def sugerir(q):
+            return [item['titulo'] for item in self.cliente.get(url, {'q': q}).data]
+
+        self.assertEqual(sugerir('dom'), ['Dom Casmurro'])
+        with self.captureOnCommitCallbacks(execute=True):
+            quixote = Livro.objects.create(titulo='Dom Quixote', autor='Miguel de Cervantes',
+                                           data_publicacao=date(1605, 1, 1), tipo='fisico')
+        # Nem o banco nem o cache: a versão do catálogo só é relida após INTERVALO_VERIFICACAO
+        with self.assertNumQueries(0), \
+                mock.patch('brivo.autocompletar.versao_catalogo', side_effect=AssertionError('leu o cache')):
+            self.assertEqual(sugerir('Dom'), ['Dom Casmurro', 'Dom Quixote'])
+            self.assertEqual(sugerir('quix'), ['Dom Quixote'])
+            self.assertEqual(sugerir('cervant'), ['Dom Quixote'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            quixote.ativo = False
+            quixote.save()
+        self.assertEqual(sugerir('dom'), ['Dom Casmurro'])
+
+    def test_facetas_contam_em_uma_consulta_e_seguem_o_estoque(self):
+        """
+        As facetas respeitam os filtros da listagem, saem de uma consulta e ficam em
+        cache até o estoque mudar.
+        """
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.livro.genero = 'Romance'
+            self.livro.save()
+            Livro.objects.create(titulo='Iracema', autor='José de Alencar', genero='Romance', subgenero='Indianista',
+                                 data_publicacao=date(1865, 1, 1), tipo='fisico', quantidade_total=1)
+            Livro.objects.create(titulo='Libertação', autor='Chico Xavier', genero='Espírita',
+                                 data_publicacao=date(1949, 1, 1), tipo='ebook')
+        url = reverse('livro-facetas')
+
+        with self.assertNumQueries(1):
+            dados = self.cliente.get(url).data
+        self.assertEqual(dados['total'], 3)
+        self.assertEqual(dados['genero'][0], {'valor': 'Romance', 'total': 2})
+        self.assertEqual(dados['disponibilidade'], {'disponivel': 3, 'indisponivel': 0})
+        self.assertEqual(self.cliente.get(url, {'genero': 'Romance'}).data['tipo'], [{'valor': 'fisico', 'total': 2}])
+        with self.assertNumQueries(0):
+            self.cliente.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Emprestimo.objects.create(livro=Livro.objects.get(titulo='Iracema'), usuario=self.aluno)
+        self.assertEqual(self.cliente.get(url).data['disponibilidade'], {'disponivel': 2, 'indisponivel': 1})
+
+    def test_transacao_desfeita_nao_envia_email(self):
+        """
+        Um empréstimo criado em uma transação que é desfeita não dispara e-mail.
+        """
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    Emprestimo.objects.create(livro=self.livro, usuario=self.aluno)
+                    raise RuntimeError('falha depois do empréstimo')
+            except RuntimeError:
+                pass
+
+        self.assertEqual(callbacks, [])
+        self.assertFalse(EmailOutbox.objects.exists())
+
+    def test_evento_desfeito_pode_ser_registrado_de_novo(self):
+        """
+        A deduplicação só vale para disparos pendentes: um evento agendado em um
+        savepoint desfeito não impede o mesmo evento depois, e um repetido na
+        mesma transação não é agendado de novo.
+        """
+        with self.captureOnCommitCallbacks() as callbacks:
+            try:
+                with transaction.atomic():
+                    registrar_evento(ESTOQUE_ALTERADO, self.livro)
+                    raise RuntimeError('desfaz o savepoint')
+            except RuntimeError:
+                pass
+            registrar_evento(ESTOQUE_ALTERADO, self.livro)
+            registrar_evento(ESTOQUE_ALTERADO, self.livro)
+
+        self.assertEqual([c.evento for c in callbacks if getattr(c, 'evento', None) == ESTOQUE_ALTERADO],
+                         [ESTOQUE_ALTERADO])
@@ -2,7 +2,7 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 # Removidas importações redundantes de TokenObtainPairView e CustomTokenObtainPairSerializer
 from .views import (
-    UsuarioViewSet, LivroViewSet, EmprestimoViewSet, ReservaViewSet, 
+    UsuarioViewSet, LivroViewSet, ExemplarViewSet, EmprestimoViewSet, ReservaViewSet, 
     TesteEmailView, LembreteDevolucaoView, DashboardAdminView, 
     AvisoReservaExpirandoView, usuario_me_view, AlertaSistemaViewSet,
     PublicAlertaSistemaListView, UserStatsView,
@@ -19,6 +19,7 @@ from .views_generos import (
 router = DefaultRouter()
 router.register(r'usuarios', UsuarioViewSet)
 router.register(r'livros', LivroViewSet)
+router.register(r'exemplares', ExemplarViewSet)
 router.register(r'emprestimos', EmprestimoViewSet)
 router.register(r'reservas', ReservaViewSet) # Este router já lida com a criação, listagem, etc.
 router.register(r'alertas-sistema', AlertaSistemaViewSet) # NOVO: Registro do ViewSet de Alertas do Sistema
@@ -1,11 +1,15 @@
 from django.core.mail import send_mail
 from django.conf import settings
+from django.db.models import Q
 from datetime import timedelta, date
 from django.utils.timezone import now # Importado 'now' diretamente para uso
+from itertools import islice
 import logging
+from string import Formatter
 
 # Importações de modelos
-from .models import Emprestimo, Reserva, HistoricoAcao, AlertaSistema, Usuario, Livro
+from .models import Emprestimo, Reserva, HistoricoAcao, AlertaSistema, Usuario, Livro, EmailOutbox
+from .email_outbox import enfileirar_email, enfileirar_emails, enfileirar_broadcast
 
 # Importar templates de email configuráveis
 from .email_templates import (
@@ -14,7 +18,8 @@ from .email_templates import (
     EMAIL_LIVRO_ATRASO, EMAIL_DEVOLUCAO_CONFIRMADA, EMAIL_ENTRADA_FILA,
     EMAIL_SUA_VEZ_FILA, EMAIL_NOVOS_LIVROS, EMAIL_RECOMENDACOES,
     EMAIL_RELATORIO_MENSAL, EMAIL_ALERTA_ADMIN, EMAIL_DICAS_LEITURA,
-    EMAIL_CONVITE_EVENTO, NOME_ESCOLA, ASSINATURA_PADRAO, PRAZO_EMPRESTIMO_DIAS
+    EMAIL_CONVITE_EVENTO, EMAIL_ALERTA_PUBLICO, NOME_ESCOLA, ASSINATURA_PADRAO, PRAZO_EMPRESTIMO_DIAS,
+    CAMPOS_POR_USUARIO
 )
 
 # Configura o logger
@@ -36,31 +41,210 @@ def registrar_acao(usuario, objeto, acao, descricao=''):
         logger.error(f"Erro ao registrar ação para o objeto {objeto.__class__.__name__} (ID: {objeto.id}): {e}")
 
 
-def enviar_email(destinatario, assunto, mensagem, html=False):
+def registrar_acoes(usuario, acoes, acao, objeto_tipo=None):
     """
-    Envia um e-mail usando o backend configurado.
+    Registra várias ações no histórico com um único INSERT.
+    `acoes` é uma lista de tuplas (objeto, descricao). Para objetos que não são
+    instâncias do modelo (linhas de values_list, por exemplo), informe `objeto_tipo`.
     """
     try:
-        from django.core.mail import EmailMessage
-        
-        email = EmailMessage(
-            subject=assunto,
-            body=mensagem,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[destinatario],
-        )
-        
-        if html:
-            email.content_subtype = 'html'
-        
-        email.send(fail_silently=False)
-        logger.info(f"Email enviado para {destinatario}")
+        HistoricoAcao.objects.bulk_create([
+            HistoricoAcao(
+                usuario=usuario,
+                objeto_tipo=objeto_tipo or type(objeto).__name__,
+                objeto_id=objeto.id,
+                acao=acao,
+                descricao=descricao
+            )
+            for objeto, descricao in acoes
+        ], batch_size=500)
+    except Exception as e:
+        logger.error(f"Erro ao registrar {len(acoes)} ações em lote: {e}")
+
+
+def enviar_email(destinatario, assunto, mensagem, html=False, prioridade=EmailOutbox.PRIORIDADE_TRANSACIONAL):
+    """
+    Enfileira um e-mail na EmailOutbox.
+    O envio SMTP é feito pelo comando `manage.py processar_emails`, fora da requisição.
+    `prioridade` define a classe de envio (EmailOutbox.PRIORIDADE_*).
+    """
+    try:
+        enfileirar_email(destinatario, assunto, mensagem, html=html, prioridade=prioridade)
+        logger.info(f"Email para {destinatario} adicionado à fila")
         return True
     except Exception as e:
-        logger.error(f"Falha ao enviar email para {destinatario}: {str(e)}")
+        logger.error(f"Falha ao enfileirar email para {destinatario}: {str(e)}")
         return False
 
 
+def enviar_notificacao(usuario, objeto, assunto, mensagem, descricao):
+    """
+    Envia uma notificação não urgente (confirmações, entrada na fila, ...).
+    Se o usuário ativou `resumo_emails`, ela é guardada para o resumo diário e o
+    histórico é registrado uma única vez quando o resumo é montado; caso
+    contrário é enviada e registrada na hora.
+    """
+    if usuario.resumo_emails:
+        try:
+            enfileirar_email(usuario.email, assunto, mensagem, resumo=True)
+            return True
+        except Exception as e:
+            logger.error(f"Falha ao guardar notificação para o resumo de {usuario.email}: {str(e)}")
+            return False
+
+    if enviar_email(usuario.email, assunto, mensagem):
+        registrar_acao(None, objeto, 'NOTIFICACAO', descricao=descricao)
+        return True
+    return False
+
+
+def enviar_emails(mensagens, prioridade=EmailOutbox.PRIORIDADE_TRANSACIONAL):
+    """
+    Enfileira vários e-mails de uma vez (envio em massa).
+    `mensagens` é uma lista de tuplas (destinatario, assunto, mensagem).
+    O worker entrega a fila reaproveitando a conexão SMTP entre as mensagens.
+    Retorna um dicionário {destinatario: True/False} com o resultado de cada um.
+    """
+    resultados = {}
+    validas = []
+    for destinatario, assunto, mensagem in mensagens:
+        if destinatario:
+            validas.append((destinatario, assunto, mensagem))
+            resultados[destinatario] = True
+        else:
+            logger.warning(f"Email '{assunto}' ignorado: destinatário sem endereço")
+
+    try:
+        enfileirar_emails(validas, prioridade=prioridade)
+        logger.info(f"{len(validas)} emails adicionados à fila")
+    except Exception as e:
+        logger.error(f"Falha ao enfileirar {len(validas)} emails: {str(e)}")
+        resultados = dict.fromkeys(resultados, False)
+
+    return resultados
+
+
+def template_personalizado(*templates):
+    """
+    Indica se algum dos templates usa campos do destinatário (CAMPOS_POR_USUARIO),
+    ou seja, se o conteúdo muda de um usuário para outro.
+    """
+    for template in templates:
+        for _, campo, _, _ in Formatter().parse(template):
+            if campo and campo.split('.')[0].split('[')[0] in CAMPOS_POR_USUARIO:
+                return True
+    return False
+
+
+def enviar_email_broadcast(destinatarios, assunto, mensagem, prioridade=EmailOutbox.PRIORIDADE_INFORMATIVO):
+    """
+    Envia o mesmo conteúdo para vários destinatários como poucas mensagens
+    com BCC em lotes de EMAIL_BCC_TAMANHO_LOTE.
+    Retorna {destinatario: True/False}.
+    """
+    destinatarios = [email for email in destinatarios if email]
+    try:
+        enfileirar_broadcast(destinatarios, assunto, mensagem, prioridade=prioridade)
+        logger.info(f"Broadcast '{assunto}' adicionado à fila para {len(destinatarios)} destinatários")
+        return dict.fromkeys(destinatarios, True)
+    except Exception as e:
+        logger.error(f"Falha ao enfileirar broadcast '{assunto}': {str(e)}")
+        return dict.fromkeys(destinatarios, False)
+
+
+def resolver_destinatarios(tipos=None, ids=None, campos=('id', 'email', 'nome')):
+    """
+    Resolve os destinatários ativos de um envio em massa com uma única consulta:
+    usuários de algum dos `tipos` OU com id em `ids` (sem nenhum filtro, todos
+    os ativos). Cada usuário aparece uma só vez, mesmo que caia nos dois filtros.
+    Busca só as colunas de `campos` e percorre o resultado com .iterator(), em
+    blocos de EMAIL_DESTINATARIOS_POR_BLOCO, para não carregar a escola inteira
+    na memória. Retorna linhas nomeadas (linha.id, linha.email, linha.nome, ...).
+    """
+    usuarios = Usuario.objects.filter(ativo=True).exclude(email__isnull=True).exclude(email='')
+    if tipos or ids:
+        filtro = Q()
+        if tipos:
+            filtro |= Q(tipo__in=tipos)
+        if ids:
+            filtro |= Q(id__in=ids)
+        usuarios = usuarios.filter(filtro)
+
+    return (
+        usuarios.order_by('id')
+        .values_list(*campos, named=True)
+        .iterator(chunk_size=settings.EMAIL_DESTINATARIOS_POR_BLOCO)
+    )
+
+
+def _em_blocos(iteravel, tamanho=None):
+    """
+    Agrupa um iterável em listas de até `tamanho` itens, sem materializá-lo por inteiro.
+    """
+    tamanho = tamanho or settings.EMAIL_DESTINATARIOS_POR_BLOCO
+    iterador = iter(iteravel)
+    while bloco := list(islice(iterador, tamanho)):
+        yield bloco
+
+
+def enviar_email_grupo(destinatarios, assunto, mensagem, prioridade=EmailOutbox.PRIORIDADE_INFORMATIVO,
+                       remetente=None):
+    """
+    Enfileira a mesma mensagem para cada destinatário de `resolver_destinatarios`,
+    gravando na fila bloco a bloco.
+    Cada envio aceito fica no histórico como NOTIFICACAO do `remetente`, com um
+    INSERT por bloco.
+    Retorna a tupla (enviados, falharam).
+    """
+    enviados = falharam = 0
+    for bloco in _em_blocos(destinatarios):
+        resultados = enviar_emails([(linha.email, assunto, mensagem) for linha in bloco], prioridade=prioridade)
+        registrar_acoes(remetente, [
+            (linha, f'Email manual enviado para {linha.email} com assunto: {assunto}')
+            for linha in bloco
+            if resultados.get(linha.email)
+        ], 'NOTIFICACAO', objeto_tipo='Usuario')
+        sucesso = sum(resultados.values())
+        enviados += sucesso
+        falharam += len(bloco) - sucesso
+    return enviados, falharam
+
+
+def enviar_template_para_usuarios(usuarios, template, prioridade=EmailOutbox.PRIORIDADE_INFORMATIVO, **contexto):
+    """
+    Envia um template de email_templates.py para vários usuários.
+    `usuarios` pode ser qualquer iterável com os atributos usados pelo template
+    (por exemplo, o resultado de `resolver_destinatarios`) e é consumido em blocos.
+    Se o template usa campos do usuário (nome, email, ...), cada um recebe sua
+    própria mensagem; caso contrário o conteúdo é enviado em broadcast (BCC).
+    Retorna a tupla (enviados, falharam).
+    """
+    personalizado = template_personalizado(template['assunto'], template['template'])
+    if not personalizado:
+        assunto = template['assunto'].format(**contexto)
+        mensagem = template['template'].format(**contexto)
+
+    enviados = falharam = 0
+    for bloco in _em_blocos(usuarios):
+        if personalizado:
+            mensagens = []
+            for usuario in bloco:
+                dados = dict(contexto, **{campo: getattr(usuario, campo, '') for campo in CAMPOS_POR_USUARIO})
+                mensagens.append((
+                    usuario.email,
+                    template['assunto'].format(**dados),
+                    template['template'].format(**dados),
+                ))
+            resultados = enviar_emails(mensagens, prioridade=prioridade)
+        else:
+            resultados = enviar_email_broadcast([usuario.email for usuario in bloco], assunto, mensagem,
+                                                prioridade=prioridade)
+        sucesso = sum(resultados.values())
+        enviados += sucesso
+        falharam += len(bloco) - sucesso
+    return enviados, falharam
+
+
 def enviar_lembretes_de_devolucao():
     """
     Envia lembretes de devolução para empréstimos que vencem amanhã.
@@ -153,36 +337,23 @@ def enviar_notificacao_alerta_publico(alerta_id):
         logger.info(f"Alerta {alerta_id} não é público, email não será enviado.")
         return
 
-    usuarios_para_notificar = Usuario.objects.filter(ativo=True)
-
-    if not usuarios_para_notificar.exists():
+    # Só as colunas que o template pode usar, lidas em blocos
+    usuarios_para_notificar = resolver_destinatarios(campos=sorted(CAMPOS_POR_USUARIO))
+
+    # 📧 TEMPLATE EDITÁVEL EM: email_templates.py -> EMAIL_ALERTA_PUBLICO
+    # Sem campos do usuário, então vai em broadcast (BCC em lotes)
+    emails_enviados, _ = enviar_template_para_usuarios(
+        usuarios_para_notificar,
+        EMAIL_ALERTA_PUBLICO,
+        titulo=alerta.titulo,
+        tipo_alerta=alerta.get_tipo_display(),
+        mensagem=alerta.mensagem,
+        expira_texto=f"\nExpira em: {alerta.expira_em.strftime('%d/%m/%Y às %H:%M')}" if alerta.expira_em else '',
+    )
+    if not emails_enviados:
         logger.warning("Nenhum usuário ativo encontrado para enviar notificação.")
         return
 
-    assunto = f"[Biblioteca Brivo] {alerta.titulo}"
-    
-    emails_enviados = 0
-    for usuario in usuarios_para_notificar:
-        if usuario.email:
-            expira_texto = f"\nExpira em: {alerta.expira_em.strftime('%d/%m/%Y às %H:%M')}" if alerta.expira_em else ''
-            
-            mensagem = f"""
-Olá!
-
-A Biblioteca tem um novo alerta:
-
-Título: {alerta.titulo}
-Tipo: {alerta.get_tipo_display()}
-
-{alerta.mensagem}
-{expira_texto}
-
-Biblioteca Brivo
-"""
-            
-            if enviar_email(usuario.email, assunto, mensagem):
-                emails_enviados += 1
-    
     alerta.email_enviado = True
     alerta.save(update_fields=['email_enviado'])
     
@@ -241,10 +412,7 @@ def enviar_email_confirmacao_reserva(reserva):
         hora_retirada=hora_retirada
     )
     
-    if enviar_email(reserva.aluno.email, assunto, mensagem):
-        registrar_acao(None, reserva, 'NOTIFICACAO', descricao=f'Email de confirmação de reserva enviado para {reserva.aluno.nome}')
-        return True
-    return False
+    return enviar_notificacao(reserva.aluno, reserva, assunto, mensagem, f'Email de confirmação de reserva enviado para {reserva.aluno.nome}')
 
 def enviar_email_lembrete_retirada(reserva):
     """
@@ -307,10 +475,7 @@ Acesse o sistema e faça uma nova reserva quando desejar.
 Equipe da Biblioteca
 """
     
-    if enviar_email(reserva.aluno.email, assunto, mensagem):
-        registrar_acao(None, reserva, 'NOTIFICACAO', descricao=f'Email de cancelamento de reserva enviado para {reserva.aluno.nome}')
-        return True
-    return False
+    return enviar_notificacao(reserva.aluno, reserva, assunto, mensagem, f'Email de cancelamento de reserva enviado para {reserva.aluno.nome}')
 
 # -----------------------------------------------------------------------------
 # 📖 3. EMPRÉSTIMOS
@@ -334,10 +499,7 @@ def enviar_email_emprestimo_confirmado(emprestimo):
         data_devolucao=data_devolucao
     )
     
-    if enviar_email(emprestimo.usuario.email, assunto, mensagem):
-        registrar_acao(None, emprestimo, 'NOTIFICACAO', descricao=f'Email de confirmação de empréstimo enviado para {emprestimo.usuario.nome}')
-        return True
-    return False
+    return enviar_notificacao(emprestimo.usuario, emprestimo, assunto, mensagem, f'Email de confirmação de empréstimo enviado para {emprestimo.usuario.nome}')
 
 def enviar_email_lembrete_devolucao_3_dias(emprestimo):
     """
@@ -392,7 +554,7 @@ Seu livro está em atraso desde ontem.
 
 📚 Livro: {emprestimo.livro.titulo}
 📅 Deveria ter sido devolvido: {data_deveria_devolver}
-💰 Multa atual: R$ {multa:.2f}
+⏰ Dias de atraso: {dias_atraso}
 
 🏃♂️ AÇÃO NECESSÁRIA:
 Devolva o livro hoje mesmo na biblioteca.
@@ -438,10 +600,7 @@ Continue lendo!
 Equipe da Biblioteca
 """
     
-    if enviar_email(emprestimo.usuario.email, assunto, mensagem):
-        registrar_acao(None, emprestimo, 'NOTIFICACAO', descricao=f'Email de devolução confirmada enviado para {emprestimo.usuario.nome}')
-        return True
-    return False
+    return enviar_notificacao(emprestimo.usuario, emprestimo, assunto, mensagem, f'Email de devolução confirmada enviado para {emprestimo.usuario.nome}')
 
 # -----------------------------------------------------------------------------
 # 📋 4. FILA DE ESPERA
@@ -473,10 +632,7 @@ def enviar_email_entrada_fila(reserva):
         previsao_dias=previsao_dias
     )
     
-    if enviar_email(reserva.aluno.email, assunto, mensagem):
-        registrar_acao(None, reserva, 'NOTIFICACAO', descricao=f'Email de entrada na fila enviado para {reserva.aluno.nome}')
-        return True
-    return False
+    return enviar_notificacao(reserva.aluno, reserva, assunto, mensagem, f'Email de entrada na fila enviado para {reserva.aluno.nome}')
 
 def enviar_email_sua_vez_fila(reserva):
     """
@@ -500,6 +656,25 @@ def enviar_email_sua_vez_fila(reserva):
 # 🔔 5. NOTIFICAÇÕES GERAIS
 # -----------------------------------------------------------------------------
 
+def _enviar_para_usuarios(mensagens, assunto, descricao):
+    """
+    Envio em massa usado pelos emails de campanha (prioridade mais baixa,
+    entregues na janela fora de pico).
+    `mensagens` é uma lista de tuplas (usuario, mensagem) e `descricao` é o texto
+    do histórico, com {nome} para o nome do usuário.
+    Retorna {email: True/False} para cada destinatário.
+    """
+    resultados = enviar_emails(
+        [(usuario.email, assunto, mensagem) for usuario, mensagem in mensagens],
+        prioridade=EmailOutbox.PRIORIDADE_CAMPANHA,
+    )
+    registrar_acoes(None, [
+        (usuario, descricao.format(nome=usuario.nome))
+        for usuario, _ in mensagens
+        if resultados.get(usuario.email)
+    ], 'NOTIFICACAO')
+    return resultados
+
 def enviar_email_novos_livros(usuarios_lista, livros_novos):
     """
     📚 Novos Livros Adicionados
@@ -510,6 +685,7 @@ def enviar_email_novos_livros(usuarios_lista, livros_novos):
     # TEMPLATE DE NOVOS LIVROS - Editável aqui
     lista_livros = "\n".join([f"• {livro.titulo} - {livro.autor}" for livro in livros_novos[:3]])
     
+    mensagens = []
     for usuario in usuarios_lista:
         mensagem = f"""
 Olá {usuario.nome},
@@ -526,9 +702,9 @@ Chegaram livros novos na nossa biblioteca! 🎉
 Boa leitura!
 Equipe da Biblioteca
 """
-        
-        if enviar_email(usuario.email, assunto, mensagem):
-            registrar_acao(None, usuario, 'NOTIFICACAO', descricao=f'Email de novos livros enviado para {usuario.nome}')
+        mensagens.append((usuario, mensagem))
+
+    return _enviar_para_usuarios(mensagens, assunto, 'Email de novos livros enviado para {nome}')
 
 def enviar_email_recomendacoes(usuario, livros_recomendados):
     """
@@ -556,7 +732,7 @@ Você gostou de livros similares no passado!
 Equipe da Biblioteca
 """
     
-    if enviar_email(usuario.email, assunto, mensagem):
+    if enviar_email(usuario.email, assunto, mensagem, prioridade=EmailOutbox.PRIORIDADE_CAMPANHA):
         registrar_acao(None, usuario, 'NOTIFICACAO', descricao=f'Email de recomendações enviado para {usuario.nome}')
         return True
     return False
@@ -654,6 +830,7 @@ def enviar_email_dicas_leitura(usuarios_lista, dica_titulo, dica_conteudo, livro
     # TEMPLATE DE DICAS DE LEITURA - Editável aqui
     livro_texto = f"\n\n📚 Livro da semana: \"{livro_sugerido.titulo}\"\nPerfeito para praticar essa técnica!" if livro_sugerido else ""
     
+    mensagens = []
     for usuario in usuarios_lista:
         mensagem = f"""
 Olá {usuario.nome},
@@ -669,9 +846,9 @@ Dica desta semana para turbinar sua leitura! 📚
 Boa leitura!
 Equipe da Biblioteca
 """
-        
-        if enviar_email(usuario.email, assunto, mensagem):
-            registrar_acao(None, usuario, 'NOTIFICACAO', descricao=f'Email de dicas de leitura enviado para {usuario.nome}')
+        mensagens.append((usuario, mensagem))
+
+    return _enviar_para_usuarios(mensagens, assunto, 'Email de dicas de leitura enviado para {nome}')
 
 # -----------------------------------------------------------------------------
 # 🎉 9. EVENTOS E PROMOÇÕES
@@ -687,6 +864,7 @@ def enviar_email_convite_evento(usuarios_lista, nome_evento, data_evento, horari
     # TEMPLATE DE CONVITE EVENTO - Editável aqui
     programacao_texto = "\n".join([f"• {atividade}" for atividade in programacao])
     
+    mensagens = []
     for usuario in usuarios_lista:
         mensagem = f"""
 Olá {usuario.nome},
@@ -709,9 +887,9 @@ Você está convidado para nosso evento especial! 🎉
 Te esperamos!
 Equipe da Biblioteca
 """
-        
-        if enviar_email(usuario.email, assunto, mensagem):
-            registrar_acao(None, usuario, 'NOTIFICACAO', descricao=f'Email de convite para evento enviado para {usuario.nome}')
+        mensagens.append((usuario, mensagem))
+
+    return _enviar_para_usuarios(mensagens, assunto, 'Email de convite para evento enviado para {nome}')
 
 # -----------------------------------------------------------------------------
 # 📧 FUNÇÃO PARA ENVIO MANUAL DE EMAIL
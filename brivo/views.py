@@ -4,11 +4,15 @@ from rest_framework.response import Response
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.views import APIView
 from rest_framework import filters
+from django_filters import rest_framework as django_filters
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models.functions import TruncMonth
-from django.db.models import Count, Sum, F, Q
+from django.db.models.functions import Coalesce, TruncMonth
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import BooleanField, Case, Count, Sum, F, Q, OuterRef, Subquery, Value, When
 from django.utils import timezone # Importação essencial para lidar com fusos horários
-from datetime import timedelta, date
+from datetime import datetime, timedelta, date
 from django.db.models import Count
 from datetime import timedelta
 from rest_framework.response import Response
@@ -21,9 +25,16 @@ from .permissions import EhAdmin
 from django.utils import timezone
 
 # Importações de modelos e serializers
-from .models import Livro, Usuario, Emprestimo, Reserva, AlertaSistema
-from .serializers import LivroSerializer, UsuarioSerializer, EmprestimoSerializer, ReservaSerializer, AlertaSistemaSerializer
+from .models import (
+    Livro, Exemplar, Usuario, Emprestimo, Reserva, AlertaSistema, EmailOutbox,
+    EstatisticaDiaria, EstatisticaCatalogo, EstatisticaUsuario,
+)
+from .serializers import LivroSerializer, ExemplarSerializer, UsuarioSerializer, EmprestimoSerializer, ReservaSerializer, AlertaSistemaSerializer, EmailOutboxSerializer
 from .permissions import EhDonoOuAdmin, EhAdmin, EhProfessorOuAdmin
+from .email_outbox import reenviar_falhas
+from . import autocompletar
+from .busca import BuscaTextoCompletoFilter, livros_similares
+from .cache import resposta_em_cache, versao_catalogo, versao_circulacao
 from .utils import (
     enviar_email,
     enviar_lembretes_de_devolucao,
@@ -100,19 +111,10 @@ class UsuarioViewSet(viewsets.ModelViewSet):
         logger.info(f"Method: {request.method}")
         
         try:
-            response = super().create(request, *args, **kwargs)
+            # O email de boas-vindas é agendado pelo serializer e sai após o commit
+            with transaction.atomic():
+                response = super().create(request, *args, **kwargs)
             logger.info(f"Usuario criado com sucesso: {response.data}")
-            
-            # ENVIAR EMAIL DE BOAS-VINDAS AUTOMATICAMENTE
-            try:
-                from .utils import enviar_email_boas_vindas
-                from .models import Usuario
-                usuario_criado = Usuario.objects.get(id=response.data['id'])
-                enviar_email_boas_vindas(usuario_criado)
-                logger.info(f"Email de boas-vindas enviado para {usuario_criado.email}")
-            except Exception as e:
-                logger.warning(f"Email de boas-vindas nao enviado: {str(e)}")
-            
             return response
         except Exception as e:
             logger.error(f"Erro ao criar usuario: {str(e)}")
@@ -131,18 +133,15 @@ class UsuarioViewSet(viewsets.ModelViewSet):
         # Remove todas as reservas do usuário
         Reserva.objects.filter(aluno=usuario).delete()
         
-        # Remove todos os empréstimos do usuário
+        # Remove todos os empréstimos do usuário, devolvendo ao estoque os que estavam ativos
         emprestimos = Emprestimo.objects.filter(usuario=usuario)
-        for emprestimo in emprestimos:
-            if not emprestimo.devolvido:
-                # Se há empréstimo ativo, decrementa a quantidade emprestada do livro
-                emprestimo.livro.quantidade_emprestada -= 1
-                emprestimo.livro.save()
+        ativos_por_livro = dict(
+            emprestimos.filter(devolvido=False).values_list('livro').annotate(total=Count('id')).order_by()
+        )
+        for livro in Livro.objects.filter(id__in=ativos_por_livro):
+            livro.devolver_exemplares(ativos_por_livro[livro.id])
         emprestimos.delete()
         
-        # Remove todos os alertas relacionados ao usuário
-        AlertaSistema.objects.filter(titulo__icontains=usuario.nome).delete()
-        
         # Registra a ação antes de deletar
         registrar_acao(request.user, usuario, 'DESATIVACAO', descricao=f'Usuário "{usuario.nome}" e todas suas dependências deletados permanentemente.')
         
@@ -165,6 +164,34 @@ class UsuarioViewSet(viewsets.ModelViewSet):
 # Views de Livros
 # -----------------------------------------------------------------------------
 
+class LivroFilter(django_filters.FilterSet):
+    """
+    Filtros da listagem de livros. Título e autor ignoram maiúsculas e acentos
+    (?titulo=dom casmurro) e usam as colunas normalizadas, que têm índice;
+    ?titulo_inicia=dom e ?autor_inicia=machado filtram por prefixo.
+    """
+    titulo = django_filters.CharFilter(method='filtrar_titulo')
+    autor = django_filters.CharFilter(method='filtrar_autor')
+    titulo_inicia = django_filters.CharFilter(method='filtrar_titulo_inicia')
+    autor_inicia = django_filters.CharFilter(method='filtrar_autor_inicia')
+
+    class Meta:
+        model = Livro
+        fields = ['titulo', 'autor', 'genero']
+
+    def filtrar_titulo(self, queryset, nome, valor):
+        return queryset.com_titulo(valor)
+
+    def filtrar_autor(self, queryset, nome, valor):
+        return queryset.com_autor(valor)
+
+    def filtrar_titulo_inicia(self, queryset, nome, valor):
+        return queryset.titulo_comeca_com(valor)
+
+    def filtrar_autor_inicia(self, queryset, nome, valor):
+        return queryset.autor_comeca_com(valor)
+
+
 class LivroViewSet(viewsets.ModelViewSet):
     """
     Viewset para gerenciar livros.
@@ -172,8 +199,8 @@ class LivroViewSet(viewsets.ModelViewSet):
     """
     queryset = Livro.objects.all().order_by('titulo')
     serializer_class = LivroSerializer
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
-    filterset_fields = ['titulo', 'autor', 'genero']
+    filter_backends = [DjangoFilterBackend, BuscaTextoCompletoFilter] # ?search= usa o índice de texto completo
+    filterset_class = LivroFilter
     search_fields = ['titulo', 'autor', 'genero', 'descricao']
 
     def get_permissions(self):
@@ -221,7 +248,7 @@ class LivroViewSet(viewsets.ModelViewSet):
         Emprestimo.objects.filter(livro=livro).delete()
         
         # Remove todos os alertas relacionados ao livro
-        AlertaSistema.objects.filter(titulo__icontains=livro.titulo).delete()
+        AlertaSistema.objects.filter(livro=livro).delete()
         
         # Registra a ação antes de deletar
         registrar_acao(request.user, livro, 'DESATIVACAO', descricao=f'Livro "{livro.titulo}" e todas suas dependências deletados permanentemente.')
@@ -231,73 +258,146 @@ class LivroViewSet(viewsets.ModelViewSet):
         
         return Response({'mensagem': 'Livro e todas suas dependências deletados permanentemente.'}, status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=False, methods=['get'], url_path='autocomplete')
+    def autocomplete(self, request):
+        """
+        Sugestões para o campo de busca: ?q=dom cas&limite=8.
+        Responde do índice de prefixos em memória, sem consultar o banco.
+        """
+        try:
+            limite = max(1, min(int(request.query_params.get('limite', 8)), 20))
+        except ValueError:
+            limite = 8
+        return Response(autocompletar.indice.sugerir(request.query_params.get('q', ''), limite))
+
+    @action(detail=False, methods=['get'], url_path='facetas')
+    def facetas(self, request):
+        """
+        Contagens por gênero, subgênero, tipo e disponibilidade para os mesmos filtros
+        da listagem (?genero=Romance&search=amor). Um único GROUP BY, guardado no cache
+        até o catálogo ou o estoque mudarem.
+        """
+        parametros = request.query_params.copy()
+        parametros.pop('page', None)
+        escopo = 'admin' if request.user.tipo == 'admin' else 'leitor'
+        chave = (f'brivo:facetas:{versao_catalogo()}:{versao_circulacao()}:{escopo}:'
+                 f'{parametros.urlencode()}')
+        dados = cache.get(chave)
+        if dados is not None:
+            return Response(dados)
+
+        grupos = (
+            self.filter_queryset(self.get_queryset())
+            .annotate(tem_exemplar=Case(
+                When(quantidade_total__gt=F('quantidade_emprestada'), then=Value(True)),
+                default=Value(False), output_field=BooleanField(),
+            ))
+            .values('genero', 'subgenero', 'tipo', 'tem_exemplar')
+            .annotate(total=Count('id'))
+            .order_by()
+        )
+
+        contagens = {campo: {} for campo in ('genero', 'subgenero', 'tipo')}
+        disponibilidade = {'disponivel': 0, 'indisponivel': 0}
+        total = 0
+        for grupo in grupos:
+            for campo, valores in contagens.items():
+                valores[grupo[campo]] = valores.get(grupo[campo], 0) + grupo['total']
+            disponibilidade['disponivel' if grupo['tem_exemplar'] else 'indisponivel'] += grupo['total']
+            total += grupo['total']
+
+        dados = {'total': total, 'disponibilidade': disponibilidade}
+        for campo, valores in contagens.items():
+            dados[campo] = [
+                {'valor': valor, 'total': quantidade}
+                for valor, quantidade in sorted(valores.items(), key=lambda item: (-item[1], item[0] or ''))
+            ]
+        cache.set(chave, dados, settings.CACHE_RESPOSTAS_TIMEOUT)
+        return Response(dados)
+
+    @action(detail=False, methods=['post'], url_path='reconciliar-estoque')
+    def reconciliar_estoque(self, request):
+        """
+        Recalcula a quantidade emprestada de todos os livros a partir dos empréstimos
+        ativos e corrige as divergências. Com {"simular": true} apenas as lista.
+        """
+        simular = str(request.data.get('simular', False)).lower() in ('1', 'true', 'sim')
+        divergencias = Livro.reconciliar_estoque(aplicar=not simular)
+        if divergencias and not simular:
+            logger.info(f'Estoque reconciliado por {request.user.nome}: {len(divergencias)} livros corrigidos')
+        return Response({
+            'mensagem': f'{len(divergencias)} livros com estoque divergente' + (' (simulação)' if simular else ' corrigidos'),
+            'total': len(divergencias),
+            'divergencias': divergencias,
+        })
+
     @action(detail=False, methods=['post'], url_path='verificar-duplicatas')
     def verificar_duplicatas(self, request):
         """
         Verifica se existem livros similares no sistema baseado em título e autor.
-        Retorna livros que podem ser duplicatas para confirmação do usuário.
+        Retorna livros que podem ser duplicatas para confirmação do usuário, com a
+        similaridade por trigramas (0 a 100), tolerante a acentos e erros de digitação.
+        Para catalogação em lote, envie {"livros": [{"titulo": ..., "autor": ...}, ...]}.
         """
-        titulo = request.data.get('titulo', '').strip()
-        autor = request.data.get('autor', '').strip()
-        
+        try:
+            limite = int(request.data.get('limite', 5))
+        except (TypeError, ValueError):
+            limite = 5
+        if limite < 1:
+            return Response({'erro': '"limite" deve ser um número maior que zero.'}, status=status.HTTP_400_BAD_REQUEST)
+        limite = min(limite, 50)
+
+        itens = request.data.get('livros')
+        if itens is not None:
+            invalidos = not isinstance(itens, list) or any(
+                not isinstance(item, dict)
+                or not isinstance(item.get('titulo', ''), str)
+                or not isinstance(item.get('autor', ''), str)
+                for item in itens
+            )
+            if invalidos:
+                return Response(
+                    {'erro': '"livros" deve ser uma lista de objetos com "titulo" e "autor" em texto.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            resultados = []
+            for item in itens:
+                similares = self._similares(item.get('titulo', ''), item.get('autor', ''), limite)
+                resultados.append({
+                    'titulo': item.get('titulo', ''),
+                    'autor': item.get('autor', ''),
+                    'livros_similares': similares,
+                    'tem_duplicatas': len(similares) > 0,
+                })
+            return Response({'resultados': resultados, 'total_verificados': len(resultados)})
+
+        titulo, autor = request.data.get('titulo', ''), request.data.get('autor', '')
+        if not isinstance(titulo, str) or not isinstance(autor, str):
+            return Response({'erro': '"titulo" e "autor" devem ser texto.'}, status=status.HTTP_400_BAD_REQUEST)
+        similares = self._similares(titulo, autor, limite)
+        return Response({
+            'livros_similares': similares,
+            'tem_duplicatas': len(similares) > 0,
+            'total_encontrados': len(similares)
+        })
+
+    def _similares(self, titulo, autor, limite):
+        titulo, autor = (titulo or '').strip(), (autor or '').strip()
         if not titulo or not autor:
-            return Response({
-                'livros_similares': [],
-                'tem_duplicatas': False
-            })
-        
-        # Busca por livros com título e autor similares
-        from django.db.models import Q
-        
-        # Busca exata primeiro
-        livros_exatos = Livro.objects.filter(
-            titulo__iexact=titulo,
-            autor__iexact=autor,
-            ativo=True
-        )
-        
-        # Busca por similaridade (contém palavras-chave)
-        titulo_words = titulo.lower().split()
-        autor_words = autor.lower().split()
-        
-        q_titulo = Q()
-        for word in titulo_words:
-            if len(word) > 2:  # Ignora palavras muito pequenas
-                q_titulo |= Q(titulo__icontains=word)
-        
-        q_autor = Q()
-        for word in autor_words:
-            if len(word) > 2:
-                q_autor |= Q(autor__icontains=word)
-        
-        livros_similares = Livro.objects.filter(
-            (q_titulo & q_autor) | 
-            Q(titulo__icontains=titulo) |
-            Q(autor__icontains=autor),
-            ativo=True
-        ).exclude(
-            id__in=livros_exatos.values_list('id', flat=True)
-        ).distinct()[:5]  # Limita a 5 resultados
-        
-        # Combina resultados
-        todos_similares = list(livros_exatos) + list(livros_similares)
-        
-        # Serializa os resultados
+            return []
+
+        # As duplicatas exatas vêm do índice de (titulo_norm, autor_norm) e sempre aparecem primeiro
+        exatas = list(Livro.objects.ativos().com_titulo(titulo).com_autor(autor).order_by('id')[:limite])
+        ids_exatas = {livro.id for livro in exatas}
+        candidatos = [(livro, 1.0) for livro in exatas] + [
+            (livro, similaridade) for livro, similaridade in livros_similares(titulo, autor, limite=limite)
+            if livro.id not in ids_exatas
+        ]
+
         resultados = []
-        for livro in todos_similares:
-            # Calcula similaridade simples
-            titulo_match = titulo.lower() in livro.titulo.lower() or livro.titulo.lower() in titulo.lower()
-            autor_match = autor.lower() in livro.autor.lower() or livro.autor.lower() in autor.lower()
-            
-            if livro.titulo.lower() == titulo.lower() and livro.autor.lower() == autor.lower():
-                similaridade = 100  # Exato
-            elif titulo_match and autor_match:
-                similaridade = 85
-            elif titulo_match or autor_match:
-                similaridade = 60
-            else:
-                similaridade = 40
-            
+        for livro, similaridade in candidatos[:limite]:
+            exata = livro.id in ids_exatas
             resultados.append({
                 'id': livro.id,
                 'titulo': livro.titulo,
@@ -308,18 +408,10 @@ class LivroViewSet(viewsets.ModelViewSet):
                 'quantidade_total': livro.quantidade_total,
                 'quantidade_disponivel': livro.quantidade_disponivel,
                 'capa': livro.capa,
-                'similaridade': similaridade,
-                'eh_duplicata_exata': similaridade == 100
+                'similaridade': 100 if exata else min(round(similaridade * 100), 99),
+                'eh_duplicata_exata': exata
             })
-        
-        # Ordena por similaridade
-        resultados.sort(key=lambda x: x['similaridade'], reverse=True)
-        
-        return Response({
-            'livros_similares': resultados,
-            'tem_duplicatas': len(resultados) > 0,
-            'total_encontrados': len(resultados)
-        })
+        return resultados
 
 # -----------------------------------------------------------------------------
 # Views de Empréstimzs
@@ -346,48 +438,17 @@ class EmprestimoViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         """
         Cria um novo empréstimo, associando-o ao usuário logado.
-        DISPARA EMAIL DE CONFIRMAÇÃO DE EMPRÉSTIMO AUTOMATICAMENTE
+        O email de confirmação é agendado pelo próprio Emprestimo e sai após o commit.
         """
-        emprestimo = serializer.save(usuario=self.request.user)
-        
-        # ENVIAR EMAIL DE CONFIRMAÇÃO DE EMPRÉSTIMO AUTOMATICAMENTE (NÃO QUEBRA SE FALHAR)
-        try:
-            from .utils import enviar_email_emprestimo_confirmado
-            enviar_email_emprestimo_confirmado(emprestimo)
-        except Exception as e:
-            logger.warning(f"Email de emprestimo nao enviado para {emprestimo.usuario.email}: {str(e)}")
+        serializer.save(usuario=self.request.user)
 
     def perform_update(self, serializer):
         """
-        Atualiza um empréstimo existente. Se o status mudar para devolvido,
-        chama o método para marcar a devolução.
+        Atualiza um empréstimo existente. Se o status mudar para devolvido, o
+        próprio Emprestimo devolve o exemplar ao estoque, conclui a reserva
+        associada e agenda o email de devolução para após o commit.
         """
-        instance = self.get_object()
-        devolvido_antes = instance.devolvido
-        emprestimo = serializer.save()
-
-        if not devolvido_antes and emprestimo.devolvido:
-            # A lógica de marcar_devolucao já está no modelo Emprestimo e usa timezone.now()
-            emprestimo.marcar_devolucao()
-            
-            # ENVIAR EMAIL DE DEVOLUÇÃO CONFIRMADA AUTOMATICAMENTE (NÃO QUEBRA SE FALHAR)
-            try:
-                from .utils import enviar_email_devolucao_confirmada
-                enviar_email_devolucao_confirmada(emprestimo)
-            except Exception as e:
-                logger.warning(f"Email de devolucao nao enviado para {emprestimo.usuario.email}: {str(e)}")
-            
-            # Atualizar reserva associada para 'concluida' se existir
-            try:
-                reserva_associada = Reserva.objects.get(
-                    livro=emprestimo.livro, 
-                    aluno=emprestimo.usuario, 
-                    status='emprestado'
-                )
-                reserva_associada.status = 'concluida'
-                reserva_associada.save()
-            except Reserva.DoesNotExist:
-                pass
+        serializer.save()
 
     @action(detail=False, methods=['get'], url_path='recent-reads')
     def recent_reads(self, request):
@@ -430,20 +491,7 @@ class EmprestimoViewSet(viewsets.ModelViewSet):
         try:
             emprestimo.devolvido = True
             emprestimo.data_devolucao = timezone.now()
-            emprestimo.save()
-            
-            # Atualizar reserva associada para 'concluida'
-            try:
-                reserva_associada = Reserva.objects.get(
-                    livro=emprestimo.livro,
-                    aluno=emprestimo.usuario,
-                    status='emprestado'
-                )
-                reserva_associada.status = 'concluida'
-                reserva_associada.save()
-                logger.info(f'Reserva {reserva_associada.id} marcada como concluída')
-            except Reserva.DoesNotExist:
-                logger.warning(f'Reserva associada não encontrada para empréstimo {emprestimo.id}')
+            emprestimo.save()  # O save do Emprestimo já conclui a reserva associada
             
             # Executar limpeza automática de reservas antigas
             try:
@@ -484,6 +532,110 @@ class DevolverEmprestimoView(APIView):
         except Emprestimo.DoesNotExist:
             return Response({"erro": "Empréstimo não encontrado."}, status=status.HTTP_404_NOT_FOUND)
 
+# -----------------------------------------------------------------------------
+# Views de Exemplares (balcão com leitor de código de barras)
+# -----------------------------------------------------------------------------
+
+class ExemplarViewSet(viewsets.ModelViewSet):
+    """
+    Viewset para os exemplares físicos de cada livro.
+    Admin cadastra as etiquetas; professores e admins fazem o empréstimo e a
+    devolução no balcão lendo o código de barras.
+    """
+    queryset = Exemplar.objects.select_related('livro').order_by('livro__titulo', 'codigo_barras')
+    serializer_class = ExemplarSerializer
+    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    filterset_fields = ['livro', 'status', 'codigo_barras']
+    search_fields = ['codigo_barras', 'livro__titulo']
+
+    def get_permissions(self):
+        """
+        Define as permissões para as ações de exemplares.
+        """
+        if self.action in ('checkout', 'devolucao'):
+            return [IsAuthenticated(), EhProfessorOuAdmin()]
+        if self.request.method in SAFE_METHODS:
+            return [IsAuthenticated()]
+        return [IsAuthenticated(), EhAdmin()]
+
+    @action(detail=False, methods=['post'], url_path='checkout')
+    def checkout(self, request):
+        """
+        Empresta o exemplar lido para um usuário.
+        Body: {"codigo_barras": "...", "ra": "..."} (ou "usuario": id).
+        Exemplar, empréstimo, estoque do livro e reserva do usuário mudam na mesma transação.
+        """
+        codigo = str(request.data.get('codigo_barras') or '').strip()
+        ra = request.data.get('ra')
+        usuario_id = request.data.get('usuario')
+        if not codigo or not (ra or usuario_id):
+            return Response({'erro': 'Informe o código de barras e o RA (ou id) do usuário.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        usuario = Usuario.objects.filter(ra=ra).first() if ra else Usuario.objects.filter(pk=usuario_id).first()
+        if usuario is None:
+            return Response({'erro': 'Usuário não encontrado.'}, status=status.HTTP_404_NOT_FOUND)
+        if not usuario.ativo or not usuario.is_active:
+            return Response({'erro': 'Este usuário está inativo e não pode fazer empréstimos.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            with transaction.atomic():
+                try:
+                    exemplar = Exemplar.objects.select_related('livro').get(codigo_barras=codigo)
+                except Exemplar.DoesNotExist:
+                    return Response({'erro': 'Código de barras não cadastrado.'}, status=status.HTTP_404_NOT_FOUND)
+
+                if not exemplar.livro.ativo:
+                    return Response({'erro': 'Este livro não está ativo no sistema.'}, status=status.HTTP_400_BAD_REQUEST)
+
+                # Exemplares livres já prometidos a reservas pendentes de outros usuários não saem no balcão
+                reservas_de_outros = Reserva.objects.filter(
+                    livro=exemplar.livro, status__in=['na_fila', 'aguardando_retirada']
+                ).exclude(aluno=usuario).count()
+                if reservas_de_outros and exemplar.livro.quantidade_disponivel <= reservas_de_outros:
+                    return Response(
+                        {'erro': 'Os exemplares livres deste livro estão reservados para outros usuários.'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+
+                # UPDATE condicional: duas leituras simultâneas da mesma etiqueta não geram dois empréstimos
+                if not Exemplar.objects.filter(pk=exemplar.pk, status='disponivel').update(status='emprestado'):
+                    return Response({'erro': 'Este exemplar não está disponível para empréstimo.'}, status=status.HTTP_400_BAD_REQUEST)
+
+                emprestimo = Emprestimo.objects.create(livro=exemplar.livro, usuario=usuario, exemplar=exemplar)
+                Reserva.objects.filter(
+                    livro=exemplar.livro, aluno=usuario, status='aguardando_retirada'
+                ).update(status='emprestado')
+                registrar_acao(request.user, emprestimo, 'CRIACAO', descricao=f'Empréstimo do exemplar {codigo} no balcão.')
+        except ValidationError as e:
+            return Response({'erro': f'Erro de validação: {str(e)}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            {'mensagem': 'Empréstimo registrado com sucesso.', 'emprestimo': EmprestimoSerializer(emprestimo).data},
+            status=status.HTTP_201_CREATED
+        )
+
+    @action(detail=False, methods=['post'], url_path='devolucao')
+    def devolucao(self, request):
+        """
+        Devolve o exemplar lido. Body: {"codigo_barras": "..."}.
+        O Emprestimo libera o exemplar, devolve o estoque e avisa a fila na mesma transação.
+        """
+        codigo = str(request.data.get('codigo_barras') or '').strip()
+        if not codigo:
+            return Response({'erro': 'Informe o código de barras.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        emprestimo = Emprestimo.objects.select_related('livro', 'usuario').filter(
+            exemplar__codigo_barras=codigo, devolvido=False
+        ).first()
+        if emprestimo is None:
+            return Response({'erro': 'Nenhum empréstimo ativo para este exemplar.'}, status=status.HTTP_404_NOT_FOUND)
+
+        emprestimo.marcar_devolucao()
+        return Response(
+            {'mensagem': 'Livro devolvido com sucesso.', 'emprestimo': EmprestimoSerializer(emprestimo).data},
+            status=status.HTTP_200_OK
+        )
+
 # -----------------------------------------------------------------------------
 # Views de Reservas
 # -----------------------------------------------------------------------------
@@ -517,19 +669,10 @@ class ReservaViewSet(viewsets.ModelViewSet):
         A validação de conflitos e status inicial é feita no serializer.
         DISPARA EMAILS AUTOMATICAMENTE CONFORME O TIPO DE RESERVA
         """
-        reserva = serializer.save(aluno=self.request.user)
-        registrar_acao(self.request.user, reserva, 'CRIACAO', descricao='Reserva criada.')
-        
-        # ENVIAR EMAILS AUTOMATICAMENTE CONFORME O STATUS DA RESERVA (NÃO QUEBRA SE FALHAR)
-        try:
-            from .utils import enviar_email_confirmacao_reserva, enviar_email_entrada_fila
-            
-            if reserva.status == 'aguardando_retirada':
-                enviar_email_confirmacao_reserva(reserva)
-            elif reserva.status == 'na_fila':
-                enviar_email_entrada_fila(reserva)
-        except Exception as e:
-            logger.warning(f"Email de reserva nao enviado para {reserva.aluno.email}: {str(e)}")
+        with transaction.atomic():
+            # O email conforme o status é agendado pelo serializer e sai após o commit
+            reserva = serializer.save(aluno=self.request.user)
+            registrar_acao(self.request.user, reserva, 'CRIACAO', descricao='Reserva criada.')
 
     def perform_update(self, serializer):
         """
@@ -582,11 +725,8 @@ class ReservaViewSet(viewsets.ModelViewSet):
                 ).first()
                 
                 if emprestimo_ativo:
-                    # Restaurar quantidade do livro antes de deletar
-                    livro = emprestimo_ativo.livro
-                    if livro.quantidade_emprestada > 0:
-                        livro.quantidade_emprestada -= 1
-                        livro.save()
+                    # Devolver o exemplar ao estoque antes de deletar
+                    emprestimo_ativo.livro.devolver_exemplares()
                     # Remover empréstimo
                     emprestimo_ativo.delete()
             
@@ -634,14 +774,15 @@ class ReservaViewSet(viewsets.ModelViewSet):
             )
 
         try:
-            emprestimo = Emprestimo.objects.create(
-                livro=reserva.livro,
-                usuario=reserva.aluno,
-                data_emprestimo=timezone.now()
-            )
-            reserva.status = 'emprestado'
-            reserva.save()
-            registrar_acao(request.user, reserva, 'EDICAO', descricao=f'Reserva do livro {reserva.livro.titulo} efetivada como empréstimo.')
+            with transaction.atomic():
+                emprestimo = Emprestimo.objects.create(
+                    livro=reserva.livro,
+                    usuario=reserva.aluno,
+                    data_emprestimo=timezone.now()
+                )
+                reserva.status = 'emprestado'
+                reserva.save()
+                registrar_acao(request.user, reserva, 'EDICAO', descricao=f'Reserva do livro {reserva.livro.titulo} efetivada como empréstimo.')
 
             return Response(
                 {'mensagem': 'Reserva efetivada e empréstimo criado com sucesso.', 'emprestimo_id': emprestimo.id},
@@ -687,12 +828,17 @@ class TesteEmailView(APIView):
     permission_classes = [IsAuthenticated, EhAdmin]
 
     def get(self, request):
+        # Para testes de carga use `manage.py benchmark_emails`, que envia para um SMTP local
+        destinatario = request.query_params.get('destinatario') or request.user.email
+        if not destinatario:
+            return Response({'erro': 'Informe ?destinatario= ou cadastre um email no seu usuário'},
+                            status=status.HTTP_400_BAD_REQUEST)
         enviar_email(
-            destinatario='brivo1652@gmail.com',
+            destinatario=destinatario,
             assunto='Teste de E-mail da Biblioteca Brivo',
             mensagem='Este é um teste do sistema de e-mails da biblioteca. Se você recebeu este e-mail, a configuração está funcionando corretamente.'
         )
-        return Response({'mensagem': 'E-mail de teste enviado com sucesso'})
+        return Response({'mensagem': f'E-mail de teste enviado para {destinatario}'})
 
 # -----------------------------------------------------------------------------
 # 📧 VIEWS PARA ENVIO MANUAL DE EMAILS
@@ -754,47 +900,22 @@ class EnviarEmailGrupoView(APIView):
                 'erro': 'Assunto e mensagem são obrigatórios'
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        # BUSCAR USUÁRIOS PARA ENVIO
-        usuarios_para_envio = []
-        
-        # Por tipo de usuário
-        if tipo_usuarios:
-            usuarios_por_tipo = Usuario.objects.filter(
-                ativo=True,
-                tipo__in=tipo_usuarios
-            )
-            usuarios_para_envio.extend(usuarios_por_tipo)
-        
-        # Usuários específicos
-        if usuarios_especificos:
-            usuarios_especificos_obj = Usuario.objects.filter(
-                id__in=usuarios_especificos,
-                ativo=True
-            )
-            usuarios_para_envio.extend(usuarios_especificos_obj)
-        
-        if not usuarios_para_envio:
+        # BUSCAR USUÁRIOS PARA ENVIO (uma consulta, sem duplicados, lida em blocos)
+        from .utils import resolver_destinatarios, enviar_email_grupo
+        destinatarios = resolver_destinatarios(tipos=tipo_usuarios, ids=usuarios_especificos) \
+            if tipo_usuarios or usuarios_especificos else ()
+
+        # ENVIAR EMAILS (gravados na fila e no histórico bloco a bloco)
+        emails_enviados, emails_falharam = enviar_email_grupo(
+            destinatarios, assunto, mensagem, prioridade=EmailOutbox.PRIORIDADE_INFORMATIVO,
+            remetente=request.user,
+        )
+        if not emails_enviados and not emails_falharam:
             return Response({
                 'erro': 'Nenhum usuário encontrado para envio'
             }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # ENVIAR EMAILS
-        from .utils import enviar_email_manual
-        emails_enviados = 0
-        emails_falharam = 0
-        
-        for usuario in usuarios_para_envio:
-            sucesso = enviar_email_manual(
-                destinatario_email=usuario.email,
-                assunto_personalizado=assunto,
-                mensagem_personalizada=mensagem,
-                remetente_usuario=request.user
-            )
-            
-            if sucesso:
-                emails_enviados += 1
-            else:
-                emails_falharam += 1
+
+        logger.info(f'Email em grupo "{assunto}" enviado por {request.user.nome}: {emails_enviados} enviados, {emails_falharam} falharam')
         
         return Response({
             'mensagem': f'Envio concluído: {emails_enviados} enviados, {emails_falharam} falharam',
@@ -961,6 +1082,7 @@ class DashboardAdminView(APIView):
     """
     permission_classes = [IsAuthenticated, EhAdmin]
 
+    @resposta_em_cache('dashboard')
     def get(self, request):
         periodo = request.query_params.get('periodo')
         agora = timezone.now()
@@ -981,97 +1103,72 @@ class DashboardAdminView(APIView):
             filtro_emprestimos = {'data_emprestimo__gte': inicio_mes}
             filtro_reservas = {'data_reserva__gte': inicio_mes}
 
-        total_livros = Livro.objects.count()
-        livros_ativos = Livro.objects.filter(ativo=True).count()
-        livros_inativos = Livro.objects.filter(ativo=False).count()
-
-        total_usuarios_ativos_geral = Usuario.objects.filter(ativo=True).count()
-
-        total_usuarios_filtrados = Usuario.objects.filter(ativo=True, **filtro_usuarios).count()
+        # Um único SELECT por tabela: cada contador é um COUNT com FILTER (CASE WHEN no SQLite)
+        livros = Livro.objects.aggregate(
+            total=Count('id'),
+            ativos=Count('id', filter=Q(ativo=True)),
+            inativos=Count('id', filter=Q(ativo=False)),
+        )
 
-        total_alunos = Usuario.objects.filter(ativo=True, tipo='aluno', **filtro_usuarios).count()
-        total_professores = Usuario.objects.filter(ativo=True, tipo='professor', **filtro_usuarios).count()
-        total_admins = Usuario.objects.filter(ativo=True, tipo='admin', **filtro_usuarios).count()
+        usuarios = Usuario.objects.filter(ativo=True).aggregate(
+            total_geral_ativos=Count('id'),
+            total_filtrado=Count('id', filter=Q(**filtro_usuarios)),
+            alunos=Count('id', filter=Q(tipo='aluno', **filtro_usuarios)),
+            total_professores=Count('id', filter=Q(tipo='professor', **filtro_usuarios)),
+            admins=Count('id', filter=Q(tipo='admin', **filtro_usuarios)),
+        )
 
         hoje = date.today()
-        reservas_hoje = Reserva.objects.filter(
-            data_reserva__date=hoje,
-            status__in=['na_fila', 'aguardando_retirada', 'emprestado']
-        ).count()
-
-        reservas_na_fila = Reserva.objects.filter(status='na_fila', **filtro_reservas).count()
-        reservas_aguardando_retirada = Reserva.objects.filter(status='aguardando_retirada', **filtro_reservas).count()
-        reservas_emprestadas = Reserva.objects.filter(status='emprestado', **filtro_reservas).count()
-        reservas_concluidas = Reserva.objects.filter(status='concluida', **filtro_reservas).count()
-        reservas_expiradas = Reserva.objects.filter(status='expirada', **filtro_reservas).count()
-        reservas_canceladas = Reserva.objects.filter(status='cancelada', **filtro_reservas).count()
-
-        total_emprestimos_geral = Emprestimo.objects.count()
-
-        emprestimos_ativos = Emprestimo.objects.filter(devolvido=False, **filtro_emprestimos).count()
-        emprestimos_concluidos = Emprestimo.objects.filter(devolvido=True, **filtro_emprestimos).count()
-
-        emprestimos_por_mes = (
-            Emprestimo.objects.annotate(mes=TruncMonth('data_emprestimo'))
-            .values('mes')
-            .annotate(total=Count('id'))
-            .order_by('mes')
+        reservas = Reserva.objects.aggregate(
+            hoje=Count('id', filter=Q(data_reserva__date=hoje, status__in=['na_fila', 'aguardando_retirada', 'emprestado'])),
+            na_fila=Count('id', filter=Q(status='na_fila', **filtro_reservas)),
+            aguardando_retirada=Count('id', filter=Q(status='aguardando_retirada', **filtro_reservas)),
+            emprestadas=Count('id', filter=Q(status='emprestado', **filtro_reservas)),
+            concluidas=Count('id', filter=Q(status='concluida', **filtro_reservas)),
+            expiradas=Count('id', filter=Q(status='expirada', **filtro_reservas)),
+            canceladas=Count('id', filter=Q(status='cancelada', **filtro_reservas)),
         )
 
-        reservas_por_mes = (
-            Reserva.objects.annotate(mes=TruncMonth('data_reserva'))
-            .values('mes')
-            .annotate(total=Count('id'))
-            .order_by('mes')
+        emprestimos = Emprestimo.objects.aggregate(
+            total_geral=Count('id'),
+            ativos=Count('id', filter=Q(devolvido=False, **filtro_emprestimos)),
+            devolvidos=Count('id', filter=Q(devolvido=True, **filtro_emprestimos)),
         )
 
+        # Séries mensais a partir da tabela de estatísticas diárias (uma linha por dia/gênero/turma).
+        # O mês sai como datetime no fuso atual, como saía do TruncMonth sobre as datas dos registros.
+        def serie_mensal(campo):
+            return [
+                {'mes': timezone.make_aware(datetime.combine(linha['mes'], datetime.min.time())), 'total': linha['total']}
+                for linha in EstatisticaDiaria.objects.filter(**{f'{campo}__gt': 0})
+                .annotate(mes=TruncMonth('dia')).values('mes').annotate(total=Sum(campo)).order_by('mes')
+            ]
+
+        emprestimos_por_mes = serie_mensal('emprestimos')
+        reservas_por_mes = serie_mensal('reservas')
+
         # --- NOVOS DADOS PARA O DASHBOARD ---
 
-        # Top Livros Mais Emprestados (considerando apenas empréstimos concluídos ou ativos)
-        # Agrupa por livro e conta o número de empréstimos, depois pega os 5 primeiros
-        top_livros_emprestados = Emprestimo.objects.filter(
-            livro__ativo=True # Considera apenas livros ativos
-        ).values('livro__titulo').annotate(
-            total_emprestimos=Count('id')
-        ).order_by('-total_emprestimos')[:5] # Top 5 livros
-
-        # Reservas por Gênero/Categoria (assumindo que Livro tem um campo 'genero')
-        # Agrupa por gênero do livro e conta o número de reservas
-        reservas_por_genero = Reserva.objects.filter(
-            livro__ativo=True, # Considera apenas livros ativos
-            livro__genero__isnull=False # Garante que o gênero não seja nulo
-        ).values('livro__genero').annotate(
-            total_reservas=Count('id')
-        ).order_by('-total_reservas')
+        # Top 5 Livros Mais Emprestados, pelo contador de empréstimos existentes de cada livro ativo
+        top_livros_emprestados = [
+            {'livro__titulo': titulo, 'total_emprestimos': total}
+            for titulo, total in Livro.objects.filter(ativo=True, total_emprestimos__gt=0)
+            .order_by('-total_emprestimos').values_list('titulo', 'total_emprestimos')[:5]
+        ]
+
+        # Reservas existentes por Gênero dos livros ativos, somando o contador de cada livro
+        reservas_por_genero = [
+            {'livro__genero': linha['genero'], 'total_reservas': linha['total_reservas']}
+            for linha in Livro.objects.filter(ativo=True, genero__isnull=False, total_reservas__gt=0)
+            .values('genero').annotate(total_reservas=Sum('total_reservas')).order_by('-total_reservas')
+        ]
 
         return Response({
             'filtro_aplicado': periodo or 'todos',
-            'livros': {
-                'total': total_livros,
-                'ativos': livros_ativos,
-                'inativos': livros_inativos,
-            },
-            'usuarios': {
-                'total_geral_ativos': total_usuarios_ativos_geral,
-                'total_filtrado': total_usuarios_filtrados,
-                'alunos': total_alunos,
-                'total_professores': total_professores,
-                'admins': total_admins,
-            },
-            'reservas': {
-                'hoje': reservas_hoje,
-                'na_fila': reservas_na_fila,
-                'aguardando_retirada': reservas_aguardando_retirada,
-                'emprestadas': reservas_emprestadas,
-                'concluidas': reservas_concluidas,
-                'expiradas': reservas_expiradas,
-                'canceladas': reservas_canceladas,
-            },
-            'emprestimos': {
-                'total_geral': total_emprestimos_geral,
-                'ativos': emprestimos_ativos,
-                'devolvidos': emprestimos_concluidos,
-            },
+            'livros': livros,
+            'usuarios': usuarios,
+            'reservas': reservas,
+            'emprestimos': emprestimos,
             'graficos': {
                 'emprestimos_por_mes': list(emprestimos_por_mes),
                 'reservas_por_mes': list(reservas_por_mes),
@@ -1214,6 +1311,28 @@ class AlertaSistemaViewSet(viewsets.ModelViewSet):
         except Exception as e:
             return Response({'erro': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=False, methods=['get'], url_path='emails-falhos', permission_classes=[IsAuthenticated, EhAdmin])
+    def emails_falhos(self, request):
+        """
+        Lista os e-mails que esgotaram as tentativas de envio (dead letter).
+        """
+        falhas = EmailOutbox.objects.filter(status='falhou').order_by('-criado_em')
+        pagina = self.paginate_queryset(falhas)
+        if pagina is not None:
+            return self.get_paginated_response(EmailOutboxSerializer(pagina, many=True).data)
+        return Response(EmailOutboxSerializer(falhas, many=True).data)
+
+    @action(detail=False, methods=['post'], url_path='reenviar-emails-falhos', permission_classes=[IsAuthenticated, EhAdmin])
+    def reenviar_emails_falhos(self, request):
+        """
+        Devolve e-mails do dead letter para a fila de envio.
+        Aceita 'ids' (lista) para reenviar apenas alguns; sem 'ids' reenvia todos.
+        """
+        ids = request.data.get('ids') or None
+        total = reenviar_falhas(ids)
+        logger.info(f'{total} emails com falha devolvidos para a fila por {request.user.nome}')
+        return Response({'mensagem': f'{total} emails devolvidos para a fila de envio.', 'total': total}, status=status.HTTP_200_OK)
+
 class PublicAlertaSistemaListView(generics.ListAPIView):
     """
     View para listar alertas do sistema públicos e ativos.
@@ -1297,34 +1416,18 @@ class UserStatsView(APIView):
     """
     permission_classes = [IsAuthenticated]
 
+    @resposta_em_cache('user-stats', por_usuario=True)
     def get(self, request):
-        user = request.user
-        
-        # Conta apenas livros únicos ativos (não soma quantidades)
-        total_livros = Livro.objects.filter(ativo=True).count()
-        
-        # Livros disponíveis (que têm pelo menos 1 exemplar disponível)
-        livros_disponiveis = Livro.objects.filter(
-            ativo=True,
-            quantidade_total__gt=F('quantidade_emprestada')
-        ).count()
-        
-        # Estatísticas pessoais do usuário
-        minhas_reservas = Reserva.objects.filter(
-            aluno=user,
-            status__in=['na_fila', 'aguardando_retirada', 'emprestado']
-        ).count()
-        
-        livros_lidos = Emprestimo.objects.filter(
-            usuario=user,
-            devolvido=True
-        ).count()
-        
+        # Duas leituras por chave primária: contadores do acervo e do usuário,
+        # mantidos pelo ciclo de vida de livros, reservas e empréstimos
+        catalogo = EstatisticaCatalogo.obter()
+        pessoais = EstatisticaUsuario.obter(request.user.pk)
+
         return Response({
-            'total_livros': total_livros,
-            'livros_disponiveis': livros_disponiveis,
-            'minhas_reservas': minhas_reservas,
-            'livros_lidos': livros_lidos
+            'total_livros': catalogo.livros_ativos,
+            'livros_disponiveis': catalogo.livros_disponiveis,
+            'minhas_reservas': pessoais.reservas_ativas,
+            'livros_lidos': pessoais.livros_lidos
         })
 
 # -----------------------------------------------------------------------------
@@ -1338,6 +1441,7 @@ class RelatoriosPedagogicosView(APIView):
     """
     permission_classes = [IsAuthenticated, EhProfessorOuAdmin]
 
+    @resposta_em_cache('relatorios-pedagogicos')
     def get(self, request):
         agora = timezone.now()
         
@@ -1355,14 +1459,16 @@ class RelatoriosPedagogicosView(APIView):
             'media_leitura': round(media_leitura_aluno, 2),
         }
 
-        # Top 10 Alunos Mais Ativos (Empréstimos)
+        # Top 10 Alunos Mais Ativos (Empréstimos), contados por subconsulta no índice de usuario_id
+        emprestimos_do_aluno = Emprestimo.objects.filter(
+            usuario=OuterRef('pk')
+        ).order_by().values('usuario').annotate(total=Count('id')).values('total')
         alunos_mais_ativos = Usuario.objects.filter(
             tipo='aluno',
             ativo=True
         ).annotate(
-            # Corrigido para usar 'emprestimos' (plural) conforme o seu models.py
-            total_emprestimos=Count('emprestimos') 
-        ).order_by('-total_emprestimos')[:10]
+            total_emprestimos=Coalesce(Subquery(emprestimos_do_aluno), 0)
+        ).only('id', 'nome', 'turma', 'ra').order_by('-total_emprestimos')[:10]
         
         alunos_data = [{
             'id': aluno.id,
@@ -1372,17 +1478,13 @@ class RelatoriosPedagogicosView(APIView):
             'total_emprestimos': aluno.total_emprestimos,
         } for aluno in alunos_mais_ativos]
 
-        # Livros Mais Populares
+        # Livros Mais Populares: soma dos contadores do próprio livro, sem juntar
+        # empréstimos e reservas (o JOIN duplo multiplicava as duas contagens)
         populares = Livro.objects.filter(
             ativo=True
         ).annotate(
-            # CORRIGIDO: O nome do relacionamento é 'emprestimos', não 'emprestimo'
-            total_emprestimos=Count('emprestimos'),
-            total_reservas=Count('reservas')
-        ).annotate(
-            # CORRIGIDO: O nome do relacionamento é 'emprestimos', não 'emprestimo'
-            popularidade=Count('emprestimos') + Count('reservas')
-        ).order_by('-popularidade')[:5]
+            popularidade=F('total_emprestimos') + F('total_reservas')
+        ).only('id', 'titulo', 'autor', 'total_emprestimos', 'total_reservas').order_by('-popularidade')[:5]
 
         livros_data = [{
             'id': livro.id,